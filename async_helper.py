@@ -0,0 +1,476 @@
+import asyncio
+import contextlib
+import os
+import threading
+import urllib.error
+import urllib.parse
+
+from pytube import YouTube
+
+from cache import MetadataCache
+from stats import Instrumentation
+from streams import quality_label
+from thumbnails import thumbnail_candidates, decode_thumbnail, ORIGINAL
+from helper import YouTubeHelper, fetch_metadata, safe_filename, target_directory
+from media import plan_mux, audio_convert_command, audio_convert_path, ffmpeg_capabilities, progress_command, \
+    FfmpegError, FfmpegProgressReader
+from transfer import AsyncSegmentedDownloader, DEFAULT_CONNECTIONS, JOURNAL_SUFFIX
+
+
+class AsyncStageLimits:
+    def __init__(self, downloads=None, muxes=None):
+        """
+        asyncio counterpart of helper.StageLimits, shared between helpers running on the same event loop
+
+        :param downloads: maximum number of concurrent downloads, unlimited if None
+        :type downloads: int or None
+        :param muxes: maximum number of concurrent ffmpeg mux/transcode processes, unlimited if None
+        :type muxes: int or None
+        """
+        self.download = asyncio.Semaphore(downloads) if downloads else _Unlimited()
+        self.mux = asyncio.Semaphore(muxes) if muxes else _Unlimited()
+
+
+class _Unlimited:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class AsyncYouTubeHelper:
+    def __init__(self, video_link, metadata, on_progress=None, connections=DEFAULT_CONNECTIONS, limits=None,
+                 cache=True, instrumentation=None, bandwidth=None, priority=None):
+        """
+        asyncio counterpart of YouTubeHelper, use create() to build one. downloads, thumbnail fetch and ffmpeg
+        run on the event loop, so many videos can be processed at once without a thread each.
+        stream selection and queries such as get_all_resolution and get_info come from a YouTubeHelper of the
+        video, the queries stay synchronous. clips and get_outputs run that helper in a worker thread.
+
+        cancelling a coroutine of the helper stops its downloads and ffmpeg process and removes their
+        partial files, other failures keep partial downloads so that they can be resumed
+
+        :param video_link: link to the YouTube video
+        :type video_link: str
+        :param metadata: metadata of the video, see helper.fetch_metadata
+        :type metadata: dict
+        :param on_progress: callback(label, bytes_done, total) for download progress, print progress if None
+        :type on_progress: callable or None
+        :param connections: number of parallel connections used to download one stream
+        :type connections: int
+        :param limits: limits on concurrent downloads and ffmpeg processes shared with other helpers
+        :type limits: AsyncStageLimits or None
+        :param cache: metadata cache to use, True for the default cache, False to always fetch
+        :type cache: MetadataCache or bool
+        :param instrumentation: receives timing and throughput events of every stage
+        :type instrumentation: stats.Instrumentation or None
+        :param bandwidth: rate limits shared with other helpers, also sync ones, unlimited if None
+        :type bandwidth: bandwidth.BandwidthScheduler or None
+        :param priority: priority class of the downloads under bandwidth, see YouTubeHelper
+        :type priority: int or None
+        """
+        self.video_link = video_link
+        self.metadata = metadata
+        # arguments of the blocking helpers, see _run_blocking
+        self.options = dict(on_progress=on_progress, connections=connections, cache=cache,
+                            instrumentation=instrumentation, bandwidth=bandwidth, priority=priority)
+        self.helper = YouTubeHelper(video_link, metadata=metadata, **self.options)
+        self.downloader = AsyncSegmentedDownloader(connections=connections)
+        self.limits = limits if limits is not None else AsyncStageLimits()
+        self.outputs = []  # paths of the files written, in order, see YouTubeHelper.outputs
+        self.on_progress = self.helper.on_progress
+        self.stats = self.helper.stats
+        self.thumbnails = self.helper.thumbnails
+        self.video_id = self.helper.video_id
+        self.title = self.helper.title
+        self.author = self.helper.author
+        self.length = self.helper.length
+        self.description = self.helper.description
+        self.thumbnail_url = self.helper.thumbnail_url
+        self.publish_date = self.helper.publish_date
+        self.streams = self.helper.streams
+        self.stream_index = self.helper.stream_index
+
+    @classmethod
+    async def create(cls, video_link, on_progress=None, connections=DEFAULT_CONNECTIONS, limits=None, cache=True,
+                     instrumentation=None, bandwidth=None, priority=None):
+        """
+        look up the video and build a helper for it, metadata comes from the cache when possible.
+        pytube only has a blocking API, so a cache miss is fetched in a worker thread
+
+        :return: helper of the video
+        :rtype: AsyncYouTubeHelper
+        """
+        cache = MetadataCache() if cache is True else cache or None
+        yt = YouTube(video_link)
+        metadata = cache.get(yt.video_id) if cache else None
+        if metadata is None:
+            stats = (instrumentation if instrumentation is not None else Instrumentation()).bind(
+                video_id=yt.video_id)
+            async with (limits.download if limits is not None else _Unlimited()):
+                with stats.stage('metadata'):
+                    metadata = await asyncio.to_thread(fetch_metadata, yt, cache)
+        return cls(video_link, metadata, on_progress=on_progress, connections=connections, limits=limits,
+                   cache=cache, instrumentation=instrumentation, bandwidth=bandwidth, priority=priority)
+
+    async def auto_download(self, myfolder=None, container='mp4', max_bytes=None, start=None, end=None,
+                            precise=False):
+        """
+        download highest quality video available
+
+        :param myfolder: directory of downloaded video
+        :type myfolder: str or path-like or None
+        :param container: output container, see get_video
+        :type container: str or None
+        :param max_bytes: largest acceptable (estimated) size of the video stream, no limit if None
+        :type max_bytes: int or None
+        :param start: start of a clip in seconds, see get_video
+        :type start: float or None
+        :param end: end of a clip in seconds, see get_video
+        :type end: float or None
+        :param precise: cut the clip exactly, see get_video
+        :type precise: bool
+        :return: how video and audio were muxed, None for progressive video
+        :rtype: media.MuxPlan or None
+        """
+        resolution, fps = self.helper._best_quality(max_bytes)
+        print('video with resolution {} will be downloaded'.format(quality_label(resolution, fps)))
+        return await self.get_video('{}p'.format(resolution), myfolder=myfolder, fps=fps, container=container,
+                                    start=start, end=end, precise=precise)
+
+    async def get_video(self, resolution, myfolder=None, fps=None, container='mp4', start=None, end=None,
+                        precise=False):
+        """
+        download video, stream copy video and audio into the container when possible
+
+        :param myfolder: path to folder for downloaded video and audio
+        :type myfolder: path-like or str or None
+        :param resolution: resolution ends with 'p', or a quality label such as 1080p60
+        :type resolution: str
+        :param fps: frame per second, the standard frame rate if None
+        :type fps: int
+        :param container: output container (mp4, mkv or webm), None to pick mp4 or mkv, whichever avoids re-encoding
+        :type container: str or None
+        :param start: start of a clip in seconds, downloaded by YouTubeHelper.get_video in a worker thread
+        :type start: float or None
+        :param end: end of a clip in seconds, see start
+        :type end: float or None
+        :param precise: cut the clip exactly, see YouTubeHelper.get_video
+        :type precise: bool
+        :return: how video and audio were muxed, None for progressive video
+        :rtype: media.MuxPlan or None
+        """
+        if start is not None or end is not None:
+            return await self._run_blocking('get_video', resolution, myfolder=myfolder, fps=fps, container=container,
+                                            start=start, end=end, precise=precise)
+        progressive_video, video_stream, audio_stream = self.helper._select_video(resolution, fps)
+        if progressive_video:
+            print("[Downloading progressive video...]")
+            async with self.limits.download:
+                self.outputs.append(await self._download_stream(progressive_video, safe_filename(self.title),
+                                                                myfolder=myfolder, label='video'))
+            return None
+        # the first call probes ffmpeg, later calls return the cached result
+        capabilities = await asyncio.to_thread(ffmpeg_capabilities)
+        plan = plan_mux(video_stream.video_codec, audio_stream.audio_codec, container=container,
+                        capabilities=capabilities)
+        valid_filename = safe_filename(self.title) + '.' + plan.container
+        file_path = os.path.join(myfolder, valid_filename) if myfolder else valid_filename
+        video_filename = '{}_{}'.format(self.video_id, video_stream.itag)
+        audio_filename = '{}_{}'.format(self.video_id, audio_stream.itag)
+        video_path = video_stream.get_file_path(filename=video_filename, output_path=myfolder)
+        audio_path = audio_stream.get_file_path(filename=audio_filename, output_path=myfolder)
+        try:
+            print("[Downloading...]")
+            async with self.limits.download:
+                await _gather_or_cancel(
+                    self._download_stream(video_stream, video_filename, myfolder=myfolder, label='video'),
+                    self._download_stream(audio_stream, audio_filename, myfolder=myfolder, label='audio'))
+            print("[Muxing: {}]".format(plan))
+            async with self.limits.mux:
+                with self.stats.stage('mux', plan=str(plan)) as meter:
+                    await self._run_ffmpeg(plan.ffmpeg_command(video_path, audio_path, file_path), file_path,
+                                           on_progress=self.helper._ffmpeg_progress(meter))
+        except asyncio.CancelledError:
+            # a stream that finished before cancelling is not needed either
+            _remove(video_path)
+            _remove(audio_path)
+            raise
+        os.remove(video_path)
+        os.remove(audio_path)
+        self.outputs.append(file_path)
+        return plan
+
+    async def get_audio(self, myfolder=None, quality=None, audio_format=None, start=None, end=None):
+        """
+        download audio in different format
+
+        :param myfolder: directory for downloading audio
+        :type myfolder: str or path-like or None
+        :param quality: bit rate
+        :type quality: int or None
+        :param audio_format: audio format e.g.mp3,w4a
+        :type: str
+        :param start: start of a clip in seconds, downloaded by YouTubeHelper.get_audio in a worker thread
+        :type start: float or None
+        :param end: end of a clip in seconds, see start
+        :type end: float or None
+        :return: None
+        """
+        if start is not None or end is not None:
+            return await self._run_blocking('get_audio', myfolder=myfolder, quality=quality,
+                                            audio_format=audio_format, start=start, end=end)
+        filename = safe_filename(self.title)
+        if audio_format:
+            audio_format = audio_format if audio_format[0] == '.' else '.' + audio_format
+        target = self.helper._select_audio(quality, audio_format[1:] if audio_format else None)
+        print("audio with {} {} is going to be downloaded".format(target.abr, target.audio_codec))
+        print("[Downloading...]")
+        async with self.limits.download:
+            audio_path = await self._download_stream(target, filename, myfolder=myfolder, label='audio')
+        print('[Download success]')
+        if not audio_format or os.path.splitext(audio_path)[1] == audio_format:
+            self.outputs.append(audio_path)
+        if audio_format:
+            path, ext = os.path.splitext(audio_path)
+            if ext != audio_format:
+                output_path = os.path.join(myfolder, filename + audio_format) if myfolder \
+                    else filename + audio_format
+                command = audio_convert_command(audio_path, output_path, audio_format[1:],
+                                                audio_codec=target.audio_codec)
+                convert_path = audio_convert_path(target.audio_codec, audio_format[1:])
+                print("[Converting to {} ({})]".format(audio_format[1:], convert_path))
+                async with self.limits.mux:
+                    with self.stats.stage('convert', format=audio_format[1:], path=convert_path) as meter:
+                        await self._run_ffmpeg(command, output_path,
+                                               on_progress=self.helper._ffmpeg_progress(meter))
+                os.remove(audio_path)
+                self.outputs.append(output_path)
+
+    async def get_outputs(self, outputs, myfolder=None, start=None, end=None, precise=False):
+        """
+        several files from one download of the streams, see YouTubeHelper.get_outputs, run in a worker thread
+
+        :param outputs: files to produce
+        :type outputs: list[helper.Output]
+        :return: paths of the files, in the same order as outputs
+        :rtype: list[str]
+        """
+        return await self._run_blocking('get_outputs', outputs, myfolder=myfolder, start=start, end=end,
+                                        precise=precise)
+
+    async def get_thumbnail(self, myfolder=None):
+        """
+        download video thumbnail and return the path to downloaded thumbnail
+
+        :param myfolder: directory for downloading thumbnail
+        :type myfolder: str or path-like or None
+        :return: path to thumbnail
+        :rtype: str
+        """
+        filename = os.path.basename(urllib.parse.urlparse(self.thumbnail_url).path)
+        full_path = os.path.normpath(os.path.join(myfolder, filename)) if myfolder is not None else filename
+        data = await self.get_thumbnail_bytes()
+        with open(full_path, 'wb') as f:
+            f.write(data)
+        self.outputs.append(full_path)
+        return full_path
+
+    async def get_thumbnail_bytes(self, width=None, height=None):
+        """
+        the smallest video thumbnail covering width x height, see thumbnails.fetch_thumbnail
+
+        :return: JPEG data
+        :rtype: bytes
+        """
+        candidates = thumbnail_candidates(self.video_id, width, height, fallback_url=self.thumbnail_url)
+        if self.thumbnails is not None:
+            for variant, _ in candidates:
+                data = self.thumbnails.get(self.video_id, variant)
+                if data is not None:
+                    return data
+        error = None
+        with self.stats.stage('thumbnail'):
+            async with self.limits.download:
+                while candidates:
+                    variant, url = candidates.pop(0)
+                    try:
+                        data = await self.downloader.fetch(url)
+                    except urllib.error.HTTPError as e:
+                        error = e  # variant missing, try the next one
+                        continue
+                    except (OSError, asyncio.TimeoutError) as e:
+                        # thumbnail host unreachable, only the url from the metadata may still work
+                        error = e
+                        candidates = [c for c in candidates if c[0] == ORIGINAL]
+                        continue
+                    if self.thumbnails is not None:
+                        self.thumbnails.put(self.video_id, variant, data)
+                    return data
+        raise error
+
+    async def get_thumbnail_image(self, width=None, height=None):
+        """
+        video thumbnail decoded and scaled down to fit width x height in a worker thread, needs Pillow
+
+        :rtype: PIL.Image.Image
+        """
+        data = await self.get_thumbnail_bytes(width, height)
+        return await asyncio.to_thread(decode_thumbnail, data, width, height)
+
+    def get_all_resolution(self):
+        """
+        see YouTubeHelper.get_all_resolution
+
+        :rtype: list[str]
+        """
+        return self.helper.get_all_resolution()
+
+    def get_all_audio_quality(self):
+        """
+        see YouTubeHelper.get_all_audio_quality
+
+        :rtype: list[str]
+        """
+        return self.helper.get_all_audio_quality()
+
+    def get_info(self):
+        """
+        see YouTubeHelper.get_info
+
+        :return: None
+        """
+        self.helper.get_info()
+
+    def get_video_length(self):
+        """
+        see YouTubeHelper.get_video_length
+
+        :rtype: str
+        """
+        return self.helper.get_video_length()
+
+    def get_title(self):
+        """
+        :rtype: str
+        """
+        return self.title
+
+    async def _run_blocking(self, method, *args, **kwargs):
+        """
+        call a method of a YouTubeHelper of its own in a worker thread, for what only the blocking helper does:
+        clips and get_outputs. the call takes one download slot of limits while it runs. cancelling the
+        coroutine cancels the helper like YouTubeHelper.cancel: a running ffmpeg process finishes first and
+        partial downloads are kept
+
+        :param method: name of the YouTubeHelper method
+        :type method: str
+        :return: result of the method
+        """
+        # a helper per call, cancelling one call leaves the others and later calls alone
+        helper = YouTubeHelper(self.video_link, metadata=self.metadata, **self.options)
+        try:
+            async with self.limits.download:
+                return await asyncio.to_thread(getattr(helper, method), *args, **kwargs)
+        except asyncio.CancelledError:
+            helper.cancel()
+            raise
+        finally:
+            self.outputs.extend(helper.outputs)
+
+    async def _download_stream(self, stream, filename, myfolder=None, label='stream'):
+        """
+        download a stream through a partial file keyed by video id and itag, see YouTubeHelper._download_stream.
+        the partial file is removed if the download is cancelled
+
+        :return: path to downloaded stream
+        :rtype: str
+        """
+        if stream.is_otf:
+            # sequential (otf) streams are only supported by pytube's blocking request.seq_stream
+            cancel_event = threading.Event()
+            try:
+                return await asyncio.to_thread(self.helper._download_stream, stream, filename, myfolder=myfolder,
+                                               label=label, cancel_event=cancel_event)
+            except asyncio.CancelledError:
+                cancel_event.set()
+                raise
+        file_path = stream.get_file_path(filename=filename, output_path=myfolder)
+        partial_path = os.path.join(target_directory(myfolder), '{}.{}.part'.format(self.video_id, stream.itag))
+        filesize = stream.known_filesize
+        if filesize is None:
+            # only streams missing from the streaming data need a HEAD request
+            filesize = await asyncio.to_thread(getattr, stream, 'filesize')
+        if os.path.isfile(file_path) and os.path.getsize(file_path) == filesize:
+            # already downloaded
+            self.on_progress(label, filesize, filesize)
+            return file_path
+        try:
+            with self.stats.stage('download', label=label, itag=stream.itag) as meter:
+                await self.downloader.download(stream.url, partial_path, filesize,
+                                               on_progress=self.helper._progress_callback(label, meter),
+                                               resume=True, throttle=self.helper._throttle(stream))
+        except asyncio.CancelledError:
+            _remove(partial_path)
+            _remove(partial_path + JOURNAL_SUFFIX)
+            raise
+        os.replace(partial_path, file_path)
+        return file_path
+
+    @staticmethod
+    async def _run_ffmpeg(command, output_path, on_progress=None):
+        """
+        run ffmpeg as an asyncio subprocess. if it fails or is cancelled, its partial output is removed
+
+        :param command: ffmpeg command
+        :type command: list[str]
+        :param output_path: path ffmpeg writes to
+        :type output_path: str
+        :param on_progress: callback(dict) receiving each block of ffmpeg -progress output
+        :type on_progress: callable or None
+        :return: None
+        :raise FfmpegError: if ffmpeg fails
+        """
+        existed = os.path.exists(output_path)
+        # no terminal to answer ffmpeg's prompts, ffmpeg refuses to overwrite an existing file instead
+        if on_progress is None:
+            process = await asyncio.create_subprocess_exec(*command, stdin=asyncio.subprocess.DEVNULL)
+        else:
+            process = await asyncio.create_subprocess_exec(*progress_command(command),
+                                                           stdin=asyncio.subprocess.DEVNULL,
+                                                           stdout=asyncio.subprocess.PIPE)
+        try:
+            if on_progress is not None:
+                reader = FfmpegProgressReader(on_progress)
+                async for line in process.stdout:
+                    reader.feed(line.decode('utf-8', 'replace'))
+            returncode = await process.wait()
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            if not existed:
+                _remove(output_path)
+            raise
+        if returncode != 0:
+            if not existed:
+                _remove(output_path)
+            raise FfmpegError('ffmpeg exited with code {}'.format(returncode))
+
+
+async def _gather_or_cancel(*aws):
+    """
+    like asyncio.gather, but the other awaitables are cancelled as soon as one fails
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _remove(path):
+    with contextlib.suppress(OSError):
+        os.remove(path)
@@ -0,0 +1,193 @@
+import threading
+import time
+
+# priority classes of transfers, lower goes first
+AUDIO = 0  # small audio only downloads
+NORMAL = 1
+BACKGROUND = 2  # large video streams, e.g. 4K
+PRIORITIES = (AUDIO, NORMAL, BACKGROUND)
+BACKGROUND_HEIGHT = 1440  # video streams above this resolution are BACKGROUND by default
+DEFAULT_BURST = 0.25  # seconds of traffic a bucket can save up
+MAX_WAIT = 0.05  # seconds a waiting transfer sleeps before checking again
+
+
+class TokenBucket:
+    def __init__(self, rate=None, burst=DEFAULT_BURST):
+        """
+        byte rate limit that allows short bursts, not thread safe
+
+        :param rate: bytes per second, unlimited if None
+        :type rate: int or float or None
+        :param burst: seconds of traffic that can be saved up while idle
+        :type burst: float
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    @property
+    def capacity(self):
+        return self.rate * self.burst if self.rate else 0
+
+    def refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate):
+        """
+        :param rate: bytes per second, unlimited if None
+        :type rate: int or float or None
+        """
+        self.refill()
+        self.rate = rate
+        self.tokens = min(self.tokens, self.capacity)
+
+    def delay(self, n):
+        """
+        seconds until n bytes may be sent, 0 if now. more than capacity only waits for a full bucket
+
+        :rtype: float
+        """
+        self.refill()
+        if not self.rate:
+            return 0
+        missing = min(n, self.capacity) - self.tokens
+        return missing / self.rate if missing > 0 else 0
+
+    def consume(self, n):
+        """
+        take n bytes from the bucket, it goes into debt for more than it holds
+        """
+        if self.rate:
+            self.tokens -= n
+
+
+class BandwidthScheduler:
+    def __init__(self, rate=None, job_rate=None, burst=DEFAULT_BURST):
+        """
+        byte rate limits shared by all downloads of the process: a global cap divided by priority, and a cap
+        per job. while a transfer of a higher priority class is waiting for the global cap, lower classes wait,
+        so small audio downloads are not slowed down by large background ones. when the higher
+        classes are idle or limited by their own caps, the lower ones get the rest of the bandwidth.
+        every limit can be changed while downloads are running
+
+        :param rate: global cap in bytes per second, unlimited if None
+        :type rate: int or float or None
+        :param job_rate: cap of each job in bytes per second, unlimited if None
+        :type job_rate: int or float or None
+        :param burst: seconds of traffic a bucket can save up while idle
+        :type burst: float
+        """
+        self.bucket = TokenBucket(rate, burst)
+        self.job_rate = job_rate
+        self.burst = burst
+        self.condition = threading.Condition()
+        self.waiting = [0] * len(PRIORITIES)  # transfers waiting for the global bucket, per priority
+
+    @property
+    def rate(self):
+        return self.bucket.rate
+
+    def set_rate(self, rate):
+        """
+        change the global cap
+
+        :param rate: bytes per second, unlimited if None
+        :type rate: int or float or None
+        """
+        with self.condition:
+            self.bucket.set_rate(rate)
+            self.condition.notify_all()
+
+    def set_job_rate(self, rate):
+        """
+        change the cap of every job without a cap of its own
+
+        :param rate: bytes per second, unlimited if None
+        :type rate: int or float or None
+        """
+        self.job_rate = rate
+
+    def job(self, priority=NORMAL, rate=None):
+        """
+        a transfer under these limits, e.g. one stream download
+
+        :param priority: one of PRIORITIES
+        :type priority: int
+        :param rate: cap of this job in bytes per second, the scheduler's job_rate if None
+        :type rate: int or float or None
+        :rtype: TransferJob
+        """
+        if priority not in PRIORITIES:
+            raise ValueError("priority should be one of {}".format(PRIORITIES))
+        return TransferJob(self, priority, rate)
+
+    def acquire(self, n, priority=NORMAL):
+        """
+        block until n bytes may be sent under the global cap
+
+        :param n: number of bytes
+        :type n: int
+        :param priority: one of PRIORITIES
+        :type priority: int
+        """
+        if self.bucket.rate is None:
+            return
+        with self.condition:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    if any(self.waiting[:priority]):
+                        # a higher class is waiting, it is woken up with everyone once it is served
+                        self.condition.wait(MAX_WAIT)
+                        continue
+                    delay = self.bucket.delay(n)
+                    if delay <= 0:
+                        self.bucket.consume(n)
+                        return
+                    self.condition.wait(min(delay, MAX_WAIT))
+            finally:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+
+
+class TransferJob:
+    def __init__(self, scheduler, priority, rate=None):
+        """
+        one transfer under the limits of a BandwidthScheduler, see BandwidthScheduler.job.
+        all connections of the transfer share its cap
+        """
+        self.scheduler = scheduler
+        self.priority = priority
+        self.rate = rate
+        self.bucket = TokenBucket(None, scheduler.burst)
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        """
+        change the cap of this job
+
+        :param rate: bytes per second, the scheduler's job_rate if None
+        :type rate: int or float or None
+        """
+        self.rate = rate
+
+    def throttle(self, n):
+        """
+        block until n more bytes may be sent, called by the downloaders after each chunk
+
+        :param n: number of bytes just read
+        :type n: int
+        """
+        rate = self.rate if self.rate is not None else self.scheduler.job_rate
+        with self.lock:
+            if rate != self.bucket.rate:
+                self.bucket.set_rate(rate)
+            delay = self.bucket.delay(n)
+            self.bucket.consume(n)
+        if delay > 0:
+            time.sleep(delay)
+        self.scheduler.acquire(n, self.priority)
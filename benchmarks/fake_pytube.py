@@ -0,0 +1,167 @@
+import os
+import subprocess
+import time
+
+from pytube import StreamQuery, extract
+
+from benchmarks.server import SyntheticFile, synthetic_url_suffix
+
+VIDEO_ID = 'bEnChMaRk00'
+VIDEO_URL = 'https://www.youtube.com/watch?v=' + VIDEO_ID
+
+
+class FakeStream:
+    def __init__(self, itag, url, mime_type, codecs, abr=None, resolution=None, fps=None, bitrate=None,
+                 filesize=None, is_otf=False):
+        """
+        the attributes of pytube.Stream that the helper reads
+        """
+        self.itag = itag
+        self.url = url
+        self.mime_type = mime_type
+        self.type, self.subtype = mime_type.split('/')
+        self.codecs = codecs
+        self.abr = abr
+        self.resolution = resolution
+        self.fps = fps
+        self.bitrate = bitrate
+        self._filesize = filesize
+        self.is_otf = is_otf
+        self.is_adaptive = bool(len(codecs) % 2)
+        self.is_progressive = not self.is_adaptive
+        self.includes_audio_track = self.is_progressive or self.type == 'audio'
+        self.includes_video_track = self.is_progressive or self.type == 'video'
+        self.video_codec = codecs[0] if self.includes_video_track else None
+        self.audio_codec = codecs[-1] if self.includes_audio_track else None
+
+
+class FakeYouTube:
+    def __init__(self, url, catalog=None, latency=0.0):
+        """
+        stand-in for pytube.YouTube serving one video from a catalog, every metadata round trip
+        (availability check, stream manifest) takes latency seconds
+
+        :param url: url of the video
+        :type url: str
+        :param catalog: metadata and streams of the video, see build_catalog
+        :type catalog: dict
+        :param latency: seconds per metadata round trip
+        :type latency: float
+        """
+        self.video_id = extract.video_id(url)
+        self.catalog = catalog
+        self.latency = latency
+        self.title = catalog['title']
+        self.author = catalog['author']
+        self.length = catalog['length']
+        self.description = catalog['description']
+        self.thumbnail_url = catalog['thumbnail_url']
+        self.publish_date = None
+
+    def check_availability(self):
+        time.sleep(self.latency)
+
+    @property
+    def streams(self):
+        time.sleep(self.latency)
+        return StreamQuery([FakeStream(**stream) for stream in self.catalog['streams']])
+
+    @property
+    def streaming_data(self):
+        # fetched with the streams, the generated media have no init and index ranges to report
+        return {'adaptiveFormats': []}
+
+
+def generate_media(ffmpeg, directory, duration, height=1080):
+    """
+    encode synthetic test pattern video and tone audio with ffmpeg, files are reused between runs
+
+    :param ffmpeg: path to ffmpeg
+    :type ffmpeg: str
+    :param directory: directory of the generated files
+    :type directory: str
+    :param duration: length in seconds
+    :type duration: int
+    :param height: height of the adaptive video
+    :type height: int
+    :return: paths of 'video' (fragmented h264 mp4), 'audio' (fragmented aac mp4) and 'progressive' (h264+aac mp4)
+    :rtype: dict
+    """
+    os.makedirs(directory, exist_ok=True)
+    width = height * 16 // 9
+    fragmented = ['-movflags', 'frag_keyframe+empty_moov+default_base_moof']
+    x264 = ['-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p']
+    outputs = {
+        'video': (['-f', 'lavfi', '-i', 'testsrc2=size={}x{}:rate=30:duration={}'.format(width, height, duration)]
+                  + x264 + fragmented),
+        'audio': (['-f', 'lavfi', '-i', 'sine=frequency=440:duration={}'.format(duration)]
+                  + ['-c:a', 'aac', '-b:a', '128k'] + fragmented),
+        'progressive': (['-f', 'lavfi', '-i', 'testsrc2=size=640x360:rate=30:duration={}'.format(duration),
+                         '-f', 'lavfi', '-i', 'sine=frequency=440:duration={}'.format(duration)]
+                        + x264 + ['-c:a', 'aac', '-movflags', '+faststart']),
+    }
+    paths = {}
+    for name, args in outputs.items():
+        paths[name] = os.path.join(directory, '{}_{}_{}.mp4'.format(name, height, duration))
+        if not os.path.exists(paths[name]):
+            subprocess.run([ffmpeg, '-v', 'error', '-y'] + args + [paths[name] + '.tmp.mp4'], check=True,
+                           stdin=subprocess.DEVNULL)
+            os.replace(paths[name] + '.tmp.mp4', paths[name])
+    return paths
+
+
+def build_catalog(server, media=None, progressive_size=64 * 1024 * 1024, thumbnails=None, length=60):
+    """
+    register the streams of a fake video on server
+
+    :param server: server of the streams
+    :type server: benchmarks.server.StreamServer
+    :param media: paths from generate_media, None if ffmpeg is not available. without it the streams
+                  are random bytes, which can be downloaded but not muxed or transcoded
+    :type media: dict or None
+    :param progressive_size: size of the random progressive 720p stream in bytes
+    :type progressive_size: int
+    :param thumbnails: JPEG content of each thumbnail variant, e.g. hqdefault, served in place of i.ytimg.com
+    :type thumbnails: dict or None
+    :param length: length of the video in seconds
+    :type length: int
+    :return: JSON serializable metadata and stream attributes for FakeYouTube, and thumbnail_pattern
+             to use as thumbnails.THUMBNAIL_URL
+    :rtype: dict
+    """
+    suffix = synthetic_url_suffix()
+
+    def add(name, data, mime_type):
+        return server.add(name, data, mime_type) + suffix, len(data)
+
+    def add_media(name, key, mime_type):
+        if media:
+            with open(media[key], 'rb') as f:
+                return add(name, f.read(), mime_type)
+        return add(name, SyntheticFile(16 * 1024 * 1024, seed=len(name)), mime_type)
+
+    streams = []
+    url, size = add('progressive720.mp4', SyntheticFile(progressive_size), 'video/mp4')
+    streams.append(dict(itag=22, url=url, mime_type='video/mp4', codecs=['avc1.64001F', 'mp4a.40.2'],
+                        resolution='720p', fps=30, bitrate=2000000, filesize=size))
+    url, size = add_media('progressive360.mp4', 'progressive', 'video/mp4')
+    streams.append(dict(itag=18, url=url, mime_type='video/mp4', codecs=['avc1.42001E', 'mp4a.40.2'],
+                        resolution='360p', fps=30, bitrate=500000, filesize=size))
+    url, size = add_media('dash1080.mp4', 'video', 'video/mp4')
+    streams.append(dict(itag=137, url=url, mime_type='video/mp4', codecs=['avc1.640028'], resolution='1080p',
+                        fps=30, bitrate=4000000, filesize=size))
+    url, size = add_media('dash_audio.m4a', 'audio', 'audio/mp4')
+    streams.append(dict(itag=140, url=url, mime_type='audio/mp4', codecs=['mp4a.40.2'], abr='128kbps',
+                        bitrate=128000, filesize=size))
+    for variant, data in (thumbnails or {}).items():
+        server.add('vi/{}/{}.jpg'.format(VIDEO_ID, variant), data, 'image/jpeg')
+    thumbnail_url = server.base_url + 'vi/{}/maxresdefault.jpg'.format(VIDEO_ID)
+    return {
+        'title': 'Benchmark video',
+        'author': 'benchmarks',
+        'length': length,
+        'description': 'synthetic streams served from a local server',
+        'thumbnail_url': thumbnail_url,
+        'thumbnail_pattern': server.base_url + 'vi/{}/{}.jpg',
+        'streams': streams,
+    }
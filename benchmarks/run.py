@@ -0,0 +1,321 @@
+"""
+offline benchmarks of the download pipeline. a local server stands in for YouTube's CDN and a fake
+pytube.YouTube serves the metadata, so runs are repeatable and need no network.
+
+every scenario runs in a fresh child process, which reports wall time, throughput, CPU time
+(including ffmpeg) and peak RSS per stage. results are compared with a stored baseline:
+
+    python -m benchmarks.run --save-baseline
+    ... change something ...
+    python -m benchmarks.run
+"""
+import argparse
+import io
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+SCENARIOS = ['metadata', 'progressive', 'get_video', 'auto_download', 'get_audio', 'gui_load']
+NEEDS_FFMPEG = {'get_video', 'auto_download', 'get_audio'}
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+NOISE_FLOOR = 0.05  # seconds, smaller slowdowns are not reported as regressions
+
+
+def usage():
+    """
+    CPU seconds of this process and its finished children (ffmpeg), and peak RSS of this process in MB
+    """
+    if resource is None:
+        return time.process_time(), None
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = own.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return cpu, rss
+
+
+class StageRecorder:
+    def __init__(self):
+        """
+        instrumentation sink turning stage events into per-stage measurements
+        """
+        self.started = {}
+        self.stages = []
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        if event['event'] not in ('stage_start', 'stage_end'):
+            return
+        name = event['stage'] + (':' + event['label'] if event.get('label') else '')
+        with self.lock:
+            if event['event'] == 'stage_start':
+                self.started[name] = usage()
+                return
+            cpu_start, _ = self.started.pop(name)
+            cpu, rss = usage()
+            self.stages.append({
+                'stage': name,
+                'wall': event['duration'],
+                'bytes': event.get('bytes', 0),
+                'throughput': event.get('throughput', 0),
+                # stages can overlap, CPU time is that of the whole process during the stage
+                'cpu': round(cpu - cpu_start, 4),
+                'peak_rss_mb': round(rss, 1) if rss is not None else None,
+            })
+
+
+def run_child(scenario, config_path, result_path):
+    """
+    run one scenario in this process and write its measurements to result_path
+    """
+    with open(config_path, encoding='utf-8') as f:
+        config = json.load(f)
+    # keep the metadata cache and ffmpeg probe of the benchmark away from the user's cache
+    os.environ['XDG_CACHE_HOME'] = os.environ['LOCALAPPDATA'] = config['cache_dir']
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    import functools
+    import helper
+    import thumbnails
+    from benchmarks.fake_pytube import FakeYouTube, VIDEO_URL
+    from stats import Instrumentation
+
+    helper.YouTube = functools.partial(FakeYouTube, catalog=config['catalog'], latency=config['latency'])
+    thumbnails.THUMBNAIL_URL = config['catalog']['thumbnail_pattern']
+    recorder = StageRecorder()
+    instrumentation = Instrumentation([recorder])
+    out = config['output_dir']
+    os.chdir(out)
+
+    def new_helper():
+        return helper.YouTubeHelper(VIDEO_URL, on_progress=lambda *args: None, connections=config['connections'],
+                                    cache=False, instrumentation=instrumentation)
+
+    cpu_start, _ = usage()
+    started = time.monotonic()
+    if scenario == 'metadata':
+        new_helper()
+    elif scenario == 'progressive':
+        new_helper().get_video('720p', myfolder=out)
+    elif scenario == 'get_video':
+        new_helper().get_video('1080p', myfolder=out, container='mp4')
+    elif scenario == 'auto_download':
+        new_helper().auto_download(myfolder=out)
+    elif scenario == 'get_audio':
+        new_helper().get_audio(myfolder=out, audio_format='mp3')
+    elif scenario == 'gui_load':
+        import gui
+        gui.YouTubeHelper = lambda url: new_helper()
+        with instrumentation.stage('gui_load'):
+            gui.load_video(VIDEO_URL, 480, threading.Event())
+    wall = time.monotonic() - started
+    cpu, rss = usage()
+    downloaded = sum(stage['bytes'] for stage in recorder.stages if stage['stage'].startswith('download'))
+    result = {
+        'scenario': scenario,
+        'wall': round(wall, 4),
+        'cpu': round(cpu - cpu_start, 4),
+        'peak_rss_mb': round(rss, 1) if rss is not None else None,
+        'bytes': downloaded,
+        'throughput': round(downloaded / wall) if wall else 0,
+        'stages': recorder.stages,
+    }
+    with open(result_path, 'w', encoding='utf-8') as f:
+        json.dump(result, f)
+
+
+def make_thumbnails():
+    """
+    JPEG of every thumbnail variant at its size, none without Pillow
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return {}
+    from thumbnails import THUMBNAIL_VARIANTS
+
+    thumbnails = {}
+    for variant, width, height in THUMBNAIL_VARIANTS:
+        buffer = io.BytesIO()
+        Image.effect_noise((width, height), 64).convert('RGB').save(buffer, 'JPEG')
+        thumbnails[variant] = buffer.getvalue()
+    return thumbnails
+
+
+def median_result(results):
+    """
+    median of repeated runs of a scenario, per stage as well
+    """
+    stages = {}
+    for result in results:
+        for stage in result['stages']:
+            stages.setdefault(stage['stage'], []).append(stage)
+    merged = {key: statistics.median(r[key] for r in results)
+              for key in ('wall', 'cpu', 'bytes', 'throughput')}
+    walls = sorted(r['wall'] for r in results)
+    # tail latency of the runs, it shows straggling connections that the median hides
+    merged['wall_p99'] = statistics.quantiles(walls, n=100, method='inclusive')[98] if len(walls) > 1 else walls[0]
+    merged['scenario'] = results[0]['scenario']
+    merged['peak_rss_mb'] = max((r['peak_rss_mb'] for r in results if r['peak_rss_mb'] is not None), default=None)
+    merged['stages'] = {name: {key: statistics.median(s[key] for s in runs)
+                               for key in ('wall', 'cpu', 'bytes', 'throughput')}
+                        for name, runs in stages.items()}
+    return merged
+
+
+def compare(results, baseline, tolerance):
+    """
+    regressions of results against baseline, one line each
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            continue
+        pairs = [(name, result['wall'], base['wall'])]
+        pairs += [('{}/{}'.format(name, stage), values['wall'], base['stages'][stage]['wall'])
+                  for stage, values in result['stages'].items() if stage in base['stages']]
+        for label, now, before in pairs:
+            if now > before * (1 + tolerance) and now - before > NOISE_FLOOR:
+                regressions.append('{}: {:.3f}s, baseline {:.3f}s (+{:.0%})'.format(label, now, before,
+                                                                                    now / before - 1))
+    return regressions
+
+
+def print_results(results):
+    row = '{:<28} {:>9} {:>9} {:>9} {:>12} {:>10}'
+    print(row.format('stage', 'wall s', 'p99 s', 'cpu s', 'MB/s', 'peak MB'))
+    for name, result in results.items():
+        print(row.format(name, '{:.3f}'.format(result['wall']), '{:.3f}'.format(result['wall_p99']),
+                         '{:.3f}'.format(result['cpu']), '{:.1f}'.format(result['throughput'] / 1e6),
+                         result['peak_rss_mb'] or '-'))
+        for stage, values in result['stages'].items():
+            print(row.format('  ' + stage, '{:.3f}'.format(values['wall']), '', '{:.3f}'.format(values['cpu']),
+                             '{:.1f}'.format(values['throughput'] / 1e6) if values['bytes'] else '', ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="offline benchmarks of the download pipeline")
+    parser.add_argument('--scenario', '-s', action='append', choices=SCENARIOS,
+                        help="scenario to run, can be repeated, default to be all")
+    parser.add_argument('--repeat', '-r', type=int, default=3, help="runs per scenario, the median is reported")
+    parser.add_argument('--size', type=int, default=64, help="size of the progressive stream in MB")
+    parser.add_argument('--duration', type=int, default=30, help="length of the generated media in seconds")
+    parser.add_argument('--height', type=int, default=1080, help="height of the generated adaptive video")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds before each server response and per metadata round trip")
+    parser.add_argument('--bandwidth', type=float, help="MB per second per connection, unlimited by default")
+    parser.add_argument('--connections', '-c', type=int, default=4, help="connections per stream")
+    parser.add_argument('--stall-rate', type=float, default=0.0,
+                        help="fraction of range responses that stall halfway through, e.g. 0.05")
+    parser.add_argument('--stall-seconds', type=float, default=10.0, help="how long a stalled response pauses")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="fraction of range responses whose connection drops halfway through")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="path of the baseline results")
+    parser.add_argument('--save-baseline', action='store_true', help="store the results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="slowdown against the baseline reported as a regression, default 0.2 (20%%)")
+    parser.add_argument('--json', metavar='FILE', help="also write the results to FILE")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--config', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_child(args.child, args.config, args.result)
+        return 0
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from benchmarks.fake_pytube import build_catalog, generate_media
+    from benchmarks.server import StreamServer
+    from cache import cache_dir
+    from media import ffmpeg_capabilities, FfmpegNotAvailableError
+
+    scenarios = args.scenario or SCENARIOS
+    try:
+        ffmpeg = ffmpeg_capabilities().path
+        print("[Generating media...]")
+        media = generate_media(ffmpeg, cache_dir('benchmarks'), args.duration, height=args.height)
+    except FfmpegNotAvailableError:
+        media = None
+        skipped = [name for name in scenarios if name in NEEDS_FFMPEG]
+        if skipped:
+            print("[ffmpeg not found, skipping {}]".format(', '.join(skipped)))
+        scenarios = [name for name in scenarios if name not in NEEDS_FFMPEG]
+
+    bandwidth = int(args.bandwidth * 1e6) if args.bandwidth else None
+    workdir = tempfile.mkdtemp(prefix='ytd-bench-')
+    results = {}
+    try:
+        with StreamServer(latency=args.latency, bandwidth=bandwidth, stall_rate=args.stall_rate,
+                          stall_seconds=args.stall_seconds, error_rate=args.error_rate) as server:
+            catalog = build_catalog(server, media=media, progressive_size=args.size * 1024 * 1024,
+                                    thumbnails=make_thumbnails(), length=args.duration)
+            for scenario in scenarios:
+                runs = []
+                for i in range(args.repeat):
+                    run_dir = os.path.join(workdir, '{}_{}'.format(scenario, i))
+                    config = {'catalog': catalog, 'latency': args.latency, 'connections': args.connections,
+                              'cache_dir': os.path.join(run_dir, 'cache'), 'output_dir': os.path.join(run_dir, 'out')}
+                    os.makedirs(config['cache_dir'])
+                    os.makedirs(config['output_dir'])
+                    config_path = os.path.join(run_dir, 'config.json')
+                    result_path = os.path.join(run_dir, 'result.json')
+                    with open(config_path, 'w', encoding='utf-8') as f:
+                        json.dump(config, f)
+                    child = subprocess.run([sys.executable, '-m', 'benchmarks.run', '--child', scenario,
+                                            '--config', config_path, '--result', result_path],
+                                           stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                           stderr=subprocess.PIPE, universal_newlines=True,
+                                           cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+                    if child.returncode != 0:
+                        print(child.stderr)
+                        raise RuntimeError("scenario {} failed".format(scenario))
+                    with open(result_path, encoding='utf-8') as f:
+                        runs.append(json.load(f))
+                    shutil.rmtree(run_dir, ignore_errors=True)
+                results[scenario] = median_result(runs)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(results)
+    report = {'config': {key: getattr(args, key) for key in
+                         ('size', 'duration', 'height', 'latency', 'bandwidth', 'connections', 'repeat',
+                          'stall_rate', 'stall_seconds', 'error_rate')},
+              'results': results}
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print("[Baseline saved to {}]".format(args.baseline))
+        return 0
+    if not os.path.exists(args.baseline):
+        print("[No baseline at {}, run with --save-baseline to store one]".format(args.baseline))
+        return 0
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    if baseline.get('config') != report['config']:
+        print("[Baseline was recorded with different settings: {}]".format(baseline.get('config')))
+    regressions = compare(results, baseline, args.tolerance)
+    for line in regressions:
+        print("[REGRESSION: {}]".format(line))
+    if not regressions:
+        print("[No regressions against baseline]")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
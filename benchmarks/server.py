@@ -0,0 +1,208 @@
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WRITE_CHUNK = 16384  # bytes written to a connection at a time, also the granularity of bandwidth caps
+
+
+class SyntheticFile:
+    def __init__(self, size, seed=0, block_size=1024 * 1024):
+        """
+        file of any size made of one random block repeated, so large streams need no memory or disk
+
+        :param size: size in bytes
+        :type size: int
+        :param seed: seed of the random block
+        :type seed: int
+        :param block_size: size of the repeated block
+        :type block_size: int
+        """
+        self.size = size
+        self.block = random.Random(seed).randbytes(block_size)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, item):
+        start, stop, _ = item.indices(self.size)
+        out = bytearray()
+        while start < stop:
+            offset = start % len(self.block)
+            piece = self.block[offset:offset + stop - start]
+            out += piece
+            start += len(piece)
+        return bytes(out)
+
+
+class StreamServer:
+    def __init__(self, latency=0.0, bandwidth=None, host='127.0.0.1', port=0, stall_rate=0.0, stall_seconds=10.0,
+                 error_rate=0.0, seed=0):
+        """
+        local stand-in for YouTube's CDN: serves registered files over HTTP with Range support.
+        range responses can be made flaky, like a congested CDN edge: some stall halfway through their body,
+        others drop the connection halfway through
+
+        :param latency: seconds before each response is sent
+        :type latency: float
+        :param bandwidth: bytes per second per connection, unlimited if None
+        :type bandwidth: int or None
+        :param host: address to listen on
+        :type host: str
+        :param port: port to listen on, any free port if 0
+        :type port: int
+        :param stall_rate: fraction of range responses that stall halfway through
+        :type stall_rate: float
+        :param stall_seconds: how long a stalled response sends nothing
+        :type stall_seconds: float
+        :param error_rate: fraction of range responses whose connection is dropped halfway through
+        :type error_rate: float
+        :param seed: seed choosing the flaky responses, so runs are repeatable
+        :type seed: int
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.files = {}
+        self.requests = 0
+        self.stalls = 0
+        self.errors = 0
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}/'.format(host, port)
+
+    def add(self, name, data, content_type='application/octet-stream'):
+        """
+        serve data under name
+
+        :param name: path of the file in urls
+        :type name: str
+        :param data: content, bytes or SyntheticFile
+        :type data: bytes or SyntheticFile
+        :param content_type: Content-Type header
+        :type content_type: str
+        :return: url of the file
+        :rtype: str
+        """
+        self.files[name] = (data, content_type)
+        return self.base_url + name
+
+    def add_file(self, name, path, content_type='application/octet-stream'):
+        """
+        serve the content of a local file under name
+
+        :return: url of the file
+        :rtype: str
+        """
+        with open(path, 'rb') as f:
+            return self.add(name, f.read(), content_type)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _handler(self):
+        owner = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_HEAD(self):
+                self.respond(body=False)
+
+            def do_GET(self):
+                self.respond(body=True)
+
+            def respond(self, body):
+                owner.requests += 1
+                name = self.path.lstrip('/').split('?')[0]
+                if name not in owner.files:
+                    self.send_error(404)
+                    return
+                data, content_type = owner.files[name]
+                start, end = 0, len(data) - 1
+                match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+                if match:
+                    start = int(match.group(1))
+                    end = min(int(match.group(2)), end) if match.group(2) else end
+                if owner.latency:
+                    time.sleep(owner.latency)
+                self.send_response(206 if match else 200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(end - start + 1))
+                self.send_header('Accept-Ranges', 'bytes')
+                if match:
+                    self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(data)))
+                self.end_headers()
+                if body:
+                    self.send_body(data, start, end, fault=self.choose_fault() if match else None)
+
+            def choose_fault(self):
+                with owner.lock:
+                    draw = owner.random.random()
+                    if draw < owner.error_rate:
+                        owner.errors += 1
+                        return 'error'
+                    if draw < owner.error_rate + owner.stall_rate:
+                        owner.stalls += 1
+                        return 'stall'
+                return None
+
+            def send_body(self, data, start, end, fault=None):
+                began = time.monotonic()
+                sent = 0
+                halfway = start + (end - start + 1) // 2
+                try:
+                    for offset in range(start, end + 1, WRITE_CHUNK):
+                        if fault and offset >= halfway:
+                            if fault == 'error':
+                                self.close_connection = True
+                                return
+                            time.sleep(owner.stall_seconds)
+                            began += owner.stall_seconds
+                            fault = None
+                        chunk = data[offset:min(offset + WRITE_CHUNK, end + 1)]
+                        self.wfile.write(chunk)
+                        sent += len(chunk)
+                        if owner.bandwidth:
+                            delay = sent / owner.bandwidth - (time.monotonic() - began)
+                            if delay > 0:
+                                time.sleep(delay)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client gave up, e.g. a cancelled download
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def synthetic_url_suffix(expire_in=6 * 3600):
+    """
+    query string of a signed url, so the metadata cache sees a plausible expiration
+
+    :rtype: str
+    """
+    return '?expire={}'.format(int(time.time()) + expire_in)
+
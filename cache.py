@@ -0,0 +1,329 @@
+import contextlib
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_METADATA_TTL = 6 * 3600  # seconds a metadata entry is kept at most
+URL_EXPIRY_MARGIN = 1800  # seconds, drop entries whose stream urls expire sooner than this
+DEFAULT_METADATA_MAX_BYTES = 64 * 1024 * 1024  # evict least recently used entries above this size
+DEFAULT_THUMBNAIL_ITEMS = 256  # thumbnails kept in memory
+DEFAULT_THUMBNAIL_MAX_BYTES = 64 * 1024 * 1024  # evict least recently used thumbnails on disk above this size
+ARCHIVE_FILE = 'archive.sqlite3'
+
+
+def cache_dir(*parts):
+    """
+    directory for persistent caches of this program, created if missing
+
+    :param parts: sub directories inside the cache directory
+    :type parts: str
+    :return: path to the directory
+    :rtype: str
+    """
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    path = os.path.join(base, 'youtube-downloader-4k', *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class MetadataCache:
+    def __init__(self, directory=None, ttl=DEFAULT_METADATA_TTL, max_bytes=DEFAULT_METADATA_MAX_BYTES):
+        """
+        on-disk cache of video metadata and stream descriptors, one JSON file per video id.
+        entries expire after ttl seconds or before the signed stream urls they hold stop working,
+        the least recently used entries are evicted once the cache grows beyond max_bytes
+
+        :param directory: directory of the cache, default to be metadata in cache_dir()
+        :type directory: str or path-like or None
+        :param ttl: maximum age of an entry in seconds
+        :type ttl: int or float
+        :param max_bytes: maximum total size of the cache in bytes
+        :type max_bytes: int
+        """
+        self.directory = directory if directory is not None else cache_dir('metadata')
+        os.makedirs(self.directory, exist_ok=True)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+    def _path(self, video_id):
+        return os.path.join(self.directory, video_id + '.json')
+
+    def get(self, video_id):
+        """
+        cached metadata of a video
+
+        :param video_id: YouTube video id
+        :type video_id: str
+        :return: metadata stored by put, None if not cached or expired
+        :rtype: dict or None
+        """
+        path = self._path(video_id)
+        try:
+            with open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get('expires', 0) < time.time():
+            self.delete(video_id)
+            return None
+        try:
+            os.utime(path)  # mark as recently used for eviction
+        except FileNotFoundError:
+            pass  # evicted by another process or thread since it was read
+        return entry['data']
+
+    def put(self, video_id, data, url_expiration=None):
+        """
+        store metadata of a video
+
+        :param video_id: YouTube video id
+        :type video_id: str
+        :param data: JSON serializable metadata
+        :type data: dict
+        :param url_expiration: unix time at which the earliest stream url in data expires
+        :type url_expiration: int or None
+        :return: None
+        """
+        expires = time.time() + self.ttl
+        if url_expiration is not None:
+            expires = min(expires, url_expiration - URL_EXPIRY_MARGIN)
+        if expires <= time.time():
+            return
+        write_atomic(self._path(video_id), json.dumps({'expires': expires, 'data': data}).encode('utf-8'))
+        self.evict()
+
+    def delete(self, video_id):
+        try:
+            os.remove(self._path(video_id))
+        except OSError:
+            pass
+
+    def evict(self):
+        """
+        remove least recently used entries until the cache is below max_bytes
+
+        :return: None
+        """
+        evict_lru(self.directory, '.json', self.max_bytes)
+
+
+class ThumbnailCache:
+    def __init__(self, max_items=DEFAULT_THUMBNAIL_ITEMS, directory=None, max_bytes=DEFAULT_THUMBNAIL_MAX_BYTES,
+                 disk=True):
+        """
+        least recently used cache of encoded thumbnails keyed by video id and thumbnail variant,
+        in memory and optionally on disk. safe to share between threads
+
+        :param max_items: maximum number of thumbnails kept in memory
+        :type max_items: int
+        :param directory: directory of the disk cache, default to be thumbnails in cache_dir()
+        :type directory: str or path-like or None
+        :param max_bytes: maximum total size of the disk cache in bytes
+        :type max_bytes: int
+        :param disk: keep thumbnails on disk as well
+        :type disk: bool
+        """
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.directory = None
+        if disk:
+            self.directory = directory if directory is not None else cache_dir('thumbnails')
+            os.makedirs(self.directory, exist_ok=True)
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _path(self, video_id, variant):
+        return os.path.join(self.directory, '{}_{}.jpg'.format(video_id, variant))
+
+    def get(self, video_id, variant):
+        """
+        cached thumbnail
+
+        :param video_id: YouTube video id
+        :type video_id: str
+        :param variant: thumbnail variant, e.g. hqdefault
+        :type variant: str
+        :return: encoded image, None if not cached
+        :rtype: bytes or None
+        """
+        key = (video_id, variant)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+        if self.directory is None:
+            return None
+        path = self._path(video_id, variant)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)  # mark as recently used for eviction
+        except OSError:
+            return None
+        self._remember(key, data)
+        return data
+
+    def put(self, video_id, variant, data):
+        """
+        store a thumbnail
+
+        :param video_id: YouTube video id
+        :type video_id: str
+        :param variant: thumbnail variant, e.g. hqdefault
+        :type variant: str
+        :param data: encoded image
+        :type data: bytes
+        :return: None
+        """
+        self._remember((video_id, variant), data)
+        if self.directory is None:
+            return
+        write_atomic(self._path(video_id, variant), data)
+        evict_lru(self.directory, '.jpg', self.max_bytes)
+
+    def _remember(self, key, data):
+        with self.lock:
+            self.memory[key] = data
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_items:
+                self.memory.popitem(last=False)
+
+
+class DownloadArchive:
+    def __init__(self, path=None):
+        """
+        persistent record of finished downloads, one row per video id and variant (quality and format),
+        so a re-run can skip videos before fetching their metadata. unlike the caches, entries never expire.
+        safe to share between threads
+
+        :param path: SQLite database file, default to be ARCHIVE_FILE in cache_dir()
+        :type path: str or path-like or None
+        """
+        self.path = path if path is not None else os.path.join(cache_dir(), ARCHIVE_FILE)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS downloads ('
+                                    'video_id TEXT NOT NULL, variant TEXT NOT NULL, path TEXT NOT NULL, '
+                                    'size INTEGER, finished REAL NOT NULL, PRIMARY KEY (video_id, variant))')
+
+    def get(self, video_id, variant, verify=False):
+        """
+        path of a finished download
+
+        :param video_id: YouTube video id
+        :type video_id: str
+        :param variant: quality and format of the download, e.g. video:1080p60:mp4
+        :type variant: str
+        :param verify: only count the download if its file still exists with the recorded size
+        :type verify: bool
+        :return: path to the downloaded file, None if not archived (or missing with verify)
+        :rtype: str or None
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT path, size FROM downloads WHERE video_id = ? AND variant = ?',
+                                          (video_id, variant)).fetchone()
+        if row is None:
+            return None
+        path, size = row
+        if verify:
+            try:
+                if os.path.getsize(path) != size:
+                    return None
+            except OSError:
+                return None
+        return path
+
+    def add(self, video_id, variant, path):
+        """
+        record a finished download
+
+        :param video_id: YouTube video id
+        :type video_id: str
+        :param variant: quality and format of the download, see get
+        :type variant: str
+        :param path: path to the downloaded file
+        :type path: str or path-like
+        """
+        path = os.path.abspath(path)
+        size = os.path.getsize(path) if os.path.isfile(path) else None
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?)',
+                                    (video_id, variant, path, size, time.time()))
+
+    def delete(self, video_id, variant=None):
+        """
+        forget the downloads of a video, only one variant if given
+        """
+        with self.lock, self.connection:
+            if variant is None:
+                self.connection.execute('DELETE FROM downloads WHERE video_id = ?', (video_id,))
+            else:
+                self.connection.execute('DELETE FROM downloads WHERE video_id = ? AND variant = ?',
+                                        (video_id, variant))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def write_atomic(path, data):
+    """
+    replace the file at path by data at once, readers see the old or the new file but never a part of it.
+    every writer has a temporary file of its own, so concurrent writers of the same path do not mix
+
+    :param path: path of the file
+    :type path: str or path-like
+    :param data: content of the file
+    :type data: bytes
+    :return: None
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or None, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
+def evict_lru(directory, suffix, max_bytes):
+    """
+    remove the least recently modified files ending with suffix until directory holds at most max_bytes of them
+
+    :param directory: directory of the cache
+    :type directory: str or path-like
+    :param suffix: suffix of cache files
+    :type suffix: str
+    :param max_bytes: maximum total size of the files in bytes
+    :type max_bytes: int
+    :return: None
+    """
+    entries = []
+    for name in os.listdir(directory):
+        if name.endswith(suffix):
+            try:
+                st = os.stat(os.path.join(directory, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            continue
+        total -= size
@@ -0,0 +1,382 @@
+import bisect
+import re
+import struct
+import urllib.request
+
+from transfer import REQUEST_HEADERS, DEFAULT_TIMEOUT
+from transport import default_transport
+
+PROBE_BLOCK = 65536  # bytes fetched at a time while looking for the index of a stream
+MAX_PROBE_BYTES = 4 * 1024 * 1024  # give up if the index is not within this many bytes of the start
+# EBML ids of the WebM elements needed to find the clusters of a time range
+EBML_HEADER = 0x1A45DFA3
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEK_ID = 0x53AB
+SEEK_POSITION = 0x53AC
+INFO = 0x1549A966
+TIMECODE_SCALE = 0x2AD7B1
+DURATION = 0x4489
+CUES = 0x1C53BB6B
+CUE_POINT = 0xBB
+CUE_TIME = 0xB3
+CUE_TRACK_POSITIONS = 0xB7
+CUE_CLUSTER_POSITION = 0xF1
+CLUSTER = 0x1F43B675
+VOID = 0xEC
+DEFAULT_TIMECODE_SCALE = 1000000  # nanoseconds per timecode unit
+
+
+class ClipError(Exception):
+    pass
+
+
+class SegmentIndex:
+    def __init__(self, init, references):
+        """
+        where the media of each time span of a fragmented stream is: the init segment holding the codec
+        setup, and one reference per fragment (MP4) or cluster (WebM), each starting with a keyframe
+
+        :param init: init segment, prepended to the fragments of a clip so that it can be decoded on its own
+        :type init: bytes
+        :param references: (start seconds, end seconds, first byte, last byte) in stream order
+        :type references: list[tuple[float, float, int, int]]
+        """
+        self.init = init
+        self.references = references
+        self.starts = [reference[0] for reference in references]
+
+    def byte_range(self, start, end):
+        """
+        bytes of the stream covering a time range, from the last keyframe before start
+
+        :param start: start of the range in seconds
+        :type start: float
+        :param end: end of the range in seconds
+        :type end: float
+        :return: (first byte, last byte, time of the first byte in seconds)
+        :rtype: tuple[int, int, float]
+        """
+        first = max(0, bisect.bisect_right(self.starts, start) - 1)
+        last = max(first, bisect.bisect_left(self.starts, end) - 1)
+        return self.references[first][2], self.references[last][3], self.references[first][0]
+
+
+class RangeReader:
+    def __init__(self, url, timeout=DEFAULT_TIMEOUT, prefetch=None, transport=None):
+        """
+        random access to the start of a remote file through range requests, fetched in blocks and kept
+
+        :param url: url of the file
+        :type url: str
+        :param timeout: timeout of each request in seconds
+        :type timeout: int or float
+        :param prefetch: number of bytes fetched by the first request, e.g. the init and index ranges
+        :type prefetch: int or None
+        :param transport: connections the requests are sent on, the transport shared by the process if None
+        :type transport: transport.Transport or None
+        """
+        self.url = url
+        self.timeout = timeout
+        self.transport = transport if transport is not None else default_transport()
+        self.data = bytearray()
+        self.complete = False  # the whole file is in data
+        if prefetch:
+            self._fetch(prefetch)
+
+    def read(self, offset, n):
+        """
+        :return: n bytes at offset, fewer at the end of the file
+        :rtype: bytes
+        :raise ClipError: if the bytes are beyond MAX_PROBE_BYTES from the start and not read on their own
+        """
+        if offset > len(self.data) + PROBE_BLOCK and not self.complete:
+            # far from the start, e.g. an index at the end of the file
+            return self._request(offset, n)
+        while offset + n > len(self.data) and not self.complete:
+            if offset + n > MAX_PROBE_BYTES:
+                raise ClipError('no index within the first {} bytes'.format(MAX_PROBE_BYTES))
+            self._fetch(max(offset + n - len(self.data), PROBE_BLOCK))
+        return bytes(self.data[offset:offset + n])
+
+    def _fetch(self, n):
+        chunk = self._request(len(self.data), n)
+        self.data += chunk
+        self.complete = len(chunk) < n
+
+    def _request(self, offset, n):
+        headers = dict(REQUEST_HEADERS, Range='bytes={}-{}'.format(offset, offset + n - 1))
+        with self.transport.open(urllib.request.Request(self.url, headers=headers), timeout=self.timeout) as r:
+            if r.status != 206:
+                raise ClipError('server does not support range requests')
+            return r.read()
+
+
+def load_segment_index(stream, timeout=DEFAULT_TIMEOUT, transport=None):
+    """
+    fetch and parse the index of an adaptive stream: the sidx box of fragmented MP4, the Cues of WebM.
+    with the init and index ranges from YouTube's metadata this is one request, otherwise the start of
+    the stream is probed block by block
+
+    :param stream: adaptive stream
+    :type stream: streams.StreamDescriptor
+    :param timeout: timeout of each request in seconds
+    :type timeout: int or float
+    :param transport: connections the requests are sent on, the transport shared by the process if None
+    :type transport: transport.Transport or None
+    :rtype: SegmentIndex
+    :raise ClipError: if the stream has no usable index, e.g. progressive or sequential (otf) streams
+    """
+    if not stream.is_adaptive or stream.is_otf:
+        raise ClipError('{} streams have no segment index'.format('otf' if stream.is_otf else 'progressive'))
+    if stream.subtype not in ('mp4', 'webm'):
+        raise ClipError('no segment index in {} streams'.format(stream.subtype))
+    index_end = stream.index_range[1] if stream.index_range else None
+    reader = RangeReader(stream.url, timeout, prefetch=index_end + 1 if index_end is not None else PROBE_BLOCK,
+                         transport=transport)
+    if stream.subtype == 'mp4':
+        return parse_mp4_index(reader, stream.filesize)
+    return parse_webm_index(reader, stream.filesize)
+
+
+def parse_mp4_index(reader, filesize):
+    """
+    index of a fragmented MP4 stream laid out as ftyp, moov, sidx, then moof/mdat pairs
+
+    :type reader: RangeReader
+    :param filesize: size of the stream in bytes
+    :type filesize: int
+    :rtype: SegmentIndex
+    """
+    offset = 0
+    while True:
+        header = reader.read(offset, 16)
+        if len(header) < 8:
+            raise ClipError('no sidx box in stream')
+        size, box_type = struct.unpack('>I4s', header[:8])
+        if size == 1:
+            size = struct.unpack('>Q', header[8:16])[0]
+        if box_type == b'sidx':
+            return SegmentIndex(reader.read(0, offset), parse_sidx(reader.read(offset, size), offset + size))
+        if box_type in (b'moof', b'mdat') or size < 8:
+            raise ClipError('no sidx box before the media of the stream')
+        offset += size
+
+
+def parse_sidx(box, anchor):
+    """
+    references of a sidx box
+
+    :param box: the whole box, header included
+    :type box: bytes
+    :param anchor: offset of the first byte after the box
+    :type anchor: int
+    :return: see SegmentIndex
+    :rtype: list[tuple[float, float, int, int]]
+    """
+    header = 12 if struct.unpack('>I', box[:4])[0] != 1 else 20
+    version = box[header - 4]
+    position = header + 4  # skip reference_ID
+    timescale = struct.unpack('>I', box[position:position + 4])[0]
+    position += 4
+    if version == 0:
+        earliest, first_offset = struct.unpack('>II', box[position:position + 8])
+        position += 8
+    else:
+        earliest, first_offset = struct.unpack('>QQ', box[position:position + 16])
+        position += 16
+    count = struct.unpack('>H', box[position + 2:position + 4])[0]
+    position += 4
+    references = []
+    time = earliest
+    offset = anchor + first_offset
+    for _ in range(count):
+        size, duration, _ = struct.unpack('>III', box[position:position + 12])
+        position += 12
+        if size >> 31:
+            raise ClipError('hierarchical sidx boxes are not supported')
+        references.append((time / timescale, (time + duration) / timescale, offset, offset + size - 1))
+        time += duration
+        offset += size
+    return references
+
+
+def parse_webm_index(reader, filesize):
+    """
+    index of a WebM stream from its Cues, found before the clusters as in YouTube's DASH streams or
+    through the SeekHead. the init segment, everything before the first cluster, is patched for clips:
+    the Segment gets an unknown size and the SeekHead and Cues become Void elements, so ffmpeg does not
+    look for elements at offsets that do not exist in a clip
+
+    :type reader: RangeReader
+    :param filesize: size of the stream in bytes
+    :type filesize: int
+    :rtype: SegmentIndex
+    """
+    element_id, size, offset = _read_element(reader, 0)
+    if element_id != EBML_HEADER:
+        raise ClipError('not a WebM stream')
+    segment_offset = offset + size
+    element_id, segment_size, segment_start = _read_element(reader, segment_offset)
+    if element_id != SEGMENT:
+        raise ClipError('no Segment element in stream')
+    segment_end = min(filesize, segment_start + segment_size) if segment_size is not None else filesize
+    timecode_scale = DEFAULT_TIMECODE_SCALE
+    duration = None
+    cues = None
+    cues_position = None
+    voids = []  # (start, end) of the elements replaced by Void elements in the init segment
+    position = segment_start
+    while position < segment_end:
+        element_id, size, data_start = _read_element(reader, position)
+        if element_id == CLUSTER:
+            break
+        if size is None:
+            raise ClipError('element of unknown size before the first cluster')
+        if element_id == SEEK_HEAD:
+            voids.append((position, data_start + size))
+            for seek_id, seek in _children(reader.read(data_start, size)):
+                entry = dict(_children(seek)) if seek_id == SEEK else {}
+                if entry.get(SEEK_ID) == CUES.to_bytes(4, 'big') and SEEK_POSITION in entry:
+                    cues_position = segment_start + int.from_bytes(entry[SEEK_POSITION], 'big')
+        elif element_id == INFO:
+            for child_id, data in _children(reader.read(data_start, size)):
+                if child_id == TIMECODE_SCALE:
+                    timecode_scale = int.from_bytes(data, 'big')
+                elif child_id == DURATION:
+                    duration = struct.unpack('>f' if len(data) == 4 else '>d', data)[0]
+        elif element_id == CUES:
+            cues = reader.read(data_start, size)
+            voids.append((position, data_start + size))
+        position = data_start + size
+    init_end = position
+    clusters_end = segment_end
+    if cues is None and cues_position is not None and cues_position > init_end:
+        element_id, size, data_start = _read_element(reader, cues_position)
+        if element_id == CUES and size is not None:
+            cues = reader.read(data_start, size)
+            clusters_end = cues_position
+    if cues is None:
+        raise ClipError('no Cues in stream')
+    scale = timecode_scale / 1e9
+    points = []
+    for cue_id, cue in _children(cues):
+        if cue_id != CUE_POINT:
+            continue
+        time = cluster = None
+        for child_id, data in _children(cue):
+            if child_id == CUE_TIME:
+                time = int.from_bytes(data, 'big')
+            elif child_id == CUE_TRACK_POSITIONS and cluster is None:
+                for position_id, value in _children(data):
+                    if position_id == CUE_CLUSTER_POSITION:
+                        cluster = int.from_bytes(value, 'big')
+        if time is not None and cluster is not None:
+            points.append((time * scale, segment_start + cluster))
+    points.sort()
+    if not points:
+        raise ClipError('empty Cues in stream')
+    end_time = duration * scale if duration else points[-1][0]
+    references = [(time, points[i + 1][0] if i + 1 < len(points) else end_time, first,
+                   (points[i + 1][1] if i + 1 < len(points) else clusters_end) - 1)
+                  for i, (time, first) in enumerate(points)]
+    init = bytearray(reader.read(0, init_end))
+    # the Segment keeps the width of its size field, all ones means unknown size
+    width = segment_start - segment_offset - 4
+    init[segment_offset + 4:segment_start] = bytes([0xFF >> (width - 1)] + [0xFF] * (width - 1))
+    for start, end in voids:
+        if end - start >= 9:
+            init[start:end] = bytes([VOID, 0x01]) + (end - start - 9).to_bytes(7, 'big') + bytes(end - start - 9)
+    return SegmentIndex(bytes(init), references)
+
+
+def parse_timestamp(text):
+    """
+    seconds of a time in the video, e.g. 90, 1:30 or 1:02:03.5
+
+    :type text: str
+    :rtype: float
+    :raise ValueError: if text is not a time
+    """
+    match = re.fullmatch(r'(?:(?:(\d+):)?(\d+):)?(\d+(?:\.\d*)?)', text.strip())
+    if not match:
+        raise ValueError("time should be in form of seconds, minutes:seconds or hours:minutes:seconds")
+    hours, minutes, seconds = match.groups()
+    return int(hours or 0) * 3600 + int(minutes or 0) * 60 + float(seconds)
+
+
+def clip_label(start, end):
+    """
+    time range of a clip for file names, e.g. 1m30s-1m45_5s for 90 to 105.5 seconds
+
+    :param start: start of the clip in seconds
+    :type start: float
+    :param end: end of the clip in seconds
+    :type end: float
+    :rtype: str
+    """
+    return '{}-{}'.format(time_label(start), time_label(end))
+
+
+def time_label(seconds):
+    """
+    time in the video for file names, e.g. 1m45_5s for 105.5 seconds
+
+    :type seconds: float
+    :rtype: str
+    """
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    # file names cannot keep the decimal point, see pytube.helpers.safe_filename
+    label = '{:g}s'.format(round(seconds, 3)).replace('.', '_')
+    if hours or minutes:
+        label = '{}m{}'.format(int(minutes), label)
+    if hours:
+        label = '{}h{}'.format(int(hours), label)
+    return label
+
+
+def _read_vint(data, position, keep_marker=False):
+    """
+    EBML variable size integer at position, (value, length). the value is None for an unknown size
+    """
+    first = data[position]
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8:
+        raise ClipError('invalid EBML integer')
+    value = first if keep_marker else first & (0xFF >> length)
+    for byte in data[position + 1:position + length]:
+        value = (value << 8) | byte
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        value = None
+    return value, length
+
+
+def _read_element(reader, offset):
+    """
+    header of the EBML element at offset: (id, size or None if unknown, offset of its data)
+    """
+    header = reader.read(offset, 12)
+    if not header:
+        raise ClipError('unexpected end of stream')
+    element_id, id_length = _read_vint(header, 0, keep_marker=True)
+    size, size_length = _read_vint(header, id_length)
+    return element_id, size, offset + id_length + size_length
+
+
+def _children(data):
+    """
+    (id, data) of the elements in the data of a master element
+    """
+    position = 0
+    while position < len(data):
+        element_id, id_length = _read_vint(data, position, keep_marker=True)
+        size, size_length = _read_vint(data, position + id_length)
+        start = position + id_length + size_length
+        if size is None:
+            size = len(data) - start
+        yield element_id, data[start:start + size]
+        position = start + size
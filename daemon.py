@@ -0,0 +1,444 @@
+import argparse
+import hmac
+import itertools
+import json
+import os
+import secrets
+import shlex
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import runme
+from bandwidth import BandwidthScheduler
+from cache import DownloadArchive, cache_dir, write_atomic
+from helper import StageLimits
+from stats import Instrumentation, JsonLinesSink
+from transcode import TranscodeScheduler
+from transport import Transport, default_transport, set_default_transport, DEFAULT_MAX_PER_HOST, DEFAULT_CHUNK_SIZE
+
+DEFAULT_ADDRESS = '127.0.0.1:8765'
+DEFAULT_KEEP_JOBS = 100  # finished jobs kept for GET /jobs, the oldest ones are forgotten
+MAX_JOB_EVENTS = 10000  # events kept per job, a client streaming them later misses the oldest ones
+TOKEN_HEADER = 'X-Daemon-Token'
+# runme.py options the daemon sets once for every job, destination -> option
+DAEMON_OPTIONS = {'jobs': '--jobs', 'mux_jobs': '--mux-jobs', 'limit_rate': '--limit-rate',
+                  'job_limit_rate': '--job-limit-rate', 'archive': '--archive',
+                  'host_connections': '--host-connections', 'chunk_size': '--chunk-size', 'stats': '--stats'}
+_UNSET = object()
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Job:
+    def __init__(self, job_id, argv, instrumentation):
+        """
+        one submitted runme.py command line, its status and the events of its videos
+
+        :param job_id: id of the job
+        :type job_id: int
+        :param argv: runme.py arguments
+        :type argv: list[str]
+        :param instrumentation: instrumentation of the daemon, the job's events are recorded on top of it
+        :type instrumentation: stats.Instrumentation
+        """
+        self.id = job_id
+        self.argv = argv
+        self.status = QUEUED
+        self.urls = []
+        self.failures = []  # (url, error message)
+        self.pending = 0  # videos and conversions not finished yet
+        self.events = deque(maxlen=MAX_JOB_EVENTS)
+        self.recorded = 0  # events recorded so far, including the ones dropped from events
+        self.condition = threading.Condition()
+        self.instrumentation = Instrumentation(instrumentation.sinks + [self.record], job=job_id)
+
+    def record(self, event):
+        # the condition's lock is reentrant, finish_one records while holding it
+        with self.condition:
+            self.events.append(event)
+            self.recorded += 1
+            self.condition.notify_all()
+
+    def events_since(self, sent):
+        """
+        events recorded after the first sent ones, without the ones already dropped, call with the condition held
+
+        :param sent: number of events seen so far
+        :type sent: int
+        :return: the events and the number of events recorded so far
+        :rtype: tuple[list[dict], int]
+        """
+        dropped = self.recorded - len(self.events)
+        return list(itertools.islice(self.events, max(0, sent - dropped), None)), self.recorded
+
+    def finish_one(self, url=None, error=None):
+        """
+        mark a video or conversion as finished, the job is done when nothing is pending
+        """
+        with self.condition:
+            if error is not None:
+                self.failures.append((url, str(error)))
+            self.pending -= 1
+            ended = self.pending <= 0
+            if ended:
+                self.status = FAILED if self.failures else DONE
+            # recorded under the same lock, so event streams see job_end before the job is finished
+            self.record({'event': 'job_end' if ended else 'video_end', 'time': time.time(), 'job': self.id,
+                         'url': url, 'ok': error is None, 'error': str(error) if error is not None else None,
+                         'status': self.status})
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED)
+
+    def to_dict(self):
+        with self.condition:
+            return {'id': self.id, 'argv': self.argv, 'status': self.status, 'urls': self.urls,
+                    'failures': [{'url': url, 'error': error} for url, error in self.failures],
+                    'events': self.recorded}
+
+
+class Daemon:
+    def __init__(self, jobs=4, mux_jobs=None, limit_rate=None, job_limit_rate=None, archive=None, stats=None,
+                 keep_jobs=DEFAULT_KEEP_JOBS):
+        """
+        long running process executing runme.py command lines submitted over HTTP. the pytube import, ffmpeg
+        probe, metadata and thumbnail caches and the open connections stay warm between jobs, and the stage limits,
+        bandwidth limits, audio transcoder and download archive are shared by every job
+
+        :param jobs: number of videos downloading at the same time over all jobs
+        :type jobs: int
+        :param mux_jobs: number of ffmpeg processes running at the same time, default to be the number of CPUs
+        :type mux_jobs: int or None
+        :param limit_rate: total download rate in bytes per second, unlimited if None
+        :type limit_rate: int or None
+        :param job_limit_rate: download rate of each stream in bytes per second, unlimited if None
+        :type job_limit_rate: int or None
+        :param archive: download archive, None to download everything
+        :type archive: cache.DownloadArchive or None
+        :param stats: receives the events of every job as well
+        :type stats: stats.Instrumentation or None
+        :param keep_jobs: number of finished jobs kept, older finished jobs are forgotten as new ones come in
+        :type keep_jobs: int
+        """
+        mux_jobs = mux_jobs or os.cpu_count() or 1
+        self.mux_jobs = mux_jobs
+        self.limits = StageLimits(downloads=jobs, muxes=mux_jobs)
+        self.bandwidth = BandwidthScheduler(rate=limit_rate, job_rate=job_limit_rate)
+        self.transcoder = TranscodeScheduler(workers=mux_jobs)
+        self.archive = archive
+        self.instrumentation = stats if stats is not None else Instrumentation()
+        # enough workers to keep every download and mux slot busy, the stage limits do the actual bounding
+        self.executor = ThreadPoolExecutor(max_workers=jobs + mux_jobs)
+        self.jobs = {}  # id -> Job, in the order they were submitted
+        self.keep_jobs = keep_jobs
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        # only processes that can read the token file of the user may talk to the daemon, a web page cannot
+        self.token = secrets.token_urlsafe(32)
+
+    def submit(self, argv):
+        """
+        queue a runme.py command line, each of its videos runs as soon as a worker is free
+
+        :param argv: runme.py arguments, paths should be absolute
+        :type argv: list[str]
+        :return: the queued job
+        :rtype: Job
+        :raise ValueError: if the arguments are invalid or set options of the daemon, see DAEMON_OPTIONS
+        """
+        try:
+            # argparse leaves attributes already in the namespace alone, so the options given stand out
+            given = runme.parser.parse_args(argv, argparse.Namespace(**dict.fromkeys(DAEMON_OPTIONS, _UNSET)))
+            args = runme.parser.parse_args(argv)
+        except SystemExit:
+            raise ValueError("invalid arguments: {}".format(' '.join(map(shlex.quote, argv))))
+        rejected = [option for dest, option in DAEMON_OPTIONS.items() if getattr(given, dest) is not _UNSET]
+        if rejected:
+            raise ValueError("options of daemon.py that cannot be set per job: {}".format(', '.join(rejected)))
+        # segments of --parallel-transcode spread over the mux slots of the daemon
+        args.mux_jobs = self.mux_jobs
+        if not args.url and not args.url_file:
+            raise ValueError("no url given")
+        quality = runme.parse_quality(args.quality) if args.quality else None
+        if args.quality and quality is None:
+            raise ValueError("incorrect format of argument quality")
+        with self.lock:
+            job = Job(next(self.ids), argv, self.instrumentation)
+            self.jobs[job.id] = job
+            finished = [job_id for job_id, other in self.jobs.items() if other.finished]
+            for job_id in finished[:max(0, len(finished) - self.keep_jobs)]:
+                del self.jobs[job_id]
+        self.executor.submit(self._start, job, args, quality)
+        return job
+
+    def _start(self, job, args, quality):
+        try:
+            # playlists and channels need requests, expand them off the HTTP thread
+            urls = runme.expand_urls(args.url, args.url_file)
+            target_dir = runme.prepare_folder(args.folder) if args.folder else None
+        except Exception as e:
+            job.pending = 1
+            job.finish_one(error=e)
+            return
+        container = None if args.container == 'auto' else args.container
+        with job.condition:
+            job.urls = urls
+            job.pending = len(urls)
+            job.status = RUNNING
+        if not urls:
+            job.pending = 1
+            job.finish_one()
+        for url in urls:
+            self.executor.submit(self._run, job, url, args, quality, target_dir, container)
+
+    def _run(self, job, url, args, quality, target_dir, container):
+        try:
+            conversion = runme.process_url(url, args, quality, target_dir, container, self.limits,
+                                           label_progress=True, instrumentation=job.instrumentation,
+                                           transcoder=self.transcoder if args.audio and args.aformat else None,
+                                           bandwidth=self.bandwidth, archive=self.archive)
+        except Exception as e:
+            job.finish_one(url, e)
+            return
+        if conversion is None:
+            job.finish_one(url)
+        else:
+            conversion.add_done_callback(lambda future: job.finish_one(url, future.exception()))
+
+    def serve(self, address=DEFAULT_ADDRESS):
+        """
+        serve the JSON API until interrupted. every request needs the token of the daemon in the TOKEN_HEADER
+        header, the token is written to token_path(port) for clients of the same user while the daemon runs
+
+          POST /jobs              {"argv": [...]} queue a runme.py command line, returns the job
+          GET  /jobs              every job
+          GET  /jobs/ID           one job
+          GET  /jobs/ID/events    events of the job as JSON lines, streamed until the job is finished
+          GET  /transport         connection reuse statistics of the process, see transport.Transport.statistics
+
+        :param address: host:port to listen on
+        :type address: str
+        """
+        host, port = parse_address(address)
+        server = ThreadingHTTPServer((host, port), self._handler())
+        server.daemon_threads = True
+        token_file = token_path(server.server_address[1])
+        # a new temporary file is readable by its owner only
+        write_atomic(token_file, self.token.encode())
+        print("[Daemon listening on {}:{}]".format(*server.server_address[:2]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.executor.shutdown(wait=False)
+            try:
+                os.remove(token_file)
+            except OSError:
+                pass
+
+    def _handler(self):
+        daemon = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def authorized(self):
+                if hmac.compare_digest(self.headers.get(TOKEN_HEADER, '').encode(), daemon.token.encode()):
+                    return True
+                self.send_json(403, {'error': 'missing or wrong {} header, see {}'.format(
+                    TOKEN_HEADER, token_path(self.server.server_address[1]))})
+                return False
+
+            def do_POST(self):
+                if not self.authorized():
+                    return
+                if self.path.rstrip('/') != '/jobs':
+                    return self.send_json(404, {'error': 'not found'})
+                # a web page can only send a form or text/plain without a preflight request
+                if self.headers.get_content_type() != 'application/json':
+                    return self.send_json(415, {'error': 'content type should be application/json'})
+                try:
+                    body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                    job = daemon.submit([str(arg) for arg in body.get('argv', [])])
+                except (ValueError, AttributeError) as e:
+                    return self.send_json(400, {'error': str(e)})
+                self.send_json(202, job.to_dict())
+
+            def do_GET(self):
+                if not self.authorized():
+                    return
+                parts = self.path.strip('/').split('/')
+                if parts == ['transport']:
+                    return self.send_json(200, default_transport().statistics())
+                if parts == ['jobs']:
+                    with daemon.lock:
+                        jobs = list(daemon.jobs.values())
+                    return self.send_json(200, [job.to_dict() for job in jobs])
+                with daemon.lock:
+                    job = daemon.jobs.get(int(parts[1])) if len(parts) >= 2 and parts[1].isdigit() else None
+                if parts[0] != 'jobs' or job is None or len(parts) > 3 or parts[2:] not in ([], ['events']):
+                    return self.send_json(404, {'error': 'not found'})
+                if len(parts) == 2:
+                    return self.send_json(200, job.to_dict())
+                self.stream_events(job)
+
+            def stream_events(self, job):
+                # the response ends with the connection, so no length is needed
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.end_headers()
+                sent = 0
+                try:
+                    while True:
+                        with job.condition:
+                            while sent == job.recorded and not job.finished:
+                                job.condition.wait()
+                            events, sent = job.events_since(sent)
+                            finished = job.finished
+                        for event in events:
+                            self.wfile.write(json.dumps(event, default=str).encode() + b'\n')
+                        self.wfile.flush()
+                        if finished:
+                            # job_end is recorded under the lock that finishes the job, so it was the last event
+                            return
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client stopped watching, the job goes on
+
+            def send_json(self, status, data):
+                body = json.dumps(data, default=str).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def parse_address(address):
+    """
+    :param address: host:port, or only a port for localhost
+    :type address: str
+    :rtype: tuple[str, int]
+    """
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def token_path(port):
+    """
+    file holding the token of the daemon listening on port
+
+    :type port: int
+    :rtype: str
+    """
+    return os.path.join(cache_dir('daemon'), '{}.token'.format(port))
+
+
+def remote_argv(argv):
+    """
+    runme.py arguments as the daemon sees them: without --remote, and with paths made absolute, because the
+    daemon runs in a different working directory
+
+    :param argv: runme.py arguments
+    :type argv: list[str]
+    :rtype: list[str]
+    """
+    remote = argparse.ArgumentParser(add_help=False)
+    remote.add_argument('--remote', nargs='?')
+    argv = remote.parse_known_args(argv)[1]
+    paths = {'--folder', '-f', '--url-file', '-u'}
+    result = []
+    for i, arg in enumerate(argv):
+        if i and argv[i - 1] in paths:
+            arg = os.path.abspath(arg)
+        else:
+            for option in ('--folder=', '--url-file='):
+                if arg.startswith(option):
+                    arg = option + os.path.abspath(arg[len(option):])
+        result.append(arg)
+    return result
+
+
+def submit_remote(argv, address=DEFAULT_ADDRESS, out=None):
+    """
+    submit runme.py arguments to a running daemon and print its events until the job is finished
+
+    :param argv: runme.py arguments
+    :type argv: list[str]
+    :param address: host:port of the daemon
+    :type address: str
+    :param out: text stream for the events, default to be sys.stdout
+    :type out: io.TextIOBase or None
+    :return: the finished job as returned by GET /jobs/ID
+    :rtype: dict
+    :raise ValueError: if the daemon rejected the job or no daemon of this user listens on address
+    """
+    host, port = parse_address(address)
+    base = 'http://{}:{}'.format(host, port)
+    try:
+        with open(token_path(port), encoding='utf-8') as f:
+            token = f.read().strip()
+    except FileNotFoundError:
+        raise ValueError("no daemon running on port {}, start it with daemon.py".format(port))
+    request = urllib.request.Request(base + '/jobs', data=json.dumps({'argv': remote_argv(argv)}).encode(),
+                                     headers={'Content-Type': 'application/json', TOKEN_HEADER: token})
+    try:
+        with urllib.request.urlopen(request) as response:
+            job = json.load(response)
+    except urllib.error.HTTPError as e:
+        raise ValueError(json.load(e).get('error', str(e)))
+    sink = JsonLinesSink(out)
+    # the event stream has no timeout, a long download may be silent for a while
+    request = urllib.request.Request('{}/jobs/{}/events'.format(base, job['id']), headers={TOKEN_HEADER: token})
+    with urllib.request.urlopen(request) as response:
+        for line in response:
+            sink(json.loads(line))
+    request = urllib.request.Request('{}/jobs/{}'.format(base, job['id']), headers={TOKEN_HEADER: token})
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)
+
+
+parser = argparse.ArgumentParser(description="run downloads submitted with runme.py --remote in one warm process")
+parser.add_argument('--address', default=DEFAULT_ADDRESS, help="host:port to listen on (default %(default)s)")
+parser.add_argument('--jobs', '-j', type=int, default=4, help="number of videos downloading at the same time")
+parser.add_argument('--mux-jobs', type=int, default=os.cpu_count() or 1,
+                    help="number of ffmpeg mux/transcode processes running at the same time")
+parser.add_argument('--limit-rate', type=runme.parse_rate, metavar='RATE',
+                    help="total download rate in bytes per second e.g. 2M")
+parser.add_argument('--job-limit-rate', type=runme.parse_rate, metavar='RATE',
+                    help="download rate of each stream in bytes per second e.g. 500K")
+parser.add_argument('--archive', nargs='?', const='', metavar='FILE',
+                    help="skip videos already downloaded with the same quality and format, see runme.py")
+parser.add_argument('--host-connections', type=int, default=DEFAULT_MAX_PER_HOST, metavar='N',
+                    help="connections open to one host at a time over all jobs (default %(default)s)")
+parser.add_argument('--chunk-size', type=runme.parse_size, default=DEFAULT_CHUNK_SIZE, metavar='SIZE',
+                    help="bytes read from a connection at a time e.g. 256K (default 64K)")
+parser.add_argument('--stats', metavar='FILE',
+                    help="append the events of every job to FILE as JSON lines, - for stdout")
+parser.add_argument('--keep-jobs', type=int, default=DEFAULT_KEEP_JOBS, metavar='N',
+                    help="finished jobs kept for GET /jobs (default %(default)s)")
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    instrumentation = Instrumentation()
+    if args.stats:
+        stats_file = sys.stdout if args.stats == '-' else open(args.stats, 'a', encoding='utf-8')
+        instrumentation.add_sink(JsonLinesSink(stats_file))
+    # connections stay open between jobs, like the caches
+    set_default_transport(Transport(max_per_host=args.host_connections, chunk_size=args.chunk_size))
+    Daemon(jobs=args.jobs, mux_jobs=args.mux_jobs, limit_rate=args.limit_rate, job_limit_rate=args.job_limit_rate,
+           archive=DownloadArchive(args.archive or None) if args.archive is not None else None,
+           stats=instrumentation, keep_jobs=args.keep_jobs).serve(args.address)
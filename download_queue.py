@@ -0,0 +1,310 @@
+import itertools
+import threading
+
+from helper import YouTubeHelper, StageLimits
+from stats import Instrumentation
+from transfer import DownloadCancelledError, DEFAULT_CONNECTIONS
+
+DEFAULT_WORKERS = 3  # videos downloading at the same time
+VIDEO = 'video'
+AUDIO = 'audio'
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class DownloadJob:
+    def __init__(self, url, video_id=None, title=None, mode=VIDEO, quality=None, audio_format=None, folder=None):
+        """
+        one download of a DownloadQueue, its status and progress. each run creates a helper of its own,
+        so jobs never share the state of a helper
+
+        :param url: url of the video
+        :type url: str
+        :param video_id: id of the video, jobs of the same video run one after another
+        :type video_id: str or None
+        :param title: title of the video, jobs of the same title run one after another as they write the same files
+        :type title: str or None
+        :param mode: VIDEO or AUDIO
+        :type mode: str
+        :param quality: quality label such as 1080p60 for video, bit rate for audio, the best quality if None
+        :type quality: str or int or None
+        :param audio_format: audio format without dot, e.g. mp3, the format of the stream if None
+        :type audio_format: str or None
+        :param folder: directory of the downloaded files
+        :type folder: str or None
+        """
+        self.id = None  # set by DownloadQueue.submit
+        self.url = url
+        self.video_id = video_id
+        self.title = title
+        self.mode = mode
+        self.quality = quality
+        self.audio_format = audio_format
+        self.folder = folder
+        self.status = QUEUED
+        self.error = None
+        self.outputs = []
+        self.stage = None  # stage running, e.g. download or mux
+        self.transfers = {}  # label -> [bytes done, total, throughput]
+        self.helper = None
+        self.cancel_event = threading.Event()
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        quality = self.quality if self.quality is not None else 'best'
+        if self.mode == AUDIO:
+            quality = '{} {}'.format(quality, self.audio_format or '')
+        return '{} ({} {})'.format(self.title or self.url, self.mode, str(quality).strip())
+
+    @property
+    def progress(self):
+        """
+        fraction of the bytes downloaded, None until the size of every running download is known
+
+        :rtype: float or None
+        """
+        with self.lock:
+            transfers = list(self.transfers.values())
+        if not transfers or any(total is None for _, total, _ in transfers):
+            return None
+        total = sum(total for _, total, _ in transfers)
+        return sum(done for done, _, _ in transfers) / total if total else None
+
+    @property
+    def throughput(self):
+        """
+        bytes per second over all downloads of the job, over the last seconds
+
+        :rtype: int
+        """
+        with self.lock:
+            return sum(throughput for _, _, throughput in self.transfers.values())
+
+    def on_progress(self, label, bytes_done, total):
+        with self.lock:
+            self.transfers.setdefault(label, [0, None, 0])[:2] = [bytes_done, total]
+
+    def record(self, event):
+        """
+        sink of the helper's instrumentation, keeps the stage and the throughput of each download
+        """
+        with self.lock:
+            if event['event'] == 'stage_start':
+                self.stage = event['stage']
+            elif event['event'] == 'progress' and 'label' in event:
+                self.transfers.setdefault(event['label'], [0, None, 0])[2] = event['throughput']
+            elif event['event'] == 'stage_end' and 'label' in event:
+                self.transfers.setdefault(event['label'], [0, None, 0])[2] = 0
+
+    def run(self, limits=None, connections=DEFAULT_CONNECTIONS, bandwidth=None, priority=None):
+        """
+        download the video or audio, called by the workers of DownloadQueue
+
+        :param limits: limits on concurrent downloads and ffmpeg processes shared with other jobs
+        :type limits: StageLimits or None
+        :param connections: number of parallel connections used to download one stream
+        :type connections: int
+        :param bandwidth: rate limits shared with other jobs, unlimited if None
+        :type bandwidth: bandwidth.BandwidthScheduler or None
+        :param priority: priority class of the downloads under bandwidth, see YouTubeHelper
+        :type priority: int or None
+        :raise DownloadCancelledError: if the job was cancelled
+        """
+        if self.cancel_event.is_set():
+            raise DownloadCancelledError('{} cancelled'.format(self))
+        helper = YouTubeHelper(self.url, on_progress=self.on_progress, connections=connections, limits=limits,
+                               instrumentation=Instrumentation([self.record]), bandwidth=bandwidth,
+                               priority=priority)
+        with self.lock:
+            self.helper = helper
+            if self.cancel_event.is_set():
+                helper.cancel()
+        try:
+            if self.mode == AUDIO:
+                helper.get_audio(self.folder, quality=self.quality, audio_format=self.audio_format)
+            elif self.quality:
+                helper.get_video(self.quality, myfolder=self.folder)
+            else:
+                helper.auto_download(myfolder=self.folder)
+        finally:
+            self.outputs = list(helper.outputs)
+            with self.lock:
+                self.helper = None
+
+    def cancel(self):
+        """
+        stop the job, its downloads stop at their next chunk and a running ffmpeg process finishes first
+        """
+        with self.lock:
+            self.cancel_event.set()
+            if self.helper is not None:
+                self.helper.cancel()
+
+    def reset(self):
+        """
+        clear the status and progress so the job can run again
+        """
+        with self.lock:
+            self.status = QUEUED
+            self.error = None
+            self.outputs = []
+            self.stage = None
+            self.transfers = {}
+            self.cancel_event = threading.Event()
+
+
+class DownloadQueue:
+    def __init__(self, workers=DEFAULT_WORKERS, limits=None, connections=DEFAULT_CONNECTIONS, bandwidth=None,
+                 priority=None):
+        """
+        jobs downloaded by a pool of worker threads in the order they were submitted. jobs of the same video
+        or title never run at the same time, so their partial and output files cannot collide.
+        jobs can be cancelled and retried, and the number of workers changed while jobs are running
+
+        :param workers: number of jobs running at the same time
+        :type workers: int
+        :param limits: limits on concurrent downloads and ffmpeg processes shared by the jobs, e.g. with
+                       other queues, only the number of workers limits them if None
+        :type limits: StageLimits or None
+        :param connections: number of parallel connections used to download one stream
+        :type connections: int
+        :param bandwidth: rate limits shared by the jobs, e.g. with other queues, unlimited if None
+        :type bandwidth: bandwidth.BandwidthScheduler or None
+        :param priority: priority class of the jobs under bandwidth, by stream if None, see YouTubeHelper
+        :type priority: int or None
+        """
+        self.workers = workers
+        self.limits = limits if limits is not None else StageLimits()
+        self.connections = connections
+        self.bandwidth = bandwidth
+        self.priority = priority
+        self.jobs = []
+        self.ids = itertools.count(1)
+        self.threads = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def submit(self, job):
+        """
+        queue a job
+
+        :type job: DownloadJob
+        :rtype: DownloadJob
+        """
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('download queue is shut down')
+            job.id = next(self.ids)
+            self.jobs.append(job)
+            self._start_workers()
+            self.condition.notify()
+        return job
+
+    def cancel(self, job):
+        """
+        cancel a queued or running job
+        """
+        with self.condition:
+            if job.status == QUEUED:
+                job.status = CANCELLED
+            elif job.status == RUNNING:
+                job.cancel()
+
+    def retry(self, job):
+        """
+        queue a failed or cancelled job again, its partial downloads are resumed
+        """
+        with self.condition:
+            if job.status in (FAILED, CANCELLED):
+                job.reset()
+                self._start_workers()
+                self.condition.notify()
+
+    def remove_finished(self):
+        """
+        forget the jobs that are done, failed or cancelled
+
+        :return: the removed jobs
+        :rtype: list[DownloadJob]
+        """
+        with self.condition:
+            finished = [job for job in self.jobs if job.status in (DONE, FAILED, CANCELLED)]
+            self.jobs = [job for job in self.jobs if job not in finished]
+            return finished
+
+    def set_workers(self, workers):
+        """
+        change the number of jobs running at the same time, extra workers stop after their current job
+
+        :type workers: int
+        """
+        with self.condition:
+            self.workers = max(1, workers)
+            self._start_workers()
+            self.condition.notify_all()
+
+    @property
+    def active(self):
+        """
+        number of jobs queued or running
+
+        :rtype: int
+        """
+        with self.condition:
+            return sum(job.status in (QUEUED, RUNNING) for job in self.jobs)
+
+    def shutdown(self):
+        """
+        cancel every job and stop the workers, partial files are kept for the next run
+        """
+        with self.condition:
+            self.closed = True
+            for job in self.jobs:
+                self.cancel(job)
+            self.condition.notify_all()
+
+    def _start_workers(self):
+        while self.threads < self.workers:
+            self.threads += 1
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def _next_job(self):
+        running = [job for job in self.jobs if job.status == RUNNING]
+        for job in self.jobs:
+            if job.status == QUEUED and not any(self._conflict(job, other) for other in running):
+                return job
+        return None
+
+    @staticmethod
+    def _conflict(job, other):
+        return (job.video_id is not None and job.video_id == other.video_id) or \
+            (job.title is not None and job.title == other.title)
+
+    def _work(self):
+        while True:
+            with self.condition:
+                job = None
+                while not self.closed and self.threads <= self.workers:
+                    job = self._next_job()
+                    if job is not None:
+                        break
+                    self.condition.wait()
+                if job is None:
+                    self.threads -= 1
+                    return
+                job.status = RUNNING
+            try:
+                job.run(self.limits, self.connections, self.bandwidth, self.priority)
+                status, error = DONE, None
+            except DownloadCancelledError as e:
+                status, error = CANCELLED, e
+            except Exception as e:
+                status, error = (CANCELLED if job.cancel_event.is_set() else FAILED), e
+            with self.condition:
+                job.status = status
+                job.error = error
+                # a job of the same video may be runnable now
+                self.condition.notify_all()
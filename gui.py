@@ -1,12 +1,21 @@
 import tkinter as tk
-from tkinter import messagebox
-from PIL import ImageTk, Image
+from tkinter import messagebox, ttk
+from PIL import ImageTk
 import os.path
+import queue
 import threading
-from helper import YouTubeHelper, FfmpegNotAvailableError, FFMPEG_AVAILABLE
+from concurrent.futures import ThreadPoolExecutor
+from bandwidth import BandwidthScheduler
+from download_queue import DownloadQueue, DownloadJob, DEFAULT_WORKERS, AUDIO, QUEUED, RUNNING, DONE, FAILED, \
+    CANCELLED
+from helper import YouTubeHelper
+from media import ffmpeg_available
 
-
-# TODO: use multiple threads to download things in background
+LOADER_POLL_MS = 15  # how often finished loads are checked for, shorter than a frame at 60Hz
+DOWNLOADS_POLL_MS = 250  # how often the rows of running downloads are refreshed
+MAX_WORKERS = 8  # largest number of parallel downloads offered
+MAX_RATE_KB = 1000000  # largest total download rate offered, in KB/s
+RATE_STEP_KB = 100  # change of the download rate per click
 
 
 class DropDown(tk.OptionMenu):
@@ -91,6 +100,152 @@ class EntryWithPlaceholder(tk.Entry):
             self.put_placeholder()
 
 
+class DownloadRow(tk.Frame):
+    def __init__(self, parent, job, on_cancel, on_retry):
+        """
+        one job of the download queue: its name, a progress bar, its status and a cancel/retry button
+
+        :param parent: the tk parent frame
+        :param job: the job shown
+        :type job: DownloadJob
+        :param on_cancel: callback(job) of the cancel button
+        :param on_retry: callback(job) of the retry button
+        """
+        super().__init__(parent)
+        self.job = job
+        self.on_cancel = on_cancel
+        self.on_retry = on_retry
+        self.nameLabel = tk.Label(self, text=str(job), width=26, anchor='w')
+        self.nameLabel.grid(row=0, column=0)
+        self.progressBar = ttk.Progressbar(self, length=120, maximum=1.0)
+        self.progressBar.grid(row=0, column=1, padx=5)
+        self.statusLabel = tk.Label(self, width=16, anchor='w')
+        self.statusLabel.grid(row=0, column=2)
+        self.button = tk.Button(self, width=6, command=self.press)
+        self.button.grid(row=0, column=3)
+        self.refresh()
+
+    def press(self):
+        if self.job.status in (QUEUED, RUNNING):
+            self.on_cancel(self.job)
+        elif self.job.status in (FAILED, CANCELLED):
+            self.on_retry(self.job)
+        self.refresh()
+
+    def refresh(self):
+        job = self.job
+        progress = job.progress
+        if job.status == RUNNING:
+            if job.stage in ('download', 'stream_mux', 'stream_convert') and progress is not None:
+                status = '{:.0%} {}'.format(progress, readable_rate(job.throughput))
+            else:
+                status = job.stage or RUNNING
+        elif job.status == FAILED:
+            status = 'failed: {}'.format(job.error)
+        else:
+            status = job.status
+        self.statusLabel.config(text=status)
+        self.progressBar['value'] = 1.0 if job.status == DONE else progress or 0
+        if job.status in (QUEUED, RUNNING):
+            self.button.config(text='Cancel', state=tk.NORMAL)
+        elif job.status in (FAILED, CANCELLED):
+            self.button.config(text='Retry', state=tk.NORMAL)
+        else:
+            self.button.config(text='Done', state=tk.DISABLED)
+
+
+class DownloadList(tk.Frame):
+    def __init__(self, parent, download_queue, height=180):
+        """
+        scrollable list of the jobs of a download queue, refreshed on the Tk thread while jobs are active
+
+        :param parent: the tk parent frame
+        :param download_queue: the queue shown
+        :type download_queue: DownloadQueue
+        :param height: height of the list in pixels
+        """
+        super().__init__(parent)
+        self.queue = download_queue
+        self.rows = []
+        self.polling = False
+
+        # number of parallel downloads, total download rate and removal of finished rows
+        self.controlFrame = tk.Frame(self)
+        self.controlFrame.pack(fill='x')
+        tk.Label(self.controlFrame, text='parallel downloads:').pack(side='left')
+        self.workers = tk.IntVar(self, download_queue.workers)
+        self.workersBox = tk.Spinbox(self.controlFrame, from_=1, to=MAX_WORKERS, width=3, textvariable=self.workers,
+                                     command=lambda: self.queue.set_workers(self.workers.get()))
+        self.workersBox.pack(side='left')
+        if download_queue.bandwidth is not None:
+            tk.Label(self.controlFrame, text='limit KB/s (0 = none):').pack(side='left')
+            self.rate = tk.IntVar(self, (download_queue.bandwidth.rate or 0) // 1024)
+            self.rateBox = tk.Spinbox(self.controlFrame, from_=0, to=MAX_RATE_KB, increment=RATE_STEP_KB, width=6,
+                                      textvariable=self.rate, command=self.setRate)
+            self.rateBox.bind('<Return>', lambda event: self.setRate())
+            self.rateBox.bind('<FocusOut>', lambda event: self.setRate())
+            self.rateBox.pack(side='left')
+        self.clearButton = tk.Button(self.controlFrame, text='Clear finished', command=self.clearFinished)
+        self.clearButton.pack(side='right')
+
+        self.canvas = tk.Canvas(self, height=height, highlightthickness=0)
+        self.scrollbar = tk.Scrollbar(self, orient='vertical', command=self.canvas.yview)
+        self.canvas.configure(yscrollcommand=self.scrollbar.set)
+        self.scrollbar.pack(side='right', fill='y')
+        self.canvas.pack(side='left', fill='both', expand=True)
+        self.rowFrame = tk.Frame(self.canvas)
+        self.canvas.create_window((0, 0), window=self.rowFrame, anchor='nw')
+        self.rowFrame.bind('<Configure>', lambda event: self.canvas.configure(scrollregion=self.canvas.bbox('all')))
+
+    def add(self, job):
+        """
+        queue a job and show it
+
+        :type job: DownloadJob
+        """
+        self.queue.submit(job)
+        row = DownloadRow(self.rowFrame, job, self.queue.cancel, self.retry)
+        row.pack(fill='x')
+        self.rows.append(row)
+        self.startPolling()
+
+    def retry(self, job):
+        self.queue.retry(job)
+        self.startPolling()
+
+    def setRate(self):
+        """
+        apply the total download rate of the spinbox to running and queued downloads
+        """
+        try:
+            rate = self.rate.get()
+        except tk.TclError:
+            return  # not a number (yet)
+        self.queue.bandwidth.set_rate(rate * 1024 if rate > 0 else None)
+
+    def clearFinished(self):
+        finished = self.queue.remove_finished()
+        for row in [row for row in self.rows if row.job in finished]:
+            row.destroy()
+            self.rows.remove(row)
+
+    def startPolling(self):
+        if not self.polling:
+            self.polling = True
+            self.after(DOWNLOADS_POLL_MS, self.poll)
+
+    def poll(self):
+        """
+        refresh every row, runs on the Tk thread until no job is queued or running
+        """
+        for row in self.rows:
+            row.refresh()
+        if self.queue.active:
+            self.after(DOWNLOADS_POLL_MS, self.poll)
+        else:
+            self.polling = False
+
+
 # noinspection PyAttributeOutsideInit
 class App(tk.Frame):
     # TODO: add clear button of input bar (if possible)
@@ -101,10 +256,20 @@ class App(tk.Frame):
         self.url = None
         self.res_list = ['default']
         self.bitrate_list = ['default']
-        self.original_image = None  # original thumbnail image
+        self.original_image = None  # thumbnail image scaled to the window
         self.img = None  # image for tkinter
-
-        self.root.geometry('500x600')
+        # metadata and thumbnails are loaded in a worker thread, finished loads are queued for the Tk thread
+        self.loader = ThreadPoolExecutor(max_workers=2)  # a stale load cannot block the next one
+        self.loaded = queue.Queue()
+        self.load_id = 0  # id of the latest load, results of older loads are stale
+        self.load_cancel = None  # set to cancel the running load
+        self.pending_loads = 0  # loads whose results are not taken from the queue yet
+        # unlimited until a rate is set in the download list, each job's streams then get their default priority
+        self.bandwidth = BandwidthScheduler()
+        self.download_queue = DownloadQueue(workers=DEFAULT_WORKERS, bandwidth=self.bandwidth)
+
+        self.root.geometry('500x800')
+        self.root.protocol('WM_DELETE_WINDOW', self.close)
         tk.Frame.__init__(self, self.root)
 
         # input bar for getting video url
@@ -144,11 +309,15 @@ class App(tk.Frame):
         self.resolutionOptions = DropDown(self.settingFrame, ['default'])
         self.resolutionOptions.grid(row=0, column=1)
 
+        # queued downloads, below the video info
+        self.downloadList = DownloadList(self.root, self.download_queue)
+        self.downloadList.pack(side='bottom', fill='x', padx=5, pady=5)
+
         # frame at bottom for displaying thumbnail and video info
         self.bottomFrame = tk.Frame(self.root, padx=5, pady=5)
         self.bottomFrame.pack(padx=5, pady=5)
 
-        if not FFMPEG_AVAILABLE:
+        if not ffmpeg_available():
             messagebox.showwarning('ffmpeg not found in PATH, some functionality may not be available')
 
     def go(self):
@@ -159,82 +328,114 @@ class App(tk.Frame):
             # deactivate download button
             self.downloadButton.config(state=tk.DISABLED)
         elif url != self.url:
-            # update url and YouTube Helper
+            # update url and start loading the video in background, a previous load is cancelled
             self.url = url
-            try:
-                self.yt = YouTubeHelper(self.url)
-                self.res_list = ['default'] + self.yt.get_all_resolution()
-                self.bitrate_list = ['default'] + self.yt.get_all_audio_quality()
-                img_path = self.yt.get_thumbnail(myfolder='assets')
-                self.original_image = Image.open(img_path)
-                self.img = ImageTk.PhotoImage(self.original_image)
-                time_duration = self.yt.get_video_length()
-                title = self.yt.get_title()
-
-                # update options
-                if self.getDownloadMode() == 0:
-                    self.resolutionOptions.reset(self.res_list)
-                elif self.getDownloadMode() == 1:
-                    self.bitrateOptions.reset(self.bitrate_list)
-            except Exception as e:
-                messagebox.showerror(message=str(e))
-                return
-
-            # activate download button
-            self.downloadButton.config(state=tk.ACTIVE)
-
-            # update frame
+            self.load_id += 1
+            if self.load_cancel is not None:
+                self.load_cancel.set()
+            self.load_cancel = threading.Event()
+            self.downloadButton.config(state=tk.DISABLED)
+            self.showLoading()
+            width = max(self.root.winfo_width() - 20, 1)
+            future = self.loader.submit(load_video, url, width, self.load_cancel)
+            load_id = self.load_id
+            future.add_done_callback(lambda f: self.loaded.put((load_id, f)))
+            self.pending_loads += 1
+            if self.pending_loads == 1:
+                self.root.after(LOADER_POLL_MS, self.pollLoader)
+
+    def pollLoader(self):
+        """
+        show finished loads, runs on the Tk thread until no load is pending
+        """
+        try:
+            while True:
+                load_id, future = self.loaded.get_nowait()
+                self.pending_loads -= 1
+                if load_id == self.load_id:
+                    self.showVideo(future)
+        except queue.Empty:
+            pass
+        if self.pending_loads:
+            self.root.after(LOADER_POLL_MS, self.pollLoader)
+
+    def showLoading(self):
+        for wid in self.bottomFrame.winfo_children():
+            wid.destroy()
+        self.titleLabel = tk.Message(self.bottomFrame, text='loading...', width=490)
+        self.titleLabel.pack()
+
+    def showVideo(self, future):
+        """
+        show a loaded video
+
+        :param future: finished load_video call
+        :type future: concurrent.futures.Future
+        """
+        self.load_cancel = None
+        try:
+            video = future.result()
+        except Exception as e:
+            self.url = None  # allow trying the same url again
             for wid in self.bottomFrame.winfo_children():
                 wid.destroy()
+            messagebox.showerror(message=str(e))
+            return
+        self.yt = video['helper']
+        self.res_list = video['resolutions']
+        self.bitrate_list = video['bitrates']
+
+        # update options
+        if self.getDownloadMode() == 0:
+            self.resolutionOptions.reset(self.res_list)
+        elif self.getDownloadMode() == 1:
+            self.bitrateOptions.reset(self.bitrate_list)
+
+        # activate download button
+        self.downloadButton.config(state=tk.ACTIVE)
+
+        # update frame
+        for wid in self.bottomFrame.winfo_children():
+            wid.destroy()
 
-            # display title
-            self.titleLabel = tk.Message(self.bottomFrame, text=title, width=490)
-            self.titleLabel.pack()
+        # display title
+        self.titleLabel = tk.Message(self.bottomFrame, text=video['title'], width=490)
+        self.titleLabel.pack()
 
-            # display video length
-            self.durationLabel = tk.Label(self.bottomFrame, text=f'video length: {time_duration}')
-            self.durationLabel.pack(side='bottom')
+        # display video length
+        self.durationLabel = tk.Label(self.bottomFrame, text=f'video length: {video["length"]}')
+        self.durationLabel.pack(side='bottom')
 
-            # display video thumbnail
-            self.imageLabel = tk.Label(self.bottomFrame, image=self.img)
-            self.imageLabel.pack(fill='both', expand=True)  # fill the whole frame
-            self.bottomFrame.update()  # update the change to get actual size of frame
-            h, w = self.bottomFrame.winfo_height(), self.bottomFrame.winfo_width()  # get frame size
-            self.original_image = self.original_image.resize((w, h))  # resize image to fit the frame
-            self.img = ImageTk.PhotoImage(self.original_image)  # keep reference
-            self.imageLabel.config(image=self.img)  # change the image in label
+        # display video thumbnail, it is already decoded and scaled in the worker thread
+        self.original_image = video['thumbnail']
+        self.img = ImageTk.PhotoImage(self.original_image)  # keep reference
+        self.imageLabel = tk.Label(self.bottomFrame, image=self.img)
+        self.imageLabel.pack(fill='both', expand=True)  # fill the whole frame
 
-    # TODO: solve the race condition problem
     def download(self):
+        """
+        queue a download of the shown video with the chosen settings, it runs with a helper of its own
+        """
         if not self.yt or not self.url:
             messagebox.showerror(message='cannot download')
-        mode = self.getDownloadMode()
-        print('the download mode is', mode)
+            return
         download_path = os.path.normpath(os.path.expanduser('~/Downloads'))
-        try:
-            if mode == 0:
-                # download video
-                res = self.getResolution()
-                if res:
-                    i = res.find('p')
-                    fps = int(res[i + 1:]) if res[i + 1:] else None
-                    t = thread_with_messagebox(self.yt.get_video, 'download success', args=[res[:i + 1]],
-                                               kwargs={'myfolder': download_path, 'fps': fps})
-                else:
-                    t = thread_with_messagebox(self.yt.auto_download, 'download success',
-                                               kwargs={'myfolder': download_path})
-            elif mode == 1:
-                # download audio
-                bitrate = self.getBitRate()
-                if bitrate is not None:
-                    i = bitrate.find('kbps')
-                    bitrate = int(bitrate[:i])
-                audio_format = self.getFormat()
-                t = thread_with_messagebox(self.yt.get_audio, 'download success',
-                                           kwargs={'myfolder': download_path, 'quality': bitrate,
-                                                   'audio_format': audio_format})
-        except FfmpegNotAvailableError as e:
-            messagebox.showerror(message=e.message)
+        job = DownloadJob(self.url, video_id=self.yt.video_id, title=self.yt.title, folder=download_path)
+        if self.getDownloadMode() == 0:
+            # the dropdown lists quality labels such as 1080p60, get_video parses them
+            job.quality = self.getResolution()
+        else:
+            job.mode = AUDIO
+            bitrate = self.getBitRate()
+            if bitrate is not None:
+                job.quality = int(bitrate[:bitrate.find('kbps')])
+            job.audio_format = self.getFormat()
+        self.downloadList.add(job)
+
+    def close(self):
+        # partial downloads are kept, the next run resumes them
+        self.download_queue.shutdown()
+        self.root.destroy()
 
     def gotoVideoMode(self):
         # destroy all widgets
@@ -278,14 +479,46 @@ class App(tk.Frame):
         self.root.mainloop()
 
 
-def thread_with_messagebox(target, message, args=[], kwargs={}):
-    def run_target_with_messagebox(*args, **kwargs):
-        target(*args, **kwargs)
-        messagebox.showinfo(message=message)
-
-    t = threading.Thread(target=run_target_with_messagebox, args=args, kwargs=kwargs)
-    t.start()
-    return t
+def load_video(url, width, cancel_event):
+    """
+    look up a video and fetch, decode and scale its thumbnail to width, runs in a worker thread.
+    thumbnails are kept in memory, so going back to a video needs no network or disk access
+
+    :param url: url of the video
+    :type url: str
+    :param width: width of the thumbnail in pixels
+    :type width: int
+    :param cancel_event: skip the remaining steps once it is set
+    :type cancel_event: threading.Event
+    :return: helper, resolutions, bitrates, title, length and thumbnail of the video, None if cancelled
+    :rtype: dict or None
+    """
+    yt = YouTubeHelper(url)
+    video = {
+        'helper': yt,
+        'resolutions': ['default'] + yt.get_all_resolution(),
+        'bitrates': ['default'] + yt.get_all_audio_quality(),
+        'title': yt.get_title(),
+        'length': yt.get_video_length(),
+    }
+    if cancel_event.is_set():
+        return None
+    video['thumbnail'] = yt.get_thumbnail_image(width, width * 9 // 16)
+    return video
+
+
+def readable_rate(bytes_per_second):
+    """
+    :param bytes_per_second: download rate
+    :type bytes_per_second: int or float
+    :return: rate such as 2.5 MB/s
+    :rtype: str
+    """
+    for unit in ('B/s', 'KB/s', 'MB/s'):
+        if bytes_per_second < 1024:
+            return '{:.1f} {}'.format(bytes_per_second, unit)
+        bytes_per_second /= 1024
+    return '{:.1f} GB/s'.format(bytes_per_second)
 
 
 if __name__ == '__main__':
@@ -1,117 +1,668 @@
+import contextlib
+import datetime
+import functools
 import os
+import shutil
 import subprocess
+import threading
 import urllib.parse
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
 
 try:
-    from pytube import YouTube
-    from pytube.helpers import safe_filename
+    from pytube import YouTube, StreamQuery, request
+    from pytube.helpers import safe_filename, target_directory
 except ImportError:
     print('[ERROR: dependencies not installed]')
     print('[start installing dependencies by pip...]')
     subprocess.run(['pip', 'install', '-r', 'requirements.txt'])
 
-    from pytube import YouTube
-    from pytube.helpers import safe_filename
+    from pytube import YouTube, StreamQuery, request
+    from pytube.helpers import safe_filename, target_directory
+
+from bandwidth import AUDIO, NORMAL, BACKGROUND, BACKGROUND_HEIGHT
+from cache import MetadataCache
+from clips import load_segment_index, clip_label, ClipError
+from media import plan_mux, audio_convert_command, audio_convert_path, ffmpeg_capabilities, run_ffmpeg, popen_ffmpeg, \
+    can_stream_input, cut_command, FfmpegNotAvailableError, FfmpegError, AUDIO_FORMAT_CODECS, REMUX, TRANSCODE
+from stats import Instrumentation
+from streams import StreamDescriptor, StreamIndex, parse_quality_label, quality_label
+from thumbnails import default_thumbnail_cache, fetch_thumbnail, decode_thumbnail
+from transcode import segmented_transcode
+from transfer import SegmentedDownloader, DownloadCancelledError, DEFAULT_CONNECTIONS
+from transport import default_transport
+
+# a stream the requested audio format can hold without re-encoding is preferred over a better one
+# that needs transcoding, as long as its bit rate is at least this fraction of the best one
+COPY_MIN_BITRATE_RATIO = 0.75
+OUTPUT_KINDS = ('video', 'audio', 'thumbnail')  # kinds of files get_outputs produces
 
-try:
-    subprocess.run(['ffmpeg', '-version'], stdout=subprocess.DEVNULL)
-except FileNotFoundError:
-    FFMPEG_AVAILABLE = False
-else:
-    FFMPEG_AVAILABLE = True
 
+class StageLimits:
+    def __init__(self, downloads=None, muxes=None):
+        """
+        limits on how many network downloads and ffmpeg processes run at the same time,
+        shared between helpers downloading different videos
+
+        :param downloads: maximum number of concurrent downloads, unlimited if None
+        :type downloads: int or None
+        :param muxes: maximum number of concurrent ffmpeg mux/transcode processes, unlimited if None
+        :type muxes: int or None
+        """
+        self.download = threading.BoundedSemaphore(downloads) if downloads else contextlib.nullcontext()
+        self.mux = threading.BoundedSemaphore(muxes) if muxes else contextlib.nullcontext()
+
+
+class Output:
+    def __init__(self, kind, quality=None, audio_format=None, container='mp4'):
+        """
+        one file wanted from a video, see YouTubeHelper.get_outputs
+
+        :param kind: one of OUTPUT_KINDS
+        :type kind: str
+        :param quality: quality label such as 1080p60 for video, bit rate in kbps for audio, the best if None
+        :type quality: str or int or None
+        :param audio_format: format of audio without dot, e.g. mp3, the format of the stream if None
+        :type audio_format: str or None
+        :param container: container of video, see YouTubeHelper.get_video
+        :type container: str or None
+        """
+        if kind not in OUTPUT_KINDS:
+            raise ValueError("kind should be one of {}".format(OUTPUT_KINDS))
+        self.kind = kind
+        self.quality = quality
+        self.audio_format = audio_format[1:] if audio_format and audio_format[0] == '.' else audio_format
+        self.container = container
 
-class FfmpegNotAvailableError(Exception):
-    pass
+    def __repr__(self):
+        return '<Output {} quality={} audio_format={} container={}>'.format(self.kind, self.quality,
+                                                                            self.audio_format, self.container)
 
 
 class YouTubeHelper:
-    def __init__(self, video_link):
+    def __init__(self, video_link, on_progress=None, connections=DEFAULT_CONNECTIONS, limits=None, cache=True,
+                 streaming=False, metadata=None, instrumentation=None, thumbnails=True, transcoder=None,
+                 bandwidth=None, priority=None, transcode_workers=None, transport=None):
         """
-        initialize helper object and check video availability
+        initialize helper object and check video availability, metadata and streams are loaded from
+        the metadata cache when a fresh entry exists, so availability is not checked again
 
         :param video_link: link to the YouTube video
         :type video_link: str
+        :param on_progress: callback(label, bytes_done, total) for download progress, print progress if None
+        :type on_progress: callable or None
+        :param connections: number of parallel connections used to download one stream
+        :type connections: int
+        :param limits: limits on concurrent downloads and ffmpeg processes shared with other helpers
+        :type limits: StageLimits or None
+        :param cache: metadata cache to use, True for the default cache, False to always fetch
+        :type cache: MetadataCache or bool
+        :param streaming: pipe downloads straight into ffmpeg instead of writing temporary files first,
+                          streaming downloads cannot be resumed
+        :type streaming: bool
+        :param metadata: metadata already loaded, e.g. by AsyncYouTubeHelper.create, skips the cache and YouTube
+        :type metadata: dict or None
+        :param instrumentation: receives timing and throughput events of every stage
+        :type instrumentation: stats.Instrumentation or None
+        :param thumbnails: thumbnail cache to use, True for the cache shared by every helper, False for none
+        :type thumbnails: cache.ThumbnailCache or bool
+        :param transcoder: queue for the format conversions of get_audio shared with other helpers,
+                           get_audio converts before returning if None
+        :type transcoder: transcode.TranscodeScheduler or None
+        :param bandwidth: rate limits shared with other helpers, unlimited if None
+        :type bandwidth: bandwidth.BandwidthScheduler or None
+        :param priority: priority class of the downloads under bandwidth, see bandwidth.PRIORITIES. if None,
+                         audio is AUDIO, video above BACKGROUND_HEIGHT is BACKGROUND and the rest NORMAL
+        :type priority: int or None
+        :param transcode_workers: when get_video has to re-encode video, encode segments of it on this many
+                                  ffmpeg processes at once instead of one, see transcode.segmented_transcode
+        :type transcode_workers: int or None
+        :param transport: HTTP connections of the downloads, thumbnails and clip indexes, kept open between
+                          requests. the transport shared by every helper of the process if None, which pytube's
+                          metadata requests use too
+        :type transport: transport.Transport or None
         """
         self.yt = YouTube(video_link)
         self.index = 0
-        self.yt.check_availability()  # throw error if not available
+        self.outputs = []  # paths of the files get_video, get_audio and get_thumbnail wrote, in order
+        self.on_progress = on_progress if on_progress else print_progress
+        transport = transport if transport is not None else default_transport()
+        self.downloader = SegmentedDownloader(connections=connections, chunk_size=transport.chunk_size,
+                                              timeout=transport.timeout, transport=transport)
+        self.limits = limits if limits is not None else StageLimits()
+        self.cache = MetadataCache() if cache is True else cache or None
+        self.streaming = streaming
+        self.transcoder = transcoder
+        self.bandwidth = bandwidth
+        self.priority = priority
+        self.transcode_workers = transcode_workers
+        self.thumbnails = default_thumbnail_cache() if thumbnails is True else thumbnails or None
+        self.cancelled = threading.Event()  # set by cancel, stops every download of this helper
+        self.cancel_events = set()  # events of the downloads running in _run_concurrently
+        self.cancel_lock = threading.Lock()
+        self.video_id = self.yt.video_id
+        self.stats = (instrumentation if instrumentation is not None else Instrumentation()).bind(
+            video_id=self.video_id)
 
-    def auto_download(self, myfolder=None):
+        if metadata is None:
+            metadata = self.cache.get(self.video_id) if self.cache else None
+        if metadata is None:
+            with self.stats.stage('metadata'):
+                metadata = fetch_metadata(self.yt, self.cache)
+        self.title = metadata['title']
+        self.author = metadata['author']
+        self.length = metadata['length']
+        self.description = metadata['description']
+        self.thumbnail_url = metadata['thumbnail_url']
+        self.publish_date = datetime.datetime.fromisoformat(metadata['publish_date']) \
+            if metadata['publish_date'] else None
+        # query interface over all streams and index of their qualities, built once
+        self.streams = StreamQuery([StreamDescriptor.from_dict(d) for d in metadata['streams']])
+        self.stream_index = StreamIndex(self.streams, self.length)
+
+    def auto_download(self, myfolder=None, container='mp4', max_bytes=None, start=None, end=None, precise=False):
         """
-        download highest quality video available in mp4 format
+        download highest quality video available
 
         :param myfolder: directory of downloaded video
         :type myfolder: str or path-like or None
-        :return: None
+        :param container: output container, see get_video
+        :type container: str or None
+        :param max_bytes: largest acceptable (estimated) size of the video stream, no limit if None
+        :type max_bytes: int or None
+        :param start: start of a clip in seconds, see get_video
+        :type start: float or None
+        :param end: end of a clip in seconds, see get_video
+        :type end: float or None
+        :param precise: cut the clip exactly, see get_video
+        :type precise: bool
+        :return: how video and audio were muxed, None for progressive video
+        :rtype: media.MuxPlan or None
+        """
+        resolution, fps = self._best_quality(max_bytes)
+        print('video with resolution {} will be downloaded'.format(quality_label(resolution, fps)))
+        return self.get_video('{}p'.format(resolution), myfolder=myfolder, fps=fps, container=container,
+                              start=start, end=end, precise=precise)
+
+    def _best_quality(self, max_bytes=None):
+        """
+        highest (resolution, fps) available, highest resolution first, then highest frame rate
+
+        :param max_bytes: largest acceptable (estimated) size of the video stream, no limit if None
+        :type max_bytes: int or None
+        :rtype: tuple[int, int]
+        :raise ValueError: if there is no video within max_bytes
+        """
+        index = self.stream_index
+        stream = index.best_video(max_bytes=max_bytes)
+        best = (stream.height, stream.fps) if stream else None
+        if index.progressive_qualities and max_bytes is None:
+            best = max(filter(None, [best, index.progressive_qualities[-1]]))
+        if best is None:
+            raise ValueError("there is no video within {} bytes".format(max_bytes) if max_bytes else
+                             "there is no video")
+        return best
+
+    def _select_video(self, resolution, fps=None):
         """
-        resolutions = self.get_all_resolution()
-        highest_resolution = None
-        fps = None
-        # find highest resolution and highest fps if possible
-        for res in resolutions:
-            i = res.find('p')
-            number = res[:i]
-            frame_per_second = res[i + 1:]
-            if highest_resolution and number < highest_resolution:
-                break
-            if not highest_resolution:
-                highest_resolution = number
-            if not fps and frame_per_second:
-                fps = int(frame_per_second)
-            elif frame_per_second and int(frame_per_second) > fps:
-                fps = int(frame_per_second)
-        highest_resolution = str(highest_resolution) + 'p'
-        conventional = highest_resolution + str(fps) if fps else highest_resolution
-        print('video with resolution {} will be downloaded'.format(conventional))
-        self.get_video(highest_resolution, myfolder=myfolder, fps=fps)
-
-    def get_video(self, resolution, myfolder=None, fps=None):
-        """
-        download video in mp4 format
+        streams to download for a quality: the cheapest progressive stream if there is one,
+        otherwise the cheapest video only stream and the best audio
+
+        :param resolution: resolution ends with 'p', or a quality label such as 1080p60
+        :type resolution: str
+        :param fps: frame per second, the standard frame rate if None
+        :type fps: int or None
+        :return: (progressive stream, None, None) or (None, video stream, audio stream)
+        :rtype: tuple
+        :raise ValueError: if there is no video of this quality
+        """
+        height, label_fps = parse_quality_label(resolution)
+        fps = fps or label_fps
+        progressive = self.stream_index.progressive(height, fps)
+        if progressive:
+            return progressive, None, None
+        video = self.stream_index.video(height, fps)
+        if not video:
+            raise ValueError("there is no video with quality {}".format(quality_label(height, fps) if fps else
+                                                                          resolution))
+        return None, video, self.stream_index.best_audio()
+
+    def _select_audio(self, quality=None, audio_format=None):
+        """
+        audio stream of a bit rate, the highest one if None. streams that audio_format can hold without
+        re-encoding are preferred, see COPY_MIN_BITRATE_RATIO
+
+        :param quality: bit rate in kbps
+        :type quality: int or None
+        :param audio_format: target format without dot, e.g. m4a, None to keep the downloaded format
+        :type audio_format: str or None
+        :rtype: streams.StreamDescriptor
+        :raise TypeError: if quality is not an int
+        :raise ValueError: if there is no audio with this bit rate
+        """
+        index = self.stream_index
+        copyable = AUDIO_FORMAT_CODECS.get(audio_format) if audio_format else None
+        if quality is None:
+            target = index.best_audio()
+            if target is None:
+                raise ValueError("there is no audio")
+            copy_target = index.best_audio(codecs=copyable) if copyable else None
+            if copy_target is not None and copy_target.kbps >= target.kbps * COPY_MIN_BITRATE_RATIO:
+                return copy_target
+            return target
+        if not isinstance(quality, int):
+            raise TypeError("quality should be int")
+        # of the streams with this bit rate, one that can be copied
+        target = index.best_audio(max_kbps=quality, codecs=copyable) if copyable else None
+        if target is None or target.kbps != quality:
+            target = index.audio(quality)
+        if target is None:
+            raise ValueError("there is no audio with bit rate {}kbps".format(quality))
+        return target
+
+    def get_video(self, resolution, myfolder=None, fps=None, container='mp4', start=None, end=None, precise=False):
+        """
+        download video, stream copy video and audio into the container when possible.
+        with start or end only that part of the video is downloaded: the fragments covering it are found in the
+        segment index of each stream and fetched by byte range, then cut by ffmpeg
 
         :param myfolder: path to folder for downloaded video and audio
         :type myfolder: path-like or str or None
-        :param resolution: resolution ends with 'p'
+        :param resolution: resolution ends with 'p', or a quality label such as 1080p60
         :type resolution: str
-        :param fps: frame per second
+        :param fps: frame per second, the standard frame rate if None
         :type fps: int
-        :return: None
+        :param container: output container (mp4, mkv or webm), None to pick mp4 or mkv, whichever avoids re-encoding
+        :type container: str or None
+        :param start: start of the clip in seconds, the start of the video if None
+        :type start: float or None
+        :param end: end of the clip in seconds, the end of the video if None
+        :type end: float or None
+        :param precise: re-encode the clip so it starts exactly at start, a stream copy starts at the keyframe
+                        before start
+        :type precise: bool
+        :return: how video and audio were muxed, None for progressive video
+        :rtype: media.MuxPlan or None
+        :raise ValueError: if the clip does not end after it starts, within the video
         """
-        self.index += 1
-        title = self.yt.title
-        idx = self.index
-        valid_filename = safe_filename(title) + '.mp4'
-        file_path = os.path.join(myfolder, valid_filename) if myfolder else valid_filename
-        progressive_video = self.yt.streams.filter(progressive=True, resolution=resolution, fps=fps)
+        self._check_cancelled()
+        self.index += 1  # number of videos requested from this helper
+        title = self.title
+        clip = self._clip_range(start, end)
+        progressive_video, video_stream, audio_stream = self._select_video(resolution, fps)
 
         # download progressive video if possible
         if progressive_video:
             print("[Downloading progressive video...]")
-            progressive_video.last().download(output_path=myfolder, filename=valid_filename)
-            return
-        if not FFMPEG_AVAILABLE:
-            raise FfmpegNotAvailableError('ffmpeg not found. Cannot perform downloading.'
-                                          'Make sure ffmpeg is installed and added in PATH')
-
-        # search for video with specific resolution and fps
-        video_search_result = self.yt.streams.filter(only_video=True, resolution=resolution, fps=fps)
-        if video_search_result:
-            print("[Downloading...]")
-            video_path = video_search_result.last().download(
-                output_path=myfolder, filename=f'video{idx}')
-            audio_path = self.yt.streams.filter(only_audio=True).order_by('abr').last().download(output_path=myfolder,
-                                                                                                 filename=f'audio{idx}')
-            subprocess.run(
-                ['ffmpeg', '-i', video_path, '-i', audio_path, '-acodec', 'aac', '-vsync', 'vfr', '-preset', 'veryfast', file_path])
-            os.remove(video_path)
-            os.remove(audio_path)
+            with self.limits.download:
+                if clip is None:
+                    self.outputs.append(self._download_stream(progressive_video, safe_filename(title),
+                                                              myfolder=myfolder, label='video'))
+                    return None
+                # progressive streams have no segment index, the clip is cut out of the whole stream
+                video_path = self._download_stream(progressive_video, '{}_{}'.format(self.video_id,
+                                                                                      progressive_video.itag),
+                                                   myfolder=myfolder, label='video')
+            file_path = progressive_video.get_file_path(self._clip_filename(clip), output_path=myfolder)
+            self._check_cancelled()
+            if precise:
+                plan = plan_mux(progressive_video.video_codec, progressive_video.audio_codec,
+                                container=progressive_video.subtype, reencode=True)
+                command = plan.ffmpeg_command(video_path, video_path, file_path, clip=clip)
+            else:
+                command = cut_command(video_path, file_path, clip)
+            print("[Cutting...]")
+            self._cut(command, video_path, file_path, path=TRANSCODE if precise else REMUX)
+            return None
+        capabilities = ffmpeg_capabilities()  # throw error if ffmpeg is not available
+        plan = plan_mux(video_stream.video_codec, audio_stream.audio_codec, container=container,
+                        capabilities=capabilities, reencode=clip is not None and precise)
+        valid_filename = self._clip_filename(clip) + '.' + plan.container
+        file_path = os.path.join(myfolder, valid_filename) if myfolder else valid_filename
+        if clip is None and self.streaming and self._can_pipe(video_stream) and self._can_pipe(audio_stream):
+            print("[Downloading and muxing: {}]".format(plan))
+            with self.limits.download, self.limits.mux, self.stats.stage('stream_mux', plan=str(plan)) as meter:
+                self._mux_streaming(plan, video_stream, audio_stream, file_path, meter)
+            self.outputs.append(file_path)
+            return plan
+        print("[Downloading...]")
+        # video and audio are independent requests, fetch them at the same time.
+        # temporary files are named by video id and itag so an interrupted run can be resumed
+        with self.limits.download:
+            video_path, audio_path = self._fetch_concurrently(
+                [('video', video_stream, '{}_{}'.format(self.video_id, video_stream.itag)),
+                 ('audio', audio_stream, '{}_{}'.format(self.video_id, audio_stream.itag))],
+                myfolder=myfolder, clip=clip)
+        self._check_cancelled()
+        print("[Muxing: {}]".format(plan))
+        self._mux(plan, video_path, audio_path, file_path, capabilities, clip=clip)
+        os.remove(video_path)
+        os.remove(audio_path)
+        self.outputs.append(file_path)
+        return plan
+
+    def _mux(self, plan, video_path, audio_path, file_path, capabilities, clip=None):
+        """
+        carry out a mux plan on downloaded streams, re-encoded video is split over transcode_workers processes
+        """
+        if plan.path == TRANSCODE and self.transcode_workers and clip is None:
+            # each ffmpeg process of the segments takes a mux slot of its own
+            with self.stats.stage('mux', plan=str(plan)):
+                segmented_transcode(plan, video_path, audio_path, file_path, workers=self.transcode_workers,
+                                    capabilities=capabilities, slots=self.limits.mux)
         else:
-            quality = resolution + str(fps) if fps else resolution
-            raise ValueError("there is no video with quality {}".format(quality))
+            with self.limits.mux, self.stats.stage('mux', plan=str(plan)) as meter:
+                run_ffmpeg(plan.ffmpeg_command(video_path, audio_path, file_path, clip=clip),
+                           on_progress=self._ffmpeg_progress(meter))
+
+    def _fetch_concurrently(self, jobs, myfolder=None, clip=None):
+        """
+        download several streams at the same time, one thread per stream.
+        if any download fails, the others are cancelled. partial files are kept so that the
+        downloads can be resumed
+
+        :param jobs: list of (label, stream, filename) to download
+        :type jobs: list[tuple]
+        :param myfolder: directory for downloaded streams
+        :type myfolder: str or path-like or None
+        :param clip: (start, end) in seconds, download only the part of the streams covering it
+        :type clip: tuple[float, float] or None
+        :return: paths to downloaded streams, in the same order as jobs
+        :rtype: list[str]
+        """
+        if clip is not None:
+            return self._run_concurrently([functools.partial(self._download_clip, stream, filename, clip,
+                                                             myfolder=myfolder, label=label)
+                                           for label, stream, filename in jobs])
+        return self._run_concurrently([functools.partial(self._download_stream, stream, filename, myfolder=myfolder,
+                                                         label=label)
+                                       for label, stream, filename in jobs])
+
+    def _run_concurrently(self, tasks):
+        """
+        run tasks at the same time, one thread per task. if any task fails or the helper is cancelled,
+        the others are cancelled
+
+        :param tasks: callables accepting a cancel_event keyword argument
+        :type tasks: list[callable]
+        :return: results of tasks, in the same order as tasks
+        :rtype: list
+        """
+        cancel_event = threading.Event()
+        with self.cancel_lock:
+            if self.cancelled.is_set():
+                cancel_event.set()
+            self.cancel_events.add(cancel_event)
+        try:
+            with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+                futures = [executor.submit(task, cancel_event=cancel_event) for task in tasks]
+                done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+                failed = [f for f in done if f.exception() is not None]
+                if failed:
+                    cancel_event.set()
+                    wait(futures)
+                    raise failed[0].exception()
+                return [f.result() for f in futures]
+        finally:
+            with self.cancel_lock:
+                self.cancel_events.discard(cancel_event)
+
+    def cancel(self):
+        """
+        stop the running and later downloads of this helper, they raise DownloadCancelledError.
+        partial files are kept, so a new helper resumes the downloads. a running ffmpeg process
+        is not interrupted, the helper stops before the next one
+        """
+        with self.cancel_lock:
+            self.cancelled.set()
+            for event in self.cancel_events:
+                event.set()
+
+    def _check_cancelled(self):
+        if self.cancelled.is_set():
+            raise DownloadCancelledError('downloads of {} cancelled'.format(self.video_id))
+
+    @staticmethod
+    def _can_pipe(stream, extra_fds=True):
+        """
+        check if a stream can be piped into ffmpeg
+
+        :param stream: stream to check
+        :type stream: streams.StreamDescriptor
+        :param extra_fds: whether the pipe is passed as an extra file descriptor, which needs a POSIX system,
+                          rather than as stdin
+        :type extra_fds: bool
+        :rtype: bool
+        """
+        return not stream.is_otf and can_stream_input(stream.subtype) and (not extra_fds or os.name == 'posix')
+
+    def _pipe_stream(self, stream, fileobj, label='stream', cancel_event=None):
+        """
+        download a stream into fileobj in order and close it when done
+
+        :param stream: stream to download
+        :type stream: streams.StreamDescriptor
+        :param fileobj: writable binary file object, e.g. a pipe to ffmpeg
+        :type fileobj: io.BufferedIOBase
+        :param label: name of the download passed to on_progress
+        :type label: str
+        :param cancel_event: stop the download once it is set
+        :type cancel_event: threading.Event or None
+        :return: None
+        """
+        with fileobj, self.stats.stage('download', label=label, itag=stream.itag) as meter:
+            self.downloader.download_to(stream.url, fileobj, stream.filesize,
+                                        on_progress=self._progress_callback(label, meter), cancel_event=cancel_event,
+                                        throttle=self._throttle(stream))
+
+    def _throttle(self, stream):
+        """
+        rate limit callback for one download of stream, None without a bandwidth scheduler
+
+        :param stream: stream to download
+        :type stream: streams.StreamDescriptor
+        :rtype: callable or None
+        """
+        if self.bandwidth is None:
+            return None
+        priority = self.priority
+        if priority is None:
+            if not stream.includes_video_track:
+                priority = AUDIO
+            elif stream.height and stream.height > BACKGROUND_HEIGHT:
+                priority = BACKGROUND
+            else:
+                priority = NORMAL
+        return self.bandwidth.job(priority).throttle
+
+    def _mux_streaming(self, plan, video_stream, audio_stream, file_path, meter=None):
+        """
+        download video and audio straight into ffmpeg through pipes, so muxing overlaps with downloading
+        and no temporary file is written. the output is removed if anything fails
+
+        :param plan: how to mux the streams
+        :type plan: media.MuxPlan
+        :param video_stream: video stream
+        :type video_stream: streams.StreamDescriptor
+        :param audio_stream: audio stream
+        :type audio_stream: streams.StreamDescriptor
+        :param file_path: path to the muxed video
+        :type file_path: str
+        :param meter: meter of the stage receiving ffmpeg progress
+        :type meter: stats.TransferMeter or None
+        :return: None
+        """
+        video_read, video_write = os.pipe()
+        audio_read, audio_write = os.pipe()
+        command = plan.ffmpeg_command('pipe:{}'.format(video_read), 'pipe:{}'.format(audio_read), file_path)
+        try:
+            process = popen_ffmpeg(command, on_progress=self._ffmpeg_progress(meter),
+                                   pass_fds=(video_read, audio_read))
+        except (OSError, FfmpegError):
+            os.close(video_write)
+            os.close(audio_write)
+            raise
+        finally:
+            os.close(video_read)
+            os.close(audio_read)
+        self._feed_process(process, [functools.partial(self._pipe_stream, video_stream, open(video_write, 'wb'),
+                                                       label='video'),
+                                     functools.partial(self._pipe_stream, audio_stream, open(audio_write, 'wb'),
+                                                       label='audio')],
+                           file_path)
+
+    def _feed_process(self, process, tasks, output_path):
+        """
+        run tasks writing into the pipes of an ffmpeg process and wait for it to finish.
+        if a task or ffmpeg fails, ffmpeg is killed and its partial output removed, an existing file
+        ffmpeg refused to overwrite is kept
+
+        :param process: running ffmpeg process
+        :type process: subprocess.Popen
+        :param tasks: callables accepting a cancel_event keyword argument
+        :type tasks: list[callable]
+        :param output_path: path ffmpeg writes to
+        :type output_path: str
+        :return: None
+        :raise FfmpegError: if ffmpeg fails
+        """
+        # ffmpeg cannot have opened its output yet, it is still waiting for input to probe
+        existed = os.path.exists(output_path)
+        try:
+            self._run_concurrently(tasks)
+        except BrokenPipeError as e:
+            # ffmpeg gave up on its own, e.g. refused to overwrite output_path
+            returncode = process.wait()
+            if not existed:
+                self._remove_output(output_path)
+            raise FfmpegError('ffmpeg stopped reading its input, exit code {}'.format(returncode)) from e
+        except BaseException:
+            process.kill()
+            process.wait()
+            if not existed:
+                self._remove_output(output_path)
+            raise
+        returncode = process.wait()
+        if hasattr(process, 'progress_reader'):
+            process.progress_reader.join()
+        if returncode != 0:
+            if not existed:
+                self._remove_output(output_path)
+            raise FfmpegError('ffmpeg exited with code {}'.format(returncode))
+
+    def _progress_callback(self, label, meter):
+        """
+        progress callback of the downloaders reporting to on_progress and meter
+        """
+        def on_progress(done, total):
+            self.on_progress(label, done, total)
+            meter.update(done, total)
+
+        return on_progress
 
-    def get_audio(self, myfolder=None, quality=None, audio_format=None):
+    def _ffmpeg_progress(self, meter):
+        """
+        ffmpeg progress callback for meter, None if nothing is measured so ffmpeg runs as before
+        """
+        return meter.ffmpeg_progress if meter is not None and self.stats.enabled else None
+
+    @staticmethod
+    def _remove_output(output_path):
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
+    def _download_stream(self, stream, filename, myfolder=None, label='stream', cancel_event=None):
+        """
+        download a stream with the segmented downloader, reporting progress under label.
+        the stream is written to a partial file keyed by video id and itag and moved to its final
+        path when complete, an interrupted download of the same stream continues where it stopped
+
+        :param stream: stream to download
+        :type stream: streams.StreamDescriptor
+        :param filename: filename of the stream without extension
+        :type filename: str
+        :param myfolder: directory for downloaded stream
+        :type myfolder: str or path-like or None
+        :param label: name of the download passed to on_progress
+        :type label: str
+        :param cancel_event: stop the download once it is set, default to be the event of cancel
+        :type cancel_event: threading.Event or None
+        :return: path to downloaded stream
+        :rtype: str
+        """
+        cancel_event = cancel_event if cancel_event is not None else self.cancelled
+        file_path = stream.get_file_path(filename=filename, output_path=myfolder)
+        partial_path = os.path.join(target_directory(myfolder), '{}.{}.part'.format(self.video_id, stream.itag))
+        with self.stats.stage('download', label=label, itag=stream.itag) as meter:
+            on_progress = self._progress_callback(label, meter)
+            throttle = self._throttle(stream)
+            if stream.is_otf:
+                # sequential (otf) streams are served in numbered fragments and cannot be split by range
+                done = 0
+                with open(partial_path, 'wb') as fh:
+                    for chunk in request.seq_stream(stream.url):
+                        if cancel_event.is_set():
+                            raise DownloadCancelledError('download of {} cancelled'.format(label))
+                        fh.write(chunk)
+                        done += len(chunk)
+                        on_progress(done, None)
+                        if throttle:
+                            throttle(len(chunk))
+            else:
+                filesize = stream.filesize
+                if os.path.isfile(file_path) and os.path.getsize(file_path) == filesize:
+                    # already downloaded
+                    self.on_progress(label, filesize, filesize)
+                    return file_path
+                self.downloader.download(stream.url, partial_path, filesize, on_progress=on_progress,
+                                         cancel_event=cancel_event, resume=True, throttle=throttle)
+        os.replace(partial_path, file_path)
+        return file_path
+
+    def _download_clip(self, stream, filename, clip, myfolder=None, label='stream', cancel_event=None):
+        """
+        download the part of a stream covering a clip: the init segment followed by the fragments from the
+        keyframe before its start to its end, located through the segment index of the stream. the file
+        keeps the timestamps of the whole stream, ffmpeg cuts it with media.clip_args.
+        streams without a segment index, e.g. otf streams, are downloaded whole
+
+        :param stream: stream to download
+        :type stream: streams.StreamDescriptor
+        :param filename: filename of the stream without extension
+        :type filename: str
+        :param clip: (start, end) in seconds
+        :type clip: tuple[float, float]
+        :param myfolder: directory for downloaded stream
+        :type myfolder: str or path-like or None
+        :param label: name of the download passed to on_progress
+        :type label: str
+        :param cancel_event: stop the download once it is set, default to be the event of cancel
+        :type cancel_event: threading.Event or None
+        :return: path to downloaded stream
+        :rtype: str
+        """
+        cancel_event = cancel_event if cancel_event is not None else self.cancelled
+        try:
+            with self.stats.stage('index', label=label, itag=stream.itag):
+                index = load_segment_index(stream, timeout=self.downloader.timeout,
+                                           transport=self.downloader.transport)
+        except ClipError as e:
+            print("[{}: {}, downloading the whole stream]".format(label, e))
+            return self._download_stream(stream, filename, myfolder=myfolder, label=label, cancel_event=cancel_event)
+        first, last, _ = index.byte_range(*clip)
+        file_path = stream.get_file_path(filename='{}_{}'.format(filename, clip_label(*clip)), output_path=myfolder)
+        # keyed by byte range as well, a partial file of another clip or of the whole stream is not resumed
+        partial_path = os.path.join(target_directory(myfolder), '{}.{}.{}-{}.part'.format(
+            self.video_id, stream.itag, first, last))
+        with self.stats.stage('download', label=label, itag=stream.itag, clip=clip_label(*clip)) as meter:
+            self.downloader.download(stream.url, partial_path, None, on_progress=self._progress_callback(label, meter),
+                                     cancel_event=cancel_event, resume=True, throttle=self._throttle(stream),
+                                     byte_range=(first, last), offset=len(index.init))
+        with open(partial_path, 'r+b') as fh:
+            fh.write(index.init)
+        os.replace(partial_path, file_path)
+        return file_path
+
+    def get_audio(self, myfolder=None, quality=None, audio_format=None, start=None, end=None):
         """
         download audio in different format
 
@@ -121,50 +672,305 @@ class YouTubeHelper:
         :type quality: int or None
         :param audio_format: audio format e.g.mp3,w4a
         :type: str
-        :return: None
+        :param start: start of a clip in seconds, see get_video
+        :type start: float or None
+        :param end: end of a clip in seconds, see get_video
+        :type end: float or None
+        :return: future of the converted audio if the conversion was queued on the transcoder, otherwise None
+        :rtype: concurrent.futures.Future or None
+        :raise ValueError: if the clip does not end after it starts, within the video
         """
-        filename = safe_filename(self.yt.title)
-        if quality is None:
-            target = self.yt.streams.filter(only_audio=True).order_by('abr').last()
-        elif not isinstance(quality, int):
-            raise TypeError("quality should be int")
-        else:
-            abr = str(quality) + 'kbps'
-            search_result = self.yt.streams.filter(only_audio=True, abr=abr)
-            if search_result:
-                target = search_result.last()
-            else:
-                raise ValueError("there is no audio with bit rate {}".format(abr))
-        print("audio with {} is going to be downloaded".format(target.abr))
+        self._check_cancelled()
+        clip = self._clip_range(start, end)
+        filename = self._clip_filename(clip)
+        if audio_format:
+            audio_format = audio_format if audio_format[0] == '.' else '.' + audio_format
+            output_path = os.path.join(myfolder, filename + audio_format) if myfolder else filename + audio_format
+        target = self._select_audio(quality, audio_format[1:] if audio_format else None)
+        print("audio with {} {} is going to be downloaded".format(target.abr, target.audio_codec))
+        convert_path = audio_convert_path(target.audio_codec, audio_format[1:]) if audio_format else None
+        if clip is not None:
+            self._get_audio_clip(target, filename, clip, myfolder, audio_format, convert_path)
+            return
+        if audio_format and '.' + target.subtype != audio_format and self.streaming \
+                and self._can_pipe(target, extra_fds=False):
+            # convert while downloading, the source audio never reaches the disk
+            command = audio_convert_command('pipe:0', output_path, audio_format[1:], audio_codec=target.audio_codec)
+            print("[Downloading and converting ({})...]".format(convert_path))
+            with self.limits.download, self.limits.mux, \
+                    self.stats.stage('stream_convert', format=audio_format[1:], path=convert_path) as meter:
+                process = popen_ffmpeg(command, on_progress=self._ffmpeg_progress(meter), stdin=subprocess.PIPE)
+                self._feed_process(process, [functools.partial(self._pipe_stream, target, process.stdin,
+                                                               label='audio')],
+                                   output_path)
+            print('[Download success]')
+            self.outputs.append(output_path)
+            return
         print("[Downloading...]")
-        audio_path = target.download(output_path=myfolder, filename=filename)
+        with self.limits.download:
+            audio_path = self._download_stream(target, filename, myfolder=myfolder, label='audio')
         print('[Download success]')
+        if not audio_format or os.path.splitext(audio_path)[1] == audio_format:
+            self.outputs.append(audio_path)
         if audio_format:
-            audio_format = audio_format if audio_format[0] == '.' else '.' + audio_format
             path, ext = os.path.splitext(audio_path)
+            if ext != audio_format and self.transcoder is not None and convert_path != REMUX:
+                # the download slot is free again, the next download overlaps with this conversion
+                print("[Queued conversion to {}]".format(audio_format[1:]))
+                self.outputs.append(output_path)
+                return self.transcoder.submit(audio_path, output_path, audio_format[1:], instrumentation=self.stats)
             if ext != audio_format:
-                if not FFMPEG_AVAILABLE:
-                    raise FfmpegNotAvailableError('ffmpeg not found. Cannot perform downloading.'
-                                                  'Make sure ffmpeg is installed and added in PATH')
-                output_path = os.path.join(myfolder, filename + audio_format) if myfolder else filename + audio_format
-                subprocess.run(['ffmpeg', '-i', audio_path, output_path])
+                self._check_cancelled()
+                # a stream copy only rewrites the container, it is not worth queueing
+                command = audio_convert_command(audio_path, output_path, audio_format[1:],
+                                                audio_codec=target.audio_codec)
+                print("[Converting to {} ({})]".format(audio_format[1:], convert_path))
+                with self.limits.mux, \
+                        self.stats.stage('convert', format=audio_format[1:], path=convert_path) as meter:
+                    run_ffmpeg(command, on_progress=self._ffmpeg_progress(meter))
                 os.remove(audio_path)
+                self.outputs.append(output_path)
+
+    def _get_audio_clip(self, target, filename, clip, myfolder, audio_format, convert_path):
+        """
+        download the part of an audio stream covering clip, then cut and convert it in one ffmpeg run
+        """
+        print("[Downloading...]")
+        with self.limits.download:
+            audio_path = self._download_clip(target, '{}_{}'.format(self.video_id, target.itag), clip,
+                                             myfolder=myfolder, label='audio')
+        print('[Download success]')
+        self._check_cancelled()
+        if audio_format:
+            output_path = os.path.join(myfolder, filename + audio_format) if myfolder else filename + audio_format
+            command = audio_convert_command(audio_path, output_path, audio_format[1:], audio_codec=target.audio_codec,
+                                            clip=clip)
+            print("[Cutting and converting to {} ({})]".format(audio_format[1:], convert_path))
+        else:
+            output_path = target.get_file_path(filename, output_path=myfolder)
+            command = cut_command(audio_path, output_path, clip)
+            print("[Cutting...]")
+        self._cut(command, audio_path, output_path, path=convert_path or REMUX)
+
+    def _clip_range(self, start, end):
+        """
+        (start, end) in seconds of a clip, the end is clamped to the length of the video
+
+        :type start: float or None
+        :type end: float or None
+        :return: None if both are None, for the whole video
+        :rtype: tuple[float, float] or None
+        :raise ValueError: if the clip does not end after it starts, within the video
+        """
+        if start is None and end is None:
+            return None
+        start = start or 0
+        if end is None or (self.length and end > self.length):
+            end = self.length
+        if start < 0 or end is None or end <= start:
+            raise ValueError("clip should end after it starts, within the {}s of the video".format(self.length))
+        return start, end
+
+    def _clip_filename(self, clip):
+        """
+        file name of the output without extension, the title followed by the time range of a clip
+        """
+        if clip is None:
+            return safe_filename(self.title)
+        return safe_filename('{} {}'.format(self.title, clip_label(*clip)))
+
+    def _cut(self, command, input_path, output_path, path=REMUX):
+        """
+        run the ffmpeg command cutting a clip out of a downloaded stream, then remove the stream
+        """
+        with self.limits.mux, self.stats.stage('cut', path=path) as meter:
+            run_ffmpeg(command, on_progress=self._ffmpeg_progress(meter))
+        os.remove(input_path)
+        self.outputs.append(output_path)
+
+    def get_outputs(self, outputs, myfolder=None, start=None, end=None, precise=False):
+        """
+        produce several files of the video, e.g. an mp4, an mp3 and the thumbnail, downloading every stream
+        they need only once. video outputs are planned first, audio outputs without a quality then reuse the
+        audio stream of a video instead of fetching another one. the streams and the thumbnail are downloaded
+        at the same time, then every mux, conversion and copy runs at the same time under the mux limit.
+        files that would get the same name are told apart by their quality, e.g. "title 720p.mp4"
+
+        :param outputs: files to produce
+        :type outputs: list[Output]
+        :param myfolder: directory of the files
+        :type myfolder: str or path-like or None
+        :param start: start of a clip in seconds, see get_video
+        :type start: float or None
+        :param end: end of a clip in seconds, see get_video
+        :type end: float or None
+        :param precise: re-encode the video of a clip so it starts exactly at start, see get_video
+        :type precise: bool
+        :return: paths of the files, in the same order as outputs
+        :rtype: list[str]
+        :raise ValueError: if a quality is not available or the clip does not end after it starts
+        """
+        self._check_cancelled()
+        clip = self._clip_range(start, end)
+        sources = {}  # index of the output -> streams it is made of
+        fetches = {}  # itag -> stream, each downloaded once
+        for i, output in sorted(enumerate(outputs), key=lambda item: item[1].kind != 'video'):
+            if output.kind == 'video':
+                if output.quality is None:
+                    resolution, fps = self._best_quality()
+                    streams = self._select_video('{}p'.format(resolution), fps)
+                else:
+                    streams = self._select_video(output.quality)
+                sources[i] = [s for s in streams if s is not None]
+            elif output.kind == 'audio':
+                planned = [s for s in fetches.values() if s.is_adaptive and s.includes_audio_track]
+                if output.quality is None and planned:
+                    sources[i] = [max(planned, key=lambda s: s.kbps or 0)]
+                else:
+                    sources[i] = [self._select_audio(output.quality, output.audio_format)]
+            else:
+                sources[i] = []
+            for stream in sources[i]:
+                fetches.setdefault(stream.itag, stream)
+
+        types = [stream.type for stream in fetches.values()]
+        jobs = [(stream.type if types.count(stream.type) == 1 else '{} {}'.format(stream.type, itag), stream,
+                 '{}_{}'.format(self.video_id, itag)) for itag, stream in fetches.items()]
+        if clip is not None:
+            tasks = [functools.partial(self._download_clip, stream, filename, clip, myfolder=myfolder, label=label)
+                     for label, stream, filename in jobs]
+        else:
+            tasks = [functools.partial(self._download_stream, stream, filename, myfolder=myfolder, label=label)
+                     for label, stream, filename in jobs]
+        thumbnails = [i for i, output in enumerate(outputs) if output.kind == 'thumbnail']
+        if thumbnails:
+            tasks.append(lambda cancel_event: self.get_thumbnail(myfolder))
+        print("[Downloading {} streams{}...]".format(len(jobs), ' and the thumbnail' if thumbnails else ''))
+        with self.limits.download:
+            results = self._run_concurrently(tasks)
+        paths = {itag: path for itag, path in zip(fetches, results)}
+        output_paths = [results[-1] if output.kind == 'thumbnail' else None for output in outputs]
+
+        capabilities = None  # ffmpeg is probed once a step needs it
+        name = self._clip_filename(clip)
+        users = [stream.itag for streams in sources.values() for stream in streams]
+        moved = set()  # itags of streams moved to their output instead of copied
+        steps = []
+        for i, output in enumerate(outputs):
+            streams = sources[i]
+            if output.kind == 'video' and len(streams) == 2:
+                capabilities = capabilities or ffmpeg_capabilities()
+                plan = plan_mux(streams[0].video_codec, streams[1].audio_codec, container=output.container,
+                                capabilities=capabilities, reencode=clip is not None and precise)
+                output_paths[i] = self._output_path(name, plan.container, myfolder, output_paths,
+                                                    quality_label(streams[0].height, streams[0].fps))
+                steps.append(functools.partial(self._mux, plan, paths[streams[0].itag], paths[streams[1].itag],
+                                               output_paths[i], capabilities, clip=clip))
+            elif streams:
+                stream = streams[0]
+                audio_format = output.audio_format if output.kind == 'audio' else None
+                extension = audio_format or stream.subtype
+                output_paths[i] = self._output_path(name, extension, myfolder, output_paths,
+                                                    stream.abr if output.kind == 'audio' else stream.resolution)
+                if (audio_format and audio_format != stream.subtype) or clip is not None:
+                    capabilities = capabilities or ffmpeg_capabilities()
+                if audio_format and audio_format != stream.subtype:
+                    command = audio_convert_command(paths[stream.itag], output_paths[i], audio_format,
+                                                    capabilities=capabilities, audio_codec=stream.audio_codec,
+                                                    clip=clip)
+                    steps.append(functools.partial(self._convert, command, audio_format,
+                                                   audio_convert_path(stream.audio_codec, audio_format)))
+                elif clip is not None and precise and output.kind == 'video':
+                    plan = plan_mux(stream.video_codec, stream.audio_codec, container=stream.subtype, reencode=True)
+                    command = plan.ffmpeg_command(paths[stream.itag], paths[stream.itag], output_paths[i], clip=clip)
+                    steps.append(functools.partial(self._convert, command, extension, TRANSCODE))
+                elif clip is not None:
+                    command = cut_command(paths[stream.itag], output_paths[i], clip, capabilities=capabilities)
+                    steps.append(functools.partial(self._convert, command, extension, REMUX))
+                elif users.count(stream.itag) == 1:
+                    moved.add(stream.itag)
+                    steps.append(functools.partial(os.replace, paths[stream.itag], output_paths[i]))
+                else:
+                    steps.append(functools.partial(shutil.copyfile, paths[stream.itag], output_paths[i]))
+        self._check_cancelled()
+        if steps:
+            print("[Muxing and converting {} outputs...]".format(len(steps)))
+            self._run_concurrently([functools.partial(self._run_step, step) for step in steps])
+        for itag, path in paths.items():
+            if itag not in moved:
+                os.remove(path)
+        self.outputs += [path for i, path in enumerate(output_paths) if i not in thumbnails]
+        return output_paths
+
+    def _run_step(self, step, cancel_event):
+        # skip the step if another one failed or the helper was cancelled before it started
+        if cancel_event.is_set():
+            raise DownloadCancelledError('downloads of {} cancelled'.format(self.video_id))
+        step()
+
+    def _convert(self, command, audio_format, path):
+        """
+        run an ffmpeg command converting or cutting one downloaded stream, keeping the stream
+        """
+        with self.limits.mux, self.stats.stage('convert', format=audio_format, path=path) as meter:
+            run_ffmpeg(command, on_progress=self._ffmpeg_progress(meter))
+
+    @staticmethod
+    def _output_path(name, extension, myfolder, taken, quality):
+        """
+        path of an output of get_outputs, with its quality in the name if another output took the plain one
+        """
+        path = os.path.join(target_directory(myfolder), '{}.{}'.format(name, extension))
+        if path in taken:
+            path = os.path.join(target_directory(myfolder), '{}.{}'.format(
+                safe_filename('{} {}'.format(name, quality)), extension))
+        return path
 
     def get_thumbnail(self, myfolder=None):
         """
-        download video thumbnail and return the path to downloaded thumbnail
+        download the largest video thumbnail and return the path to downloaded thumbnail
 
         :param myfolder: directory for downloading thumbnail
         :type myfolder: str or path-like or None
         :return: path to thumbnail
         :rtype: str
         """
-        src_link = self.yt.thumbnail_url
-        filename = os.path.basename(urllib.parse.urlparse(src_link).path)
+        filename = os.path.basename(urllib.parse.urlparse(self.thumbnail_url).path)
         full_path = os.path.normpath(os.path.join(myfolder, filename)) if myfolder is not None else filename
-        urllib.request.urlretrieve(src_link, full_path)
+        with open(full_path, 'wb') as f:
+            f.write(self.get_thumbnail_bytes())
+        self.outputs.append(full_path)
         return full_path
 
+    def get_thumbnail_bytes(self, width=None, height=None):
+        """
+        the smallest video thumbnail covering width x height, from the thumbnail cache if possible
+
+        :param width: target width in pixels, the largest thumbnail if None
+        :type width: int or None
+        :param height: target height in pixels
+        :type height: int or None
+        :return: JPEG data
+        :rtype: bytes
+        """
+        with self.stats.stage('thumbnail'):
+            return fetch_thumbnail(self.video_id, width, height, fallback_url=self.thumbnail_url,
+                                   cache=self.thumbnails, timeout=self.downloader.timeout,
+                                   transport=self.downloader.transport)
+
+    def get_thumbnail_image(self, width=None, height=None):
+        """
+        video thumbnail decoded and scaled down to fit width x height, needs Pillow
+
+        :param width: maximum width in pixels
+        :type width: int or None
+        :param height: maximum height in pixels
+        :type height: int or None
+        :return: thumbnail
+        :rtype: PIL.Image.Image
+        """
+        return decode_thumbnail(self.get_thumbnail_bytes(width, height), width, height)
+
     def get_all_resolution(self):
         """
         print all available resolution
@@ -172,17 +978,7 @@ class YouTubeHelper:
         :return: list of strings containing available resolution
         :rtype: list[str]
         """
-        resolutions = []
-        for stream in self.yt.streams.filter(only_video=True).order_by('resolution').desc():
-            res = stream.resolution
-            fps = stream.fps
-            if fps > 30:
-                res += str(fps)
-            if res in resolutions:
-                continue
-            else:
-                resolutions.append(res)
-        return resolutions
+        return self.stream_index.resolutions()
 
     def get_all_audio_quality(self):
         """
@@ -191,12 +987,7 @@ class YouTubeHelper:
         :return: list of string containing available bit rate in terms of kbps
         :rtype: list[str]
         """
-        audios = []
-        for stream in self.yt.streams.filter(only_audio=True).order_by('abr').desc():
-            bytes_per_second = stream.abr
-            if bytes_per_second not in audios:
-                audios.append(bytes_per_second)
-        return audios
+        return self.stream_index.bitrates()
 
     def get_info(self):
         """
@@ -205,11 +996,11 @@ class YouTubeHelper:
 
         :return: None
         """
-        print("title: ", self.yt.title)
-        print("publish date: ", self.yt.publish_date)
+        print("title: ", self.title)
+        print("publish date: ", self.publish_date)
         print("description:")
-        print(self.yt.description)
-        print("length: ", readable_time(self.yt.length))
+        print(self.description)
+        print("length: ", readable_time(self.length))
         print("available resolution for download: ", self.get_all_resolution())
         print("available audio quality for download: ", self.get_all_audio_quality())
 
@@ -220,7 +1011,7 @@ class YouTubeHelper:
         :return: video duration
         :rtype str
         """
-        return readable_time(self.yt.length)
+        return readable_time(self.length)
 
     def get_title(self):
         """
@@ -229,7 +1020,65 @@ class YouTubeHelper:
         :return: title
         :rtype: str
         """
-        return self.yt.title
+        return self.title
+
+
+def fetch_metadata(yt, cache=None):
+    """
+    check availability of the video and fetch its metadata and stream descriptors from YouTube,
+    the metadata is stored in cache if given
+
+    :param yt: pytube object of the video
+    :type yt: YouTube
+    :param cache: metadata cache to store the metadata in
+    :type cache: MetadataCache or None
+    :return: JSON serializable metadata
+    :rtype: dict
+    """
+    yt.check_availability()  # throw error if not available
+    # byte ranges and sizes of the streams, pytube keeps neither
+    streaming_data = yt.streaming_data
+    formats = {f.get('itag'): f for f in streaming_data.get('formats', []) + streaming_data.get('adaptiveFormats', [])}
+    streams = [StreamDescriptor.from_stream(s, formats.get(s.itag)) for s in yt.streams]
+    publish_date = yt.publish_date
+    metadata = {
+        'title': yt.title,
+        'author': yt.author,
+        'length': yt.length,
+        'description': yt.description,
+        'thumbnail_url': yt.thumbnail_url,
+        'publish_date': publish_date.isoformat() if publish_date else None,
+        'streams': [s.to_dict() for s in streams],
+    }
+    if cache:
+        expirations = [s.expiration for s in streams if s.expiration is not None]
+        cache.put(yt.video_id, metadata, url_expiration=min(expirations) if expirations else None)
+    return metadata
+
+
+def print_progress(label, bytes_done, total):
+    """
+    default progress callback, print progress of a download every 10 percent
+
+    :param label: name of the download e.g. video, audio
+    :type label: str
+    :param bytes_done: number of bytes downloaded so far
+    :type bytes_done: int
+    :param total: total number of bytes
+    :type total: int
+    :return: None
+    """
+    if not total:
+        return
+    percent = bytes_done * 100 // total
+    if percent // 10 > _printed_progress.get(label, -1):
+        print('[{}: {}%]'.format(label, percent))
+        _printed_progress[label] = percent // 10
+    if bytes_done >= total:
+        _printed_progress.pop(label, None)
+
+
+_printed_progress = {}  # label -> last printed tenth of progress
 
 
 def readable_time(seconds):
@@ -0,0 +1,582 @@
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import threading
+
+from cache import cache_dir
+
+REMUX = 'remux'  # copy both streams into the container
+TRANSCODE_AUDIO = 'transcode audio'  # copy video, re-encode audio
+TRANSCODE = 'transcode'  # re-encode both streams
+
+# codecs each container can hold without re-encoding, None means any codec YouTube serves
+CONTAINER_CODECS = {
+    'mp4': ({'avc1', 'hev1', 'hvc1', 'av01', 'vp09'}, {'mp4a', 'opus'}),
+    'webm': ({'vp08', 'vp09', 'av01'}, {'opus', 'vorbis'}),
+    'mkv': (None, None),
+}
+# audio codecs each audio format can hold without re-encoding
+AUDIO_FORMAT_CODECS = {
+    'm4a': {'mp4a'},
+    'webm': {'opus', 'vorbis'},
+    'mp3': {'mp3'},
+    'wav': set(),
+}
+# encoders per container used when a stream has to be re-encoded, in order of preference
+VIDEO_ENCODERS = {
+    'mp4': ['libx264', 'libopenh264'],
+    'mkv': ['libx264', 'libopenh264'],
+    'webm': ['libvpx-vp9', 'libvpx'],
+}
+AUDIO_ENCODERS = {
+    'mp4': ['aac', 'libfdk_aac'],
+    'mkv': ['aac', 'libfdk_aac'],
+    'webm': ['libopus', 'libvorbis', 'opus'],
+    'mp3': ['libmp3lame', 'libshine'],
+    'm4a': ['aac', 'libfdk_aac'],
+    'wav': ['pcm_s16le'],
+}
+# extra options per video encoder
+VIDEO_ENCODER_ARGS = {
+    'libx264': ['-preset', 'veryfast'],
+    'libvpx-vp9': ['-deadline', 'realtime'],
+    'libvpx': ['-deadline', 'realtime'],
+}
+# ffmpeg muxer writing each output format
+FORMAT_MUXERS = {'mp4': 'mp4', 'mkv': 'matroska', 'webm': 'webm', 'mp3': 'mp3', 'm4a': 'ipod', 'wav': 'wav'}
+OPUS_IN_MP4_VERSION = (4, 3)  # first ffmpeg version muxing opus into mp4 without -strict experimental
+FFMPEG_PROBE_FILE = 'ffmpeg.json'
+# input formats ffmpeg can read from a pipe. webm is always streamable, and YouTube's adaptive mp4 streams
+# are fragmented with the moov box first, so neither needs seeking
+STREAMABLE_INPUTS = {'webm', 'mp4'}
+
+
+class FfmpegNotAvailableError(Exception):
+    pass
+
+
+class FfmpegError(Exception):
+    pass
+
+
+class FfmpegCapabilities:
+    def __init__(self, path, version, encoders, muxers, threads):
+        """
+        what the installed ffmpeg can do
+
+        :param path: path to the ffmpeg executable
+        :type path: str
+        :param version: version string, e.g. 6.1.1
+        :type version: str
+        :param encoders: names of available encoders
+        :type encoders: set[str]
+        :param muxers: names of available muxers (output formats)
+        :type muxers: set[str]
+        :param threads: number of threads ffmpeg can use
+        :type threads: int
+        """
+        self.path = path
+        self.version = version
+        self.encoders = set(encoders)
+        self.muxers = set(muxers)
+        self.threads = threads
+
+    @property
+    def version_tuple(self):
+        """
+        (major, minor) of a release build, None for builds from git
+
+        :rtype: tuple[int, int] or None
+        """
+        match = re.match(r'n?(\d+)\.(\d+)', self.version)
+        return (int(match.group(1)), int(match.group(2))) if match else None
+
+    def can_write(self, output_format):
+        """
+        check if ffmpeg has a muxer for output_format, unknown formats are assumed to be writable
+
+        :param output_format: e.g. mp4, mkv, mp3
+        :type output_format: str
+        :rtype: bool
+        """
+        return FORMAT_MUXERS.get(output_format, output_format) in self.muxers or output_format not in FORMAT_MUXERS
+
+    def pick_encoder(self, candidates):
+        """
+        first available encoder of candidates
+
+        :param candidates: encoder names in order of preference
+        :type candidates: list[str]
+        :return: encoder name, None if none of them is available
+        :rtype: str or None
+        """
+        for name in candidates:
+            if name in self.encoders:
+                return name
+        return None
+
+    def to_dict(self):
+        return {'path': self.path, 'version': self.version, 'encoders': sorted(self.encoders),
+                'muxers': sorted(self.muxers), 'threads': self.threads}
+
+    def __repr__(self):
+        return '<FfmpegCapabilities {} version={} threads={}>'.format(self.path, self.version, self.threads)
+
+
+_capabilities = None  # probe result of this process
+_capabilities_lock = threading.Lock()
+
+
+def ffmpeg_available():
+    """
+    check if ffmpeg is in PATH, without starting it
+
+    :rtype: bool
+    """
+    return shutil.which('ffmpeg') is not None
+
+
+def ffmpeg_capabilities():
+    """
+    probe the installed ffmpeg once. the result is kept for the rest of the process and cached on disk
+    for later runs, it is probed again only when the ffmpeg executable changes
+
+    :return: capabilities of ffmpeg
+    :rtype: FfmpegCapabilities
+    :raise FfmpegNotAvailableError: if ffmpeg is not in PATH
+    """
+    global _capabilities
+    with _capabilities_lock:
+        path = shutil.which('ffmpeg')
+        if path is None:
+            raise FfmpegNotAvailableError('ffmpeg not found. Cannot perform downloading.'
+                                          'Make sure ffmpeg is installed and added in PATH')
+        if _capabilities is not None and _capabilities.path == path:
+            return _capabilities
+        st = os.stat(path)
+        key = {'path': path, 'mtime': st.st_mtime, 'size': st.st_size}
+        probe_file = os.path.join(cache_dir(), FFMPEG_PROBE_FILE)
+        try:
+            with open(probe_file, encoding='utf-8') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            cached = None
+        if cached and cached.get('key') == key:
+            data = cached['capabilities']
+            _capabilities = FfmpegCapabilities(data['path'], data['version'], data['encoders'], data['muxers'],
+                                               data['threads'])
+        else:
+            _capabilities = _probe_ffmpeg(path)
+            try:
+                with open(probe_file, 'w', encoding='utf-8') as f:
+                    json.dump({'key': key, 'capabilities': _capabilities.to_dict()}, f)
+            except OSError:
+                pass
+        return _capabilities
+
+
+def _probe_ffmpeg(path):
+    def run(option):
+        return subprocess.run([path, '-hide_banner', option], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True).stdout
+
+    match = re.search(r'ffmpeg version (\S+)', run('-version'))
+    version = match.group(1) if match else 'unknown'
+    encoders = [name for flags, name in _parse_listing(run('-encoders')) if flags[0] in 'VAS']
+    muxers = []
+    for flags, names in _parse_listing(run('-muxers')):
+        if 'E' in flags:
+            muxers += names.split(',')
+    return FfmpegCapabilities(path, version, encoders, muxers, os.cpu_count() or 1)
+
+
+def _parse_listing(output):
+    """
+    parse the output of ffmpeg -encoders or -muxers: a legend, a line of dashes,
+    then one ' FLAGS name  description' line per entry
+
+    :return: list of (flags, name)
+    :rtype: list[tuple[str, str]]
+    """
+    entries = []
+    lines = output.splitlines()
+    for i, line in enumerate(lines):
+        if line.strip() and not line.strip('- '):
+            for entry in lines[i + 1:]:
+                parts = entry.split()
+                if len(parts) >= 2:
+                    entries.append((parts[0], parts[1]))
+            break
+    return entries
+
+
+class MuxPlan:
+    def __init__(self, container, path, video_codec, audio_codec, video_encoder=None, audio_encoder=None,
+                 ffmpeg='ffmpeg'):
+        """
+        how a video stream and an audio stream are combined into one file
+
+        :param container: output container e.g. mp4, mkv
+        :type container: str
+        :param path: one of REMUX, TRANSCODE_AUDIO, TRANSCODE
+        :type path: str
+        :param video_codec: normalized codec of the video stream
+        :type video_codec: str
+        :param audio_codec: normalized codec of the audio stream
+        :type audio_codec: str
+        :param video_encoder: encoder for re-encoding video, for TRANSCODE
+        :type video_encoder: str or None
+        :param audio_encoder: encoder for re-encoding audio, for TRANSCODE and TRANSCODE_AUDIO
+        :type audio_encoder: str or None
+        :param ffmpeg: path to the ffmpeg executable
+        :type ffmpeg: str
+        """
+        self.container = container
+        self.path = path
+        self.video_codec = video_codec
+        self.audio_codec = audio_codec
+        self.video_encoder = video_encoder
+        self.audio_encoder = audio_encoder
+        self.ffmpeg = ffmpeg
+
+    def codec_args(self):
+        """
+        ffmpeg output options for the chosen path
+
+        :return: list of ffmpeg arguments
+        :rtype: list[str]
+        """
+        if self.path == REMUX:
+            return ['-c', 'copy']
+        audio_args = ['-c:a', self.audio_encoder]
+        if self.path == TRANSCODE_AUDIO:
+            return ['-c:v', 'copy'] + audio_args
+        return ['-c:v', self.video_encoder, '-vsync', 'vfr'] + VIDEO_ENCODER_ARGS.get(self.video_encoder, []) + \
+            audio_args
+
+    def ffmpeg_command(self, video_path, audio_path, output_path, clip=None):
+        """
+        full ffmpeg command muxing video_path and audio_path into output_path
+
+        :param clip: (start, end) in seconds to cut out of the inputs, see clip_args
+        :type clip: tuple[float, float] or None
+        :return: ffmpeg command
+        :rtype: list[str]
+        """
+        input_args, output_args = clip_args(clip)
+        return [self.ffmpeg] + input_args + ['-i', video_path] + input_args + ['-i', audio_path] + \
+            ['-map', '0:v:0', '-map', '1:a:0'] + self.codec_args() + output_args + [output_path]
+
+    def __repr__(self):
+        return '{} {}+{} into {}'.format(self.path, self.video_codec, self.audio_codec, self.container)
+
+
+def popen_ffmpeg(command, on_progress=None, **kwargs):
+    """
+    start an ffmpeg command, report its progress if on_progress is given. ffmpeg reads nothing from the
+    terminal unless stdin is given, and never overwrites the output file (the last argument) unless the
+    command has -y, so a process cannot hang on ffmpeg's overwrite prompt
+
+    :param command: ffmpeg command
+    :type command: list[str]
+    :param on_progress: callback(dict) receiving each block of ffmpeg -progress output, from a reader thread
+    :type on_progress: callable or None
+    :param kwargs: passed to subprocess.Popen, e.g. stdin=subprocess.PIPE to feed ffmpeg
+    :return: ffmpeg process, with the reader thread as progress_reader if on_progress is given
+    :rtype: subprocess.Popen
+    :raise FfmpegError: if the output file exists
+    """
+    if '-y' not in command:
+        if os.path.exists(command[-1]):
+            raise FfmpegError('{} already exists'.format(command[-1]))
+        command = command[:1] + ['-n'] + command[1:]
+    kwargs.setdefault('stdin', subprocess.DEVNULL)
+    if on_progress is None:
+        return subprocess.Popen(command, **kwargs)
+    process = subprocess.Popen(progress_command(command), stdout=subprocess.PIPE, **kwargs)
+    reader = FfmpegProgressReader(on_progress)
+    lines = io.TextIOWrapper(process.stdout, encoding='utf-8', errors='replace')
+    process.progress_reader = threading.Thread(target=reader.read, args=(lines,), daemon=True)
+    process.progress_reader.start()
+    return process
+
+
+def progress_command(command):
+    """
+    ffmpeg command writing progress to stdout
+
+    :param command: ffmpeg command
+    :type command: list[str]
+    :rtype: list[str]
+    """
+    return command[:1] + ['-progress', 'pipe:1'] + command[1:]
+
+
+class FfmpegProgressReader:
+    def __init__(self, on_progress):
+        """
+        parse ffmpeg -progress output, blocks of key=value lines each ending with a progress= line
+
+        :param on_progress: callback(dict) receiving each block
+        :type on_progress: callable
+        """
+        self.on_progress = on_progress
+        self.block = {}
+
+    def read(self, lines):
+        """
+        :param lines: lines of the output, e.g. ffmpeg's stdout
+        :type lines: iterable[str]
+        """
+        for line in lines:
+            self.feed(line)
+
+    def feed(self, line):
+        """
+        :param line: a line of the output
+        :type line: str
+        """
+        key, sep, value = line.strip().partition('=')
+        if not sep:
+            return
+        self.block[key.strip()] = value.strip()
+        if key == 'progress':
+            self.on_progress(self.block)
+            self.block = {}
+
+
+def run_ffmpeg(command, on_progress=None):
+    """
+    run an ffmpeg command to completion
+
+    :param command: ffmpeg command
+    :type command: list[str]
+    :param on_progress: callback(dict) receiving each block of ffmpeg -progress output
+    :type on_progress: callable or None
+    :return: None
+    :raise FfmpegError: if ffmpeg fails
+    """
+    process = popen_ffmpeg(command, on_progress=on_progress)
+    returncode = process.wait()
+    if on_progress is not None:
+        process.progress_reader.join()
+    if returncode != 0:
+        raise FfmpegError('ffmpeg exited with code {}'.format(returncode))
+
+
+def media_duration(path, capabilities=None):
+    """
+    duration of a media file as reported by ffmpeg
+
+    :param path: path to the file
+    :type path: str
+    :param capabilities: capabilities of ffmpeg, probed if None
+    :type capabilities: FfmpegCapabilities or None
+    :return: duration in seconds, None if ffmpeg cannot tell
+    :rtype: float or None
+    """
+    capabilities = capabilities if capabilities is not None else ffmpeg_capabilities()
+    # without an output ffmpeg only prints the input info and exits with an error
+    result = subprocess.run([capabilities.path, '-hide_banner', '-i', path], stdin=subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    match = re.search(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', result.stderr)
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def can_stream_input(subtype):
+    """
+    check if ffmpeg can read a stream of this type from a pipe
+
+    :param subtype: stream subtype, e.g. mp4 or webm
+    :type subtype: str
+    :rtype: bool
+    """
+    return subtype in STREAMABLE_INPUTS
+
+
+def normalize_codec(codec):
+    """
+    strip profile details from a codec string, e.g. avc1.640028 -> avc1, vp9 -> vp09
+
+    :param codec: codec string reported by pytube
+    :type codec: str or None
+    :return: normalized codec name
+    :rtype: str or None
+    """
+    if not codec:
+        return None
+    name = codec.split('.')[0].lower()
+    return {'vp9': 'vp09', 'vp8': 'vp08'}.get(name, name)
+
+
+def container_accepts(container, video_codec=None, audio_codec=None, capabilities=None):
+    """
+    check if container can hold the given codecs by stream copy
+
+    :param container: container name e.g. mp4
+    :type container: str
+    :param video_codec: normalized video codec, not checked if None
+    :type video_codec: str or None
+    :param audio_codec: normalized audio codec, not checked if None
+    :type audio_codec: str or None
+    :param capabilities: capabilities of the ffmpeg doing the muxing, assume a recent ffmpeg if None
+    :type capabilities: FfmpegCapabilities or None
+    :rtype: bool
+    """
+    video_codecs, audio_codecs = CONTAINER_CODECS.get(container, (set(), set()))
+    if container == 'mp4' and audio_codec == 'opus' and capabilities is not None:
+        version = capabilities.version_tuple
+        if version is not None and version < OPUS_IN_MP4_VERSION:
+            return False
+    video_ok = video_codec is None or video_codecs is None or video_codec in video_codecs
+    audio_ok = audio_codec is None or audio_codecs is None or audio_codec in audio_codecs
+    return video_ok and audio_ok
+
+
+def plan_mux(video_codec, audio_codec, container='mp4', capabilities=None, reencode=False):
+    """
+    choose the cheapest way to combine the streams: stream copy when the container allows it,
+    re-encoding only the streams that the container cannot hold
+
+    :param video_codec: codec of the video stream, e.g. avc1.640028 or vp9
+    :type video_codec: str
+    :param audio_codec: codec of the audio stream, e.g. mp4a.40.2 or opus
+    :type audio_codec: str
+    :param container: output container, or None to pick mp4 or mkv, whichever allows a stream copy
+    :type container: str or None
+    :param capabilities: capabilities of ffmpeg, probed if None
+    :type capabilities: FfmpegCapabilities or None
+    :param reencode: re-encode both streams even if the container can hold them, e.g. to cut a clip
+                     between keyframes
+    :type reencode: bool
+    :return: mux plan
+    :rtype: MuxPlan
+    :raise FfmpegNotAvailableError: if ffmpeg is missing or has no encoder for a stream that must be re-encoded
+    """
+    capabilities = capabilities if capabilities is not None else ffmpeg_capabilities()
+    video_codec = normalize_codec(video_codec)
+    audio_codec = normalize_codec(audio_codec)
+    if container is None:
+        copy_into_mp4 = container_accepts('mp4', video_codec, audio_codec, capabilities)
+        container = 'mp4' if copy_into_mp4 or not capabilities.can_write('mkv') else 'mkv'
+    if container not in CONTAINER_CODECS:
+        raise ValueError("unsupported container {}".format(container))
+    if not capabilities.can_write(container):
+        raise FfmpegNotAvailableError('ffmpeg cannot write {}'.format(container))
+    video_encoder = audio_encoder = None
+    if not reencode and container_accepts(container, video_codec, audio_codec, capabilities):
+        path = REMUX
+    else:
+        audio_encoder = capabilities.pick_encoder(AUDIO_ENCODERS[container])
+        if not reencode and container_accepts(container, video_codec=video_codec, capabilities=capabilities):
+            path = TRANSCODE_AUDIO
+        else:
+            path = TRANSCODE
+            video_encoder = capabilities.pick_encoder(VIDEO_ENCODERS[container])
+            if video_encoder is None:
+                raise FfmpegNotAvailableError('ffmpeg has no video encoder for {}'.format(container))
+        if audio_encoder is None:
+            raise FfmpegNotAvailableError('ffmpeg has no audio encoder for {}'.format(container))
+    return MuxPlan(container, path, video_codec, audio_codec, video_encoder, audio_encoder, capabilities.path)
+
+
+def audio_convert_path(audio_codec, audio_format):
+    """
+    how audio of a codec is converted to audio_format
+
+    :param audio_codec: codec of the audio, e.g. mp4a.40.2 or opus
+    :type audio_codec: str or None
+    :param audio_format: target format without dot, e.g. m4a
+    :type audio_format: str
+    :return: REMUX if the audio can be stream copied, otherwise TRANSCODE
+    :rtype: str
+    """
+    return REMUX if normalize_codec(audio_codec) in AUDIO_FORMAT_CODECS.get(audio_format, ()) else TRANSCODE
+
+
+def audio_convert_command(input_path, output_path, audio_format, capabilities=None, threads=None, audio_codec=None,
+                          clip=None):
+    """
+    ffmpeg command converting an audio file to audio_format, by stream copy if audio_format can hold
+    audio_codec
+
+    :param input_path: path to the source audio
+    :type input_path: str
+    :param output_path: path to the converted audio
+    :type output_path: str
+    :param audio_format: target format without dot, e.g. mp3
+    :type audio_format: str
+    :param capabilities: capabilities of ffmpeg, probed if None
+    :type capabilities: FfmpegCapabilities or None
+    :param threads: maximum number of threads of the conversion, ffmpeg decides if None
+    :type threads: int or None
+    :param audio_codec: codec of the source audio, always re-encoded if None
+    :type audio_codec: str or None
+    :param clip: (start, end) in seconds to cut out of the source, see clip_args
+    :type clip: tuple[float, float] or None
+    :return: ffmpeg command
+    :rtype: list[str]
+    :raise FfmpegNotAvailableError: if ffmpeg is missing or has no encoder for audio_format
+    """
+    capabilities = capabilities if capabilities is not None else ffmpeg_capabilities()
+    if not capabilities.can_write(audio_format):
+        raise FfmpegNotAvailableError('ffmpeg cannot write {}'.format(audio_format))
+    input_args, output_args = clip_args(clip)
+    command = [capabilities.path] + input_args + ['-i', input_path]
+    if audio_convert_path(audio_codec, audio_format) == REMUX:
+        return command + ['-vn', '-c:a', 'copy'] + output_args + [output_path]
+    thread_args = ['-threads', str(threads)] if threads else []
+    encoders = AUDIO_ENCODERS.get(audio_format)
+    if encoders is None:
+        # unknown format, let ffmpeg choose the encoder
+        return command + thread_args + output_args + [output_path]
+    encoder = capabilities.pick_encoder(encoders)
+    if encoder is None:
+        raise FfmpegNotAvailableError('ffmpeg has no encoder for {}'.format(audio_format))
+    return command + ['-vn', '-c:a', encoder] + thread_args + output_args + [output_path]
+
+
+def cut_command(input_path, output_path, clip, capabilities=None):
+    """
+    ffmpeg command cutting a time range out of a media file by stream copy, it starts at the keyframe
+    before the start of the range
+
+    :param input_path: path to the source
+    :type input_path: str
+    :param output_path: path to the cut, of the same format as the source
+    :type output_path: str
+    :param clip: (start, end) in seconds, see clip_args
+    :type clip: tuple[float, float]
+    :param capabilities: capabilities of ffmpeg, probed if None
+    :type capabilities: FfmpegCapabilities or None
+    :return: ffmpeg command
+    :rtype: list[str]
+    """
+    capabilities = capabilities if capabilities is not None else ffmpeg_capabilities()
+    input_args, output_args = clip_args(clip)
+    return [capabilities.path] + input_args + ['-i', input_path, '-map', '0', '-c', 'copy'] + output_args + \
+        [output_path]
+
+
+def clip_args(clip):
+    """
+    ffmpeg options cutting a time range: input options seeking to its start and output options limiting
+    the duration. the start is a timestamp of the input rather than an offset from its first frame, so
+    a clip downloaded by byte range, which keeps the timestamps of the whole stream, cuts the same way
+    as the whole stream
+
+    :param clip: (start, end) in seconds, None for no cut
+    :type clip: tuple[float, float] or None
+    :return: (input options, output options)
+    :rtype: tuple[list[str], list[str]]
+    """
+    if clip is None:
+        return [], []
+    start, end = clip
+    return ['-seek_timestamp', '1', '-ss', '{:.3f}'.format(start)], ['-t', '{:.3f}'.format(end - start)]
@@ -2,7 +2,18 @@ import argparse
 import os
 import errno
 import sys
-from helper import YouTubeHelper
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from bandwidth import BandwidthScheduler
+from cache import DownloadArchive
+from clips import parse_timestamp, time_label
+from helper import YouTubeHelper, StageLimits, Output, print_progress
+from pytube import Playlist, Channel, extract
+from stats import Instrumentation, JsonLinesSink
+from streams import parse_quality_label
+from transcode import TranscodeScheduler
+from transfer import DEFAULT_CONNECTIONS
+from transport import Transport, set_default_transport, DEFAULT_MAX_PER_HOST, DEFAULT_CHUNK_SIZE
 
 
 def is_pathname_valid(pathname: str) -> bool:
@@ -73,95 +84,413 @@ def is_pathname_valid(pathname: str) -> bool:
         return True
 
 
-parser = argparse.ArgumentParser()
-parser.add_argument('url', help="url of video")
-parser.add_argument('--folder', '-f', help="folder for saving downloaded video and audio")
-parser.add_argument('--quality', '-q',
-                    help="quality of video/audio, must be in the format of 1080p60/360p(for video) or 128(for audio)")
-parser.add_argument('--info', '-i', action='store_true', help="show video info")
-parser.add_argument('--audio', '-a', action='store_true', help="download audio only")
-parser.add_argument('-aformat', choices=['mp3', 'm4a', 'webm', 'wav'], help="choose audio format")
+def parse_quality(quality):
+    """
+    check the format of argument quality
+
+    :param quality: quality in the format of 1080p60/360p(for video) or 128(for audio)
+    :type quality: str
+    :return: quality as str for video, int for audio, or None if the format is incorrect
+    :rtype: str or int or None
+    """
+    # it may refer to video quality
+    if 'p' in quality:
+        try:
+            parse_quality_label(quality)
+        except ValueError:
+            return None
+        return quality
+    # it may refer to audio quality, check if it only contain number
+    for x in quality:
+        if not x.isdigit():
+            return None
+    return int(quality)  # audio quality in integer
 
-args = parser.parse_args()
 
-# processed directory for downloading to be passed to YouTubeHelper method, default to be current directory
-target_dir = None
-# processed video/audio quality to be passed to YouTubeHelper method
-quality = None
+def parse_rate(rate):
+    """
+    parse a byte rate such as 500K or 2M
+
+    :param rate: bytes per second, optionally with suffix K, M or G (powers of 1024)
+    :type rate: str
+    :return: bytes per second
+    :rtype: int
+    :raise argparse.ArgumentTypeError: if the format is incorrect
+    """
+    try:
+        return parse_size(rate)
+    except argparse.ArgumentTypeError:
+        raise argparse.ArgumentTypeError("rate should be a positive number of bytes per second, e.g. 500K or 2M")
 
-if args.info:
-    # print video info and leave
-    YouTubeHelper(args.url).dump_info()
-    sys.exit()
 
-downloader = YouTubeHelper(args.url)
+def parse_size(size):
+    """
+    parse a number of bytes such as 64K or 1M
 
-# parse argument quality
-if args.quality:
-    quality = args.quality
-    p_index = quality.find('p')
-    # it may refer to video quality
-    if p_index != -1:
-        # check left of p and right of p are both int
-        left = quality[:p_index]
-        right = quality[p_index + 1:]
-        for x in left:
-            if not x.isdigit():
-                print("[ERROR: incorrect format of argument quality]")
-                parser.print_help()
-                sys.exit()
-        for x in right:
-            if not x.isdigit():
-                print("[ERROR: incorrect format of argument quality]")
-                parser.print_help()
-                sys.exit()
-    # it may refer to audio quality, check if it only contain number
-    else:
-        for x in quality:
-            if not x.isdigit():
-                print("[ERROR: incorrect format of argument quality]")
-                parser.print_help()
-                sys.exit()
-        quality = int(quality)  # audio quality in integer
-
-# parse argument folder
-if args.folder:
-    folder_path = args.folder
+    :param size: bytes, optionally with suffix K, M or G (powers of 1024)
+    :type size: str
+    :return: bytes
+    :rtype: int
+    :raise argparse.ArgumentTypeError: if the format is incorrect
+    """
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    number, unit = (size[:-1], units[size[-1].upper()]) if size and size[-1].upper() in units else (size, 1)
+    try:
+        value = float(number) * unit
+    except ValueError:
+        raise argparse.ArgumentTypeError("size should be a number of bytes, e.g. 64K or 1M")
+    if value < 1:
+        raise argparse.ArgumentTypeError("size should be positive")
+    return int(value)
+
+
+def parse_time(text):
+    """
+    parse a time in the video such as 90, 1:30 or 1:02:03.5
+
+    :type text: str
+    :return: seconds
+    :rtype: float
+    :raise argparse.ArgumentTypeError: if the format is incorrect
+    """
+    try:
+        return parse_timestamp(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def prepare_folder(folder_path):
+    """
+    validate the folder for downloading and create it if necessary
+
+    :param folder_path: folder given by the user
+    :type folder_path: str
+    :return: directory for downloading, None for current directory
+    :rtype: str or None
+    """
     target_dir = folder_path  # directory of the path (assume path is valid)
     # check validity of path
     if not is_pathname_valid(folder_path):
         print("{} is not a valid path, download to current directory instead".format(folder_path))
-        target_dir = None
+        return None
     # if path is valid, extract the directory part
+    dir_part, tail = os.path.split(target_dir)
+    if '.' not in tail or ('.' in tail and tail[0] != '.'):
+        target_dir = os.path.normpath(os.path.join(dir_part, tail))
     else:
-        dir_part, tail = os.path.split(target_dir)
-        if '.' not in tail or ('.' in tail and tail[0] != '.'):
-            target_dir = os.path.normpath(os.path.join(dir_part, tail))
+        target_dir = dir_part
+    # check if the directory exists, if not, try to make one
+    if not os.path.isdir(target_dir):
+        try:
+            os.mkdir(target_dir)
+        except (PermissionError, OSError) as e:
+            print(e)
+            print("[Error occur when creating directory {}. Download to current working directory instead]".format(
+                target_dir))
+            target_dir = None
+    return target_dir
+
+
+def expand_urls(urls, url_file=None):
+    """
+    collect video urls from the command line and url file, playlist and channel urls are expanded to their videos
+
+    :param urls: urls given on the command line
+    :type urls: list[str]
+    :param url_file: path to a file with one url per line, lines starting with # are ignored
+    :type url_file: str or None
+    :return: video urls in the given order without duplicates
+    :rtype: list[str]
+    """
+    urls = list(urls)
+    if url_file:
+        with open(url_file, encoding='utf-8') as f:
+            urls += [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+    video_urls = []
+    for url in urls:
+        if '/channel/' in url or '/c/' in url or '/user/' in url or '/@' in url:
+            print("[Listing videos of channel {}...]".format(url))
+            video_urls += list(Channel(url).video_urls)
+        elif 'list=' in url and 'watch?' not in url:
+            print("[Listing videos of playlist {}...]".format(url))
+            video_urls += list(Playlist(url).video_urls)
         else:
-            target_dir = dir_part
-        # check if the directory exists, if not, try to make one
-        if not os.path.isdir(target_dir):
-            try:
-                os.mkdir(target_dir)
-            except (PermissionError, OSError) as e:
-                print(e)
-                print("[Error occur when creating directory {}. Download to current working directory instead]".format(
-                    target_dir))
-                target_dir = None
-
-if args.audio:
-    # download audio
-    if not isinstance(quality, int) and quality is not None:
-        raise TypeError("audio quality should be a positive integer")
-    downloader.get_audio(myfolder=target_dir, quality=quality, audio_format=args.aformat)
-else:
-    # download video
-    if quality is None:
-        downloader.auto_download(myfolder=target_dir)
-    elif isinstance(quality, str):
-        i = quality.find('p')
-        res = quality[:i]
-        fps = int(quality[i + 1:]) if quality[i + 1:] else None
-        downloader.get_video(res, fps=fps, myfolder=target_dir)
+            video_urls.append(url)
+    return list(dict.fromkeys(video_urls))
+
+
+def archive_variant(args, quality, container):
+    """
+    key of a download in the archive, e.g. video:1080p60:mp4 or audio:best:mp3, followed by the time range
+    of a clip, e.g. video:best:mp4:1m30s-2m, and the files made alongside a video, e.g. video:best:mp4:+mp3+thumbnail
+
+    :return: variant, None if nothing is downloaded
+    :rtype: str or None
+    """
+    if args.info:
+        return None
+    if args.thumbnail:
+        return 'thumbnail'
+    if args.audio:
+        variant = 'audio:{}:{}'.format(quality or 'best', args.aformat or 'native')
+    else:
+        variant = 'video:{}:{}'.format(quality or 'best', container or 'auto')
+    if args.start is not None or args.end is not None:
+        # an open end is recorded as such, the length of the video is not known before its metadata
+        variant += ':{}-{}'.format(time_label(args.start or 0), time_label(args.end) if args.end is not None else 'end')
+        if args.precise and not args.audio:
+            variant += ':precise'
+    if args.also and not args.audio:
+        variant += ':+' + '+'.join(args.also)
+    return variant
+
+
+def process_url(url, args, quality, target_dir, container, limits, label_progress=False, instrumentation=None,
+                transcoder=None, bandwidth=None, archive=None):
+    """
+    show info of, or download video/audio from one url according to the command line arguments
+
+    :param url: url of the video
+    :type url: str
+    :param label_progress: prefix progress output with the video url, used when several videos run at once
+    :type label_progress: bool
+    :param instrumentation: receives timing and throughput events
+    :type instrumentation: stats.Instrumentation or None
+    :param transcoder: queue for audio format conversions, audio is converted before returning if None
+    :type transcoder: transcode.TranscodeScheduler or None
+    :param bandwidth: rate limits shared by every download
+    :type bandwidth: bandwidth.BandwidthScheduler or None
+    :param archive: finished downloads, the url is skipped if it is in the archive and recorded when done
+    :type archive: cache.DownloadArchive or None
+    :return: future of the converted audio if its conversion was queued on transcoder, otherwise None
+    :rtype: concurrent.futures.Future or None
+    """
+    variant = archive_variant(args, quality, container) if archive is not None else None
+    if variant:
+        # checked before anything is fetched, so a re-run over finished urls costs no requests
+        video_id = extract.video_id(url)
+        path = archive.get(video_id, variant, verify=args.verify_archive)
+        if path is not None:
+            print("[Skipping {}: already downloaded to {}]".format(url, path))
+            return None
+    instrumentation = instrumentation if instrumentation is not None else Instrumentation()
+    with instrumentation.stage('job', url=url):
+        downloader, result, output_path = _process_url(url, args, quality, target_dir, container, limits,
+                                                       label_progress, instrumentation, transcoder, bandwidth)
+    for path in downloader.outputs:
+        instrumentation.emit('output', url=url, path=os.path.abspath(path))
+    if variant and downloader.outputs:
+        output_path = output_path or downloader.outputs[-1]
+        if result is None:
+            archive.add(video_id, variant, output_path)
+        else:
+            # the conversion is still queued, record the file once it exists
+            def record(future):
+                if future.exception() is None:
+                    archive.add(video_id, variant, output_path)
+            result.add_done_callback(record)
+    return result
+
+
+def _process_url(url, args, quality, target_dir, container, limits, label_progress, instrumentation, transcoder,
+                 bandwidth):
+    """
+    :return: the helper, the future of a queued audio conversion or None, and the path of the primary output
+             if it is not the last one of the helper's outputs, else None
+    :rtype: tuple
+    """
+    on_progress = None
+    if label_progress:
+        def on_progress(label, bytes_done, total):
+            print_progress('{} {}'.format(url, label), bytes_done, total)
+    transcode_workers = args.mux_jobs if args.parallel_transcode else None
+    # metadata fetch is network bound, share the download limit with stream downloads
+    with limits.download:
+        downloader = YouTubeHelper(url, on_progress=on_progress, connections=args.connections, limits=limits,
+                                   streaming=args.streaming, instrumentation=instrumentation, transcoder=transcoder,
+                                   bandwidth=bandwidth, transcode_workers=transcode_workers)
+    if args.info:
+        downloader.get_info()
+    elif args.thumbnail:
+        downloader.get_thumbnail(target_dir)
+    elif args.audio:
+        # download audio
+        if not isinstance(quality, int) and quality is not None:
+            raise TypeError("audio quality should be a positive integer")
+        return downloader, downloader.get_audio(myfolder=target_dir, quality=quality, audio_format=args.aformat,
+                                                start=args.start, end=args.end), None
+    elif args.also:
+        # video, audio renditions and thumbnail out of one fetch of the streams
+        if quality is not None and not isinstance(quality, str):
+            raise TypeError("video quality should be in form of 1080p60/360p, etc.")
+        outputs = [Output('video', quality, container=container)]
+        outputs += [Output('thumbnail') if kind == 'thumbnail' else Output('audio', audio_format=kind)
+                    for kind in args.also]
+        # the video is the primary output recorded in the archive, not the last rendition written
+        paths = downloader.get_outputs(outputs, myfolder=target_dir, start=args.start, end=args.end,
+                                       precise=args.precise)
+        return downloader, None, paths[0]
     else:
-        raise TypeError("video quality should be in form of 1080p60/360p, etc.")
+        # download video
+        if quality is None:
+            downloader.auto_download(myfolder=target_dir, container=container, start=args.start, end=args.end,
+                                     precise=args.precise)
+        elif isinstance(quality, str):
+            # a quality label such as 1080p60 selects both resolution and frame rate
+            downloader.get_video(quality, myfolder=target_dir, container=container, start=args.start, end=args.end,
+                                 precise=args.precise)
+        else:
+            raise TypeError("video quality should be in form of 1080p60/360p, etc.")
+    return downloader, None, None
+
+
+def run_batch(urls, args, quality, target_dir, container, instrumentation=None):
+    """
+    process urls on a bounded pool of workers, keep going when one of them fails and print a summary
+
+    :param urls: video urls
+    :type urls: list[str]
+    :param instrumentation: receives timing and throughput events of every video
+    :type instrumentation: stats.Instrumentation or None
+    :return: list of (url, exception) that failed
+    :rtype: list[tuple[str, Exception]]
+    """
+    limits = StageLimits(downloads=args.jobs, muxes=args.mux_jobs)
+    bandwidth = BandwidthScheduler(rate=args.limit_rate, job_rate=args.job_limit_rate) \
+        if args.limit_rate or args.job_limit_rate else None
+    archive = DownloadArchive(args.archive or None) if args.archive is not None else None
+    if len(urls) == 1:
+        process_url(urls[0], args, quality, target_dir, container, limits, instrumentation=instrumentation,
+                    bandwidth=bandwidth, archive=archive)
+        return []
+    failures = []
+    conversions = []  # (url, future) of queued audio conversions
+    lock = threading.Lock()
+    # audio conversions run on their own pool of ffmpeg processes, overlapping with the next downloads
+    transcoder = TranscodeScheduler(workers=args.mux_jobs) if args.audio and args.aformat else None
+
+    def run(index, url):
+        print("[{}/{}: {}]".format(index + 1, len(urls), url))
+        try:
+            conversion = process_url(url, args, quality, target_dir, container, limits, label_progress=True,
+                                     instrumentation=instrumentation, transcoder=transcoder, bandwidth=bandwidth,
+                                     archive=archive)
+        except Exception as e:
+            print("[ERROR: {} failed: {}]".format(url, e))
+            with lock:
+                failures.append((url, e))
+        else:
+            if conversion is not None:
+                with lock:
+                    conversions.append((url, conversion))
+
+    # enough workers to keep every download and mux slot busy, the stage limits do the actual bounding
+    with ThreadPoolExecutor(max_workers=args.jobs + args.mux_jobs) as executor:
+        for index, url in enumerate(urls):
+            executor.submit(run, index, url)
+    if transcoder is not None:
+        transcoder.shutdown()
+        for url, conversion in conversions:
+            if conversion.exception() is not None:
+                print("[ERROR: {} failed: {}]".format(url, conversion.exception()))
+                failures.append((url, conversion.exception()))
+    print("[Summary: {} succeeded, {} failed]".format(len(urls) - len(failures), len(failures)))
+    for url, e in failures:
+        print("  {}: {}".format(url, e))
+    return failures
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('url', nargs='*', help="urls of videos, playlists or channels")
+parser.add_argument('--url-file', '-u', help="file with one url per line")
+parser.add_argument('--folder', '-f', help="folder for saving downloaded video and audio")
+parser.add_argument('--quality', '-q',
+                    help="quality of video/audio, must be in the format of 1080p60/360p(for video) or 128(for audio)")
+parser.add_argument('--info', '-i', action='store_true', help="show video info")
+parser.add_argument('--audio', '-a', action='store_true', help="download audio only")
+parser.add_argument('--thumbnail', '-t', action='store_true', help="download the thumbnail only")
+parser.add_argument('-aformat', choices=['mp3', 'm4a', 'webm', 'wav'], help="choose audio format")
+parser.add_argument('--container', choices=['mp4', 'mkv', 'webm', 'auto'], default='mp4',
+                    help="container of downloaded video, auto picks mp4 or mkv, whichever avoids re-encoding")
+parser.add_argument('--connections', '-c', type=int, default=DEFAULT_CONNECTIONS,
+                    help="number of parallel connections used to download each stream")
+parser.add_argument('--jobs', '-j', type=int, default=4, help="number of videos downloading at the same time")
+parser.add_argument('--mux-jobs', type=int, default=os.cpu_count() or 1,
+                    help="number of ffmpeg mux/transcode processes running at the same time")
+parser.add_argument('--parallel-transcode', action='store_true',
+                    help="when video has to be re-encoded, encode segments of it on --mux-jobs processes at once")
+parser.add_argument('--limit-rate', type=parse_rate, metavar='RATE',
+                    help="total download rate in bytes per second e.g. 2M, audio goes before video above 1440p")
+parser.add_argument('--job-limit-rate', type=parse_rate, metavar='RATE',
+                    help="download rate of each stream in bytes per second e.g. 500K")
+parser.add_argument('--archive', nargs='?', const='', metavar='FILE',
+                    help="skip videos already downloaded with the same quality and format, and record new ones "
+                         "in FILE (an SQLite database, default in the cache directory)")
+parser.add_argument('--verify-archive', action='store_true',
+                    help="with --archive, download again if the recorded file is missing or has changed size")
+parser.add_argument('--start', type=parse_time, metavar='TIME',
+                    help="download a clip starting at TIME e.g. 90 or 1:30, only the part of the streams it needs "
+                         "is fetched")
+parser.add_argument('--end', type=parse_time, metavar='TIME', help="download a clip ending at TIME e.g. 2:15")
+parser.add_argument('--precise', action='store_true',
+                    help="re-encode a clip so it starts exactly at --start instead of the keyframe before it")
+parser.add_argument('--also', action='append', choices=['mp3', 'm4a', 'webm', 'wav', 'thumbnail'],
+                    help="with a video, also save its audio in this format or its thumbnail, every stream is "
+                         "downloaded once, can be repeated")
+parser.add_argument('--streaming', action='store_true',
+                    help="pipe downloads straight into ffmpeg without temporary files, cannot be resumed")
+parser.add_argument('--host-connections', type=int, default=DEFAULT_MAX_PER_HOST, metavar='N',
+                    help="connections open to one host at a time, idle ones are kept for the next request "
+                         "(default %(default)s)")
+parser.add_argument('--chunk-size', type=parse_size, default=DEFAULT_CHUNK_SIZE, metavar='SIZE',
+                    help="bytes read from a connection at a time e.g. 256K (default 64K)")
+parser.add_argument('--stats', metavar='FILE',
+                    help="append timing and throughput of every stage to FILE as JSON lines, - for stdout")
+parser.add_argument('--remote', nargs='?', const='', metavar='ADDRESS',
+                    help="run the job in a daemon started with daemon.py (default 127.0.0.1:8765) "
+                         "and print its events as JSON lines")
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if not args.url and not args.url_file:
+        print("[ERROR: no url given]")
+        parser.print_help()
+        sys.exit(2)
+
+    if args.remote is not None:
+        import daemon
+        try:
+            job = daemon.submit_remote(sys.argv[1:], address=args.remote or daemon.DEFAULT_ADDRESS)
+        except (ValueError, OSError) as e:
+            print("[ERROR: {}]".format(e))
+            sys.exit(2)
+        print("[Summary: job {} {}, {} failed]".format(job['id'], job['status'], len(job['failures'])))
+        sys.exit(1 if job['failures'] else 0)
+
+    # processed directory for downloading to be passed to YouTubeHelper method, default to be current directory
+    target_dir = prepare_folder(args.folder) if args.folder else None
+    # processed video/audio quality to be passed to YouTubeHelper method
+    quality = None
+    # container of downloaded video, None lets YouTubeHelper choose
+    container = None if args.container == 'auto' else args.container
+
+    # parse argument quality
+    if args.quality:
+        quality = parse_quality(args.quality)
+        if quality is None:
+            print("[ERROR: incorrect format of argument quality]")
+            parser.print_help()
+            sys.exit()
+
+    instrumentation = Instrumentation()
+    if args.stats:
+        stats_file = sys.stdout if args.stats == '-' else open(args.stats, 'a', encoding='utf-8')
+        instrumentation.add_sink(JsonLinesSink(stats_file))
+    # every request of the batch, pytube's included, shares these connections
+    transport = Transport(max_per_host=args.host_connections, chunk_size=args.chunk_size)
+    set_default_transport(transport)
+
+    failed = run_batch(expand_urls(args.url, args.url_file), args, quality, target_dir, container,
+                       instrumentation=instrumentation)
+    instrumentation.emit('transport', **transport.statistics())
+    sys.exit(1 if failed else 0)
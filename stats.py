@@ -0,0 +1,157 @@
+import contextlib
+import json
+import sys
+import threading
+import time
+from collections import deque
+
+PROGRESS_INTERVAL = 0.5  # seconds between progress events of one transfer
+THROUGHPUT_WINDOW = 2.0  # seconds of samples used for instantaneous throughput
+
+
+class Instrumentation:
+    def __init__(self, sinks=None, **fields):
+        """
+        timing and throughput events of the download pipeline. every event is a dict with at least
+        'event' and 'time' (unix time) and is passed to every sink, e.g. JsonLinesSink
+
+        events:
+          stage_start  a stage (metadata, download, mux, convert, ...) started
+          stage_end    a stage ended, with 'duration' in seconds, 'ok', and for transfers 'bytes' and
+                       'throughput' (average bytes per second)
+          progress     bytes of a transfer so far, with 'throughput' over the last seconds and 'average'
+          ffmpeg       progress reported by ffmpeg -progress, e.g. 'out_time_us', 'speed', 'total_size'
+          output       a file was written, with 'path'
+          transport    connection reuse of a batch, see transport.Transport.statistics
+
+        :param sinks: callables receiving each event, nothing is measured if there are none
+        :type sinks: list[callable] or None
+        :param fields: fields added to every event, e.g. video_id
+        """
+        self.sinks = sinks if sinks is not None else []
+        self.fields = fields
+
+    def add_sink(self, sink):
+        """
+        :param sink: callable receiving each event
+        :type sink: callable
+        """
+        self.sinks.append(sink)
+
+    def bind(self, **fields):
+        """
+        instrumentation sharing the sinks of this one, adding fields to every event
+
+        :rtype: Instrumentation
+        """
+        return Instrumentation(self.sinks, **dict(self.fields, **fields))
+
+    @property
+    def enabled(self):
+        return bool(self.sinks)
+
+    def emit(self, event, **fields):
+        """
+        send an event to every sink
+
+        :param event: name of the event
+        :type event: str
+        :param fields: fields of the event
+        """
+        if not self.sinks:
+            return
+        record = dict(self.fields, event=event, time=time.time(), **fields)
+        for sink in self.sinks:
+            sink(record)
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        """
+        time a stage, the stage_end event is emitted even if the stage fails
+
+        :param name: name of the stage
+        :type name: str
+        :param fields: fields added to both events, e.g. label or itag
+        :return: a TransferMeter for the bytes moved in the stage
+        :rtype: TransferMeter
+        """
+        meter = TransferMeter(self, name, fields)
+        self.emit('stage_start', stage=name, **fields)
+        ok = False
+        try:
+            yield meter
+            ok = True
+        finally:
+            duration = time.monotonic() - meter.started
+            end = dict(fields, duration=round(duration, 6), ok=ok)
+            if meter.bytes_done:
+                end.update(bytes=meter.bytes_done, throughput=round(meter.bytes_done / duration if duration else 0))
+            self.emit('stage_end', stage=name, **end)
+
+
+class TransferMeter:
+    def __init__(self, instrumentation, stage, fields):
+        """
+        measures bytes moved in a stage and emits throttled progress events
+        """
+        self.instrumentation = instrumentation
+        self.stage = stage
+        self.fields = fields
+        self.started = time.monotonic()
+        self.bytes_done = 0
+        self.samples = deque()  # (time, bytes_done) within THROUGHPUT_WINDOW
+        self.last_event = 0
+        self.lock = threading.Lock()
+
+    def update(self, bytes_done, total=None):
+        """
+        record the number of bytes moved so far, a progress callback of the downloaders
+
+        :param bytes_done: bytes moved since the stage started
+        :type bytes_done: int
+        :param total: expected number of bytes, None if unknown
+        :type total: int or None
+        """
+        if not self.instrumentation.enabled:
+            return
+        now = time.monotonic()
+        with self.lock:
+            self.bytes_done = bytes_done
+            self.samples.append((now, bytes_done))
+            while now - self.samples[0][0] > THROUGHPUT_WINDOW:
+                self.samples.popleft()
+            if now - self.last_event < PROGRESS_INTERVAL and bytes_done != total:
+                return
+            self.last_event = now
+            first_time, first_bytes = self.samples[0]
+        throughput = (bytes_done - first_bytes) / (now - first_time) if now > first_time else 0
+        average = bytes_done / (now - self.started) if now > self.started else 0
+        self.instrumentation.emit('progress', stage=self.stage, bytes=bytes_done, total=total,
+                                  throughput=round(throughput), average=round(average), **self.fields)
+
+    def ffmpeg_progress(self, progress):
+        """
+        forward a block of ffmpeg -progress output, a progress callback of media.run_ffmpeg
+
+        :param progress: key/value pairs of one progress block
+        :type progress: dict
+        """
+        self.instrumentation.emit('ffmpeg', stage=self.stage, **dict(progress, **self.fields))
+
+
+class JsonLinesSink:
+    def __init__(self, stream=None):
+        """
+        write every event as one line of JSON
+
+        :param stream: text stream to write to, default to be sys.stdout
+        :type stream: io.TextIOBase or None
+        """
+        self.stream = stream if stream is not None else sys.stdout
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event, default=str)
+        with self.lock:
+            self.stream.write(line + '\n')
+            self.stream.flush()
@@ -0,0 +1,412 @@
+import bisect
+import os
+import re
+import urllib.parse
+
+from pytube import request
+from pytube.helpers import safe_filename, target_directory
+
+STANDARD_FPS = 30  # frame rates above this are part of a quality label, e.g. 1080p60
+
+
+class StreamDescriptor:
+    def __init__(self, itag, url, mime_type, codecs, abr=None, resolution=None, fps=None, bitrate=None,
+                 filesize=None, is_otf=False, init_range=None, index_range=None):
+        """
+        plain description of a media stream, enough to filter, download and cache it without pytube's
+        Stream objects. attribute names follow pytube.Stream so pytube.StreamQuery can query it
+
+        :param itag: stream format id
+        :type itag: int
+        :param url: signed download url
+        :type url: str
+        :param mime_type: e.g. video/mp4
+        :type mime_type: str
+        :param codecs: e.g. ['avc1.640028'] or ['avc1.42001E', 'mp4a.40.2']
+        :type codecs: list[str]
+        :param abr: average audio bit rate e.g. 128kbps
+        :type abr: str or None
+        :param resolution: e.g. 1080p
+        :type resolution: str or None
+        :param fps: frame per second
+        :type fps: int or None
+        :param bitrate: bit rate in bits per second
+        :type bitrate: int or None
+        :param filesize: size in bytes, fetched with a HEAD request when needed if None
+        :type filesize: int or None
+        :param is_otf: whether the stream is served in sequential fragments
+        :type is_otf: bool
+        :param init_range: (first, last) inclusive bytes of the init segment of an adaptive stream
+        :type init_range: tuple[int, int] or None
+        :param index_range: (first, last) inclusive bytes of the segment index (sidx or Cues)
+        :type index_range: tuple[int, int] or None
+        """
+        self.itag = int(itag)
+        self.url = url
+        self.mime_type = mime_type
+        self.type, self.subtype = mime_type.split('/')
+        self.codecs = list(codecs)
+        self.abr = abr
+        self.resolution = resolution
+        self.fps = fps
+        self.bitrate = bitrate
+        self._filesize = filesize
+        self.is_otf = is_otf
+        self.init_range = tuple(init_range) if init_range else None
+        self.index_range = tuple(index_range) if index_range else None
+        self.video_codec, self.audio_codec = self._parse_codecs()
+
+    @classmethod
+    def from_stream(cls, stream, format_data=None):
+        """
+        describe a pytube Stream
+
+        :param stream: pytube stream
+        :type stream: pytube.Stream
+        :param format_data: entry of the stream in the streaming data of the video, pytube drops its
+                            initRange and indexRange, and only reads contentLength once asked for the filesize
+        :type format_data: dict or None
+        :rtype: StreamDescriptor
+        """
+        format_data = format_data or {}
+        return cls(stream.itag, stream.url, stream.mime_type, stream.codecs, abr=stream.abr,
+                   resolution=stream.resolution, fps=stream.fps, bitrate=stream.bitrate,
+                   filesize=getattr(stream, '_filesize', None) or _content_length(format_data),
+                   is_otf=stream.is_otf,
+                   init_range=_byte_range(format_data.get('initRange')),
+                   index_range=_byte_range(format_data.get('indexRange')))
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def to_dict(self):
+        return {'itag': self.itag, 'url': self.url, 'mime_type': self.mime_type, 'codecs': self.codecs,
+                'abr': self.abr, 'resolution': self.resolution, 'fps': self.fps, 'bitrate': self.bitrate,
+                'filesize': self._filesize, 'is_otf': self.is_otf,
+                'init_range': list(self.init_range) if self.init_range else None,
+                'index_range': list(self.index_range) if self.index_range else None}
+
+    def _parse_codecs(self):
+        # same rule as pytube: adaptive streams have one codec, progressive streams have video then audio
+        video = audio = None
+        if not self.is_adaptive:
+            video, audio = self.codecs
+        elif self.includes_video_track:
+            video = self.codecs[0]
+        elif self.includes_audio_track:
+            audio = self.codecs[0]
+        return video, audio
+
+    @property
+    def is_adaptive(self):
+        return bool(len(self.codecs) % 2)
+
+    @property
+    def is_progressive(self):
+        return not self.is_adaptive
+
+    @property
+    def is_dash(self):
+        return self.is_adaptive
+
+    @property
+    def includes_audio_track(self):
+        return self.is_progressive or self.type == 'audio'
+
+    @property
+    def includes_video_track(self):
+        return self.is_progressive or self.type == 'video'
+
+    @property
+    def filesize(self):
+        if self._filesize is None:
+            self._filesize = request.filesize(self.url)
+        return self._filesize
+
+    @property
+    def known_filesize(self):
+        """
+        size in bytes from the metadata or an earlier request, None if it is not known. never sends a request
+
+        :rtype: int or None
+        """
+        return self._filesize
+
+    @property
+    def height(self):
+        """
+        numeric resolution, e.g. 1080 for 1080p, None for audio
+
+        :rtype: int or None
+        """
+        return int(self.resolution[:-1]) if self.resolution else None
+
+    @property
+    def kbps(self):
+        """
+        numeric average audio bit rate, e.g. 128 for 128kbps, None for video only streams
+
+        :rtype: int or None
+        """
+        return int(self.abr[:-4]) if self.abr else None
+
+    def fetch_cost(self, length=None):
+        """
+        bytes to download, estimated from bitrate and length if the filesize is not known yet.
+        never sends a request
+
+        :param length: length of the video in seconds
+        :type length: int or None
+        :rtype: float
+        """
+        if self.known_filesize:
+            return self.known_filesize
+        if self.bitrate and length:
+            return self.bitrate * length / 8
+        return float('inf')
+
+    @property
+    def expiration(self):
+        """
+        unix time at which the signed url expires, None if unknown
+
+        :rtype: int or None
+        """
+        expire = urllib.parse.parse_qs(urllib.parse.urlparse(self.url).query).get('expire')
+        return int(expire[0]) if expire else None
+
+    def get_file_path(self, filename, output_path=None):
+        """
+        path of the downloaded stream, the extension is added according to the stream type
+
+        :param filename: filename without extension
+        :type filename: str
+        :param output_path: directory of the file, current directory if None
+        :type output_path: str or path-like or None
+        :rtype: str
+        """
+        return os.path.join(target_directory(output_path), '{}.{}'.format(safe_filename(filename), self.subtype))
+
+    def __repr__(self):
+        return '<StreamDescriptor itag={} mime_type={} codecs={} res={} fps={} abr={}>'.format(
+            self.itag, self.mime_type, self.codecs, self.resolution, self.fps, self.abr)
+
+
+def quality_label(height, fps=None):
+    """
+    label of a video quality, e.g. 1080p60, or 1080p for standard frame rates
+
+    :param height: numeric resolution
+    :type height: int
+    :param fps: frame per second
+    :type fps: int or None
+    :rtype: str
+    """
+    return '{}p{}'.format(height, fps if fps and fps > STANDARD_FPS else '')
+
+
+def parse_quality_label(label):
+    """
+    numeric resolution and frame rate of a quality label, e.g. (1080, 60) for 1080p60 and (720, None) for 720p
+
+    :param label: quality label
+    :type label: str
+    :return: (height, fps)
+    :rtype: tuple[int, int or None]
+    :raise ValueError: if label is not a quality label
+    """
+    match = re.fullmatch(r'(\d+)p(\d*)', label)
+    if not match:
+        raise ValueError("quality should be in form of 1080p60/360p, etc.")
+    return int(match.group(1)), int(match.group(2)) if match.group(2) else None
+
+
+def _content_length(data):
+    """
+    size in bytes of a stream from its entry in the streaming data, e.g. {'contentLength': '1048576'},
+    None if missing
+    """
+    try:
+        return int(data['contentLength']) or None
+    except (KeyError, ValueError):
+        return None
+
+
+def _byte_range(data):
+    """
+    (first, last) of a byte range of the streaming data, e.g. {'start': '0', 'end': '740'}, None if missing
+    """
+    try:
+        return int(data['start']), int(data['end'])
+    except (TypeError, KeyError, ValueError):
+        return None
+
+
+class StreamIndex:
+    def __init__(self, streams, length=None):
+        """
+        qualities of a video's streams, built once. video qualities are (height, fps) tuples and audio qualities
+        are bit rates in kbps, both compare numerically. every quality maps to its cheapest stream to fetch,
+        the one with the smallest (known or estimated) filesize
+
+        :param streams: streams of the video
+        :type streams: list[StreamDescriptor]
+        :param length: length of the video in seconds, used to estimate unknown filesizes
+        :type length: int or None
+        """
+        self.length = length
+        videos, progressives, audios, codec_audios = {}, {}, {}, {}
+        for stream in streams:
+            if stream.is_progressive:
+                self._add(progressives, (stream.height, stream.fps or 0), stream)
+            elif stream.includes_video_track:
+                self._add(videos, (stream.height, stream.fps or 0), stream)
+            elif stream.kbps:
+                self._add(audios, stream.kbps, stream)
+                self._add(codec_audios.setdefault(stream.audio_codec.split('.')[0], {}), stream.kbps, stream)
+        self.videos = videos
+        self.progressives = progressives
+        self.audios = audios
+        # qualities in ascending order, for bisection
+        self.video_qualities = sorted(videos)
+        self.progressive_qualities = sorted(progressives)
+        self.audio_qualities = sorted(audios)
+        # audio of each codec family, e.g. mp4a or opus, for formats that can only copy some codecs
+        self.codec_audios = {codec: (table, sorted(table)) for codec, table in codec_audios.items()}
+        self.video_budget = self._frontier(videos, lambda s: s.fetch_cost(length))
+        self.video_bitrate_budget = self._frontier(videos, lambda s: s.bitrate or float('inf'))
+
+    def _add(self, table, quality, stream):
+        current = table.get(quality)
+        if current is None or stream.fetch_cost(self.length) < current.fetch_cost(self.length):
+            table[quality] = stream
+
+    @staticmethod
+    def _frontier(table, cost):
+        """
+        (costs, streams) where streams[i] is the best quality costing at most costs[i], both ascending
+        """
+        costs, streams, best = [], [], None
+        for quality in sorted(table, key=lambda q: (cost(table[q]), -q[0], -q[1])):
+            if best is None or quality > best:
+                best = quality
+                costs.append(cost(table[quality]))
+                streams.append(table[quality])
+        return costs, streams
+
+    def resolutions(self):
+        """
+        labels of all video qualities, best first, e.g. ['1080p60', '1080p', '720p']
+
+        :rtype: list[str]
+        """
+        labels = []
+        for height, fps in sorted(set(self.videos) | set(self.progressives), reverse=True):
+            label = quality_label(height, fps)
+            if not labels or labels[-1] != label:
+                labels.append(label)
+        return labels
+
+    def bitrates(self):
+        """
+        labels of all audio qualities, best first, e.g. ['160kbps', '128kbps']
+
+        :rtype: list[str]
+        """
+        return ['{}kbps'.format(kbps) for kbps in reversed(self.audio_qualities)]
+
+    def video(self, height, fps=None):
+        """
+        adaptive video only stream of exactly this quality
+
+        :param height: numeric resolution
+        :type height: int
+        :param fps: frame per second, None for the standard frame rate
+        :type fps: int or None
+        :rtype: StreamDescriptor or None
+        """
+        return self._exact(self.videos, self.video_qualities, height, fps)
+
+    def progressive(self, height, fps=None):
+        """
+        progressive stream (video and audio) of exactly this quality
+
+        :param height: numeric resolution
+        :type height: int
+        :param fps: frame per second, None for the standard frame rate
+        :type fps: int or None
+        :rtype: StreamDescriptor or None
+        """
+        return self._exact(self.progressives, self.progressive_qualities, height, fps)
+
+    @staticmethod
+    def _exact(table, qualities, height, fps):
+        if fps is not None:
+            return table.get((height, fps))
+        # standard frame rate, the highest one at or below STANDARD_FPS, otherwise the highest one
+        for i in (bisect.bisect_right(qualities, (height, STANDARD_FPS)),
+                  bisect.bisect_right(qualities, (height, float('inf')))):
+            if i and qualities[i - 1][0] == height:
+                return table[qualities[i - 1]]
+        return None
+
+    def best_video(self, max_height=None, max_bytes=None, max_bitrate=None):
+        """
+        best adaptive video quality within limits, highest resolution first, then highest frame rate
+
+        :param max_height: highest acceptable resolution
+        :type max_height: int or None
+        :param max_bytes: largest acceptable (estimated) download size in bytes
+        :type max_bytes: int or None
+        :param max_bitrate: highest acceptable bit rate in bits per second
+        :type max_bitrate: int or None
+        :rtype: StreamDescriptor or None
+        """
+        if max_bytes is None and max_bitrate is None:
+            i = len(self.video_qualities) if max_height is None \
+                else bisect.bisect_right(self.video_qualities, (max_height, float('inf')))
+            return self.videos[self.video_qualities[i - 1]] if i else None
+        if max_height is None and (max_bytes is None or max_bitrate is None):
+            costs, streams = self.video_budget if max_bytes is not None else self.video_bitrate_budget
+            i = bisect.bisect_right(costs, max_bytes if max_bytes is not None else max_bitrate)
+            return streams[i - 1] if i else None
+        # several limits at once, walk down from the best quality
+        for quality in reversed(self.video_qualities):
+            stream = self.videos[quality]
+            if (max_height is None or quality[0] <= max_height) \
+                    and (max_bytes is None or stream.fetch_cost(self.length) <= max_bytes) \
+                    and (max_bitrate is None or (stream.bitrate or 0) <= max_bitrate):
+                return stream
+        return None
+
+    def audio(self, kbps):
+        """
+        audio only stream of exactly this bit rate
+
+        :param kbps: bit rate in kbps
+        :type kbps: int
+        :rtype: StreamDescriptor or None
+        """
+        return self.audios.get(kbps)
+
+    def best_audio(self, max_kbps=None, codecs=None):
+        """
+        audio only stream with the highest bit rate, at most max_kbps if given
+
+        :param max_kbps: highest acceptable bit rate in kbps
+        :type max_kbps: int or None
+        :param codecs: acceptable codec families e.g. {'mp4a'}, any codec if None
+        :type codecs: set[str] or None
+        :rtype: StreamDescriptor or None
+        """
+        if codecs is None:
+            return self._best_audio(self.audios, self.audio_qualities, max_kbps)
+        candidates = [self._best_audio(table, qualities, max_kbps)
+                      for codec, (table, qualities) in self.codec_audios.items() if codec in codecs]
+        return max(filter(None, candidates), key=lambda s: s.kbps, default=None)
+
+    @staticmethod
+    def _best_audio(table, qualities, max_kbps):
+        i = len(qualities) if max_kbps is None else bisect.bisect_right(qualities, max_kbps)
+        return table[qualities[i - 1]] if i else None
@@ -0,0 +1,142 @@
+import contextlib
+import io
+import threading
+import urllib.error
+import urllib.request
+
+from cache import ThumbnailCache
+from transfer import REQUEST_HEADERS, DEFAULT_TIMEOUT
+from transport import default_transport
+
+THUMBNAIL_URL = 'https://i.ytimg.com/vi/{}/{}.jpg'
+# thumbnail variants YouTube serves for every video, smallest first. maxresdefault is missing for some videos
+THUMBNAIL_VARIANTS = [
+    ('default', 120, 90),
+    ('mqdefault', 320, 180),
+    ('hqdefault', 480, 360),
+    ('sddefault', 640, 480),
+    ('maxresdefault', 1280, 720),
+]
+ORIGINAL = 'original'  # variant name of the thumbnail url from the video metadata
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def default_thumbnail_cache():
+    """
+    thumbnail cache shared by every helper of this process
+
+    :rtype: cache.ThumbnailCache
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ThumbnailCache()
+        return _default_cache
+
+
+def thumbnail_candidates(video_id, width=None, height=None, fallback_url=None):
+    """
+    thumbnail urls to try for a target size: the smallest variant covering width x height first,
+    then the larger ones in case it is missing, then fallback_url
+
+    :param video_id: YouTube video id
+    :type video_id: str
+    :param width: target width in pixels, the largest variant if None
+    :type width: int or None
+    :param height: target height in pixels
+    :type height: int or None
+    :param fallback_url: thumbnail url from the video metadata
+    :type fallback_url: str or None
+    :return: list of (variant, url)
+    :rtype: list[tuple[str, str]]
+    """
+    if width is None and height is None:
+        variants = THUMBNAIL_VARIANTS[::-1]
+    else:
+        covering = [i for i, (_, w, h) in enumerate(THUMBNAIL_VARIANTS) if w >= (width or 0) and h >= (height or 0)]
+        variants = THUMBNAIL_VARIANTS[covering[0]:] if covering else THUMBNAIL_VARIANTS[::-1]
+    candidates = [(name, THUMBNAIL_URL.format(video_id, name)) for name, _, _ in variants]
+    if fallback_url:
+        candidates.append((ORIGINAL, fallback_url))
+    return candidates
+
+
+def fetch_thumbnail(video_id, width=None, height=None, fallback_url=None, cache=None, timeout=DEFAULT_TIMEOUT,
+                    transport=None):
+    """
+    encoded thumbnail of a video covering width x height, from cache if possible
+
+    :param video_id: YouTube video id
+    :type video_id: str
+    :param width: target width in pixels, the largest thumbnail if None
+    :type width: int or None
+    :param height: target height in pixels
+    :type height: int or None
+    :param fallback_url: thumbnail url from the video metadata
+    :type fallback_url: str or None
+    :param cache: thumbnail cache, nothing is cached if None
+    :type cache: cache.ThumbnailCache or None
+    :param timeout: timeout of each request in seconds
+    :type timeout: int or float
+    :param transport: connections the requests are sent on, the transport shared by the process if None
+    :type transport: transport.Transport or None
+    :return: JPEG data
+    :rtype: bytes
+    """
+    candidates = thumbnail_candidates(video_id, width, height, fallback_url)
+    if cache is not None:
+        for variant, _ in candidates:
+            data = cache.get(video_id, variant)
+            if data is not None:
+                return data
+    transport = transport if transport is not None else default_transport()
+    error = None
+    while candidates:
+        variant, url = candidates.pop(0)
+        request = urllib.request.Request(url, headers=REQUEST_HEADERS)
+        try:
+            with transport.open(request, timeout=timeout) as response:
+                data = response.read()
+        except urllib.error.HTTPError as e:
+            error = e  # variant missing, try the next one
+            with contextlib.suppress(OSError):
+                # the error page is small, once read its connection serves the next variant
+                e.read()
+            continue
+        except OSError as e:
+            # thumbnail host unreachable, only the url from the metadata may still work
+            error = e
+            candidates = [c for c in candidates if c[0] == ORIGINAL]
+            continue
+        if cache is not None:
+            cache.put(video_id, variant, data)
+        return data
+    raise error
+
+
+def decode_thumbnail(data, width=None, height=None):
+    """
+    decode a thumbnail and scale it down to fit width x height, keeping its aspect ratio.
+    JPEG draft mode lets the decoder skip most of the work when the target is much smaller
+
+    :param data: encoded image
+    :type data: bytes
+    :param width: maximum width in pixels, no limit if None
+    :type width: int or None
+    :param height: maximum height in pixels, no limit if None
+    :type height: int or None
+    :return: decoded image
+    :rtype: PIL.Image.Image
+    """
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data))
+    if width or height:
+        size = (width or image.width, height or image.height)
+        image.draft('RGB', size)
+        image.thumbnail(size)
+    else:
+        image.load()
+    return image
@@ -0,0 +1,218 @@
+import contextlib
+import glob
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed
+
+from media import audio_convert_command, run_ffmpeg, media_duration, ffmpeg_capabilities, FfmpegError, TRANSCODE, \
+    VIDEO_ENCODER_ARGS
+from stats import Instrumentation
+
+DEFAULT_SEGMENT_SECONDS = 30  # target length of the pieces encoded in parallel, cut at the next keyframe
+DURATION_TOLERANCE = 0.5  # seconds the joined output may differ from the source
+
+
+class TranscodeScheduler:
+    def __init__(self, workers=None, threads_per_job=None, max_pending=None):
+        """
+        queue of audio conversions shared by any number of helpers. each conversion is one ffmpeg process,
+        at most workers of them run at the same time and each one is limited to threads_per_job threads,
+        so a batch keeps every core busy without oversubscribing them.
+        submit blocks while max_pending conversions are queued or running, which holds back the
+        downloads feeding the queue instead of piling up source files on disk
+
+        :param workers: number of ffmpeg processes running at the same time, default to be the number of CPUs
+        :type workers: int or None
+        :param threads_per_job: threads of each ffmpeg process, default to be CPUs divided by workers
+        :type threads_per_job: int or None
+        :param max_pending: maximum number of conversions queued or running, default to be twice workers
+        :type max_pending: int or None
+        """
+        cpus = os.cpu_count() or 1
+        self.workers = workers or cpus
+        self.threads_per_job = threads_per_job or max(1, cpus // self.workers)
+        self.max_pending = max_pending or 2 * self.workers
+        # the threads only wait for their ffmpeg process, the work happens in the processes
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='transcode')
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+        self.futures = set()  # conversions queued or running, a finished one removes itself
+        self.lock = threading.Lock()
+
+    def submit(self, input_path, output_path, audio_format, remove_input=True, instrumentation=None,
+               capabilities=None):
+        """
+        queue the conversion of an audio file, blocks while the queue is full
+
+        :param input_path: path to the source audio
+        :type input_path: str
+        :param output_path: path to the converted audio
+        :type output_path: str
+        :param audio_format: target format without dot, e.g. mp3
+        :type audio_format: str
+        :param remove_input: delete the source audio once it is converted
+        :type remove_input: bool
+        :param instrumentation: receives the convert stage of the conversion
+        :type instrumentation: stats.Instrumentation or None
+        :param capabilities: capabilities of ffmpeg, probed if None
+        :type capabilities: media.FfmpegCapabilities or None
+        :return: future of output_path, raises media.FfmpegError if ffmpeg failed
+        :rtype: concurrent.futures.Future
+        :raise FfmpegNotAvailableError: if ffmpeg is missing or has no encoder for audio_format
+        """
+        # build the command first so a missing encoder fails in the caller, not in the queue
+        command = audio_convert_command(input_path, output_path, audio_format, capabilities=capabilities,
+                                        threads=self.threads_per_job)
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self._convert, command, input_path, output_path, audio_format,
+                                          remove_input, instrumentation)
+        except BaseException:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self.lock:
+            self.futures.discard(future)
+        self.slots.release()
+
+    @staticmethod
+    def _convert(command, input_path, output_path, audio_format, remove_input, instrumentation):
+        stats = instrumentation if instrumentation is not None else Instrumentation()
+        with stats.stage('convert', format=audio_format, path=TRANSCODE) as meter:
+            run_ffmpeg(command, on_progress=meter.ffmpeg_progress if stats.enabled else None)
+        if remove_input:
+            os.remove(input_path)
+        return output_path
+
+    def wait(self, timeout=None):
+        """
+        wait for every conversion queued or running
+
+        :param timeout: seconds to wait at most, no limit if None
+        :type timeout: float or None
+        :return: futures of the conversions, finished ones and ones still running after timeout
+        :rtype: tuple[set, set]
+        """
+        with self.lock:
+            futures = list(self.futures)
+        return wait(futures, timeout=timeout)
+
+    def as_completed(self, timeout=None):
+        """
+        futures of the conversions queued or running, in the order they finish
+
+        :param timeout: seconds to wait at most, no limit if None
+        :type timeout: float or None
+        :rtype: collections.abc.Iterator[concurrent.futures.Future]
+        """
+        with self.lock:
+            futures = list(self.futures)
+        return as_completed(futures, timeout=timeout)
+
+    def shutdown(self, wait=True):
+        """
+        stop accepting conversions
+
+        :param wait: wait for queued and running conversions to finish
+        :type wait: bool
+        """
+        self.executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+
+def segmented_transcode(plan, video_path, audio_path, output_path, workers=None,
+                        segment_seconds=DEFAULT_SEGMENT_SECONDS, capabilities=None, on_segment=None, slots=None):
+    """
+    carry out a TRANSCODE mux plan with one encoder per core: the video is cut at keyframes into segments
+    without re-encoding, the segments are encoded at the same time, then joined by stream copy together
+    with the audio. a single encoder stops scaling at a few threads, so long videos finish several times
+    faster on many cores. the temporary segments and the joined video are written next to output_path,
+    which is only replaced once the joined video is complete
+
+    :param plan: mux plan with path TRANSCODE
+    :type plan: media.MuxPlan
+    :param video_path: path to the source video
+    :type video_path: str
+    :param audio_path: path to the source audio
+    :type audio_path: str
+    :param output_path: path to the muxed output
+    :type output_path: str
+    :param workers: number of segments encoded at the same time, default to be the number of CPUs
+    :type workers: int or None
+    :param segment_seconds: target length of a segment in seconds
+    :type segment_seconds: int or float
+    :param capabilities: capabilities of ffmpeg, probed if None
+    :type capabilities: media.FfmpegCapabilities or None
+    :param on_segment: callback(done, total) after each encoded segment
+    :type on_segment: callable or None
+    :param slots: held by each ffmpeg process while it runs, e.g. the mux semaphore of helper.StageLimits,
+                  so encoding workers segments at once takes workers slots
+    :type slots: threading.Semaphore or None
+    :return: None
+    :raise FfmpegError: if ffmpeg fails or the output is shorter or longer than the source
+    """
+    if plan.path != TRANSCODE:
+        raise ValueError("only a {} plan re-encodes video, not {}".format(TRANSCODE, plan.path))
+    capabilities = capabilities if capabilities is not None else ffmpeg_capabilities()
+    cpus = os.cpu_count() or 1
+    workers = workers or cpus
+    slots = slots if slots is not None else contextlib.nullcontext()
+    # every file is new in work_dir, so ffmpeg never has to overwrite one
+    ffmpeg = [capabilities.path, '-hide_banner', '-loglevel', 'error', '-nostdin']
+    work_dir = tempfile.mkdtemp(prefix='.segments-', dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        # matroska holds any codec and keeps the timestamps the segment muxer writes
+        with slots:
+            run_ffmpeg(ffmpeg + ['-i', video_path, '-map', '0:v:0', '-c', 'copy', '-f', 'segment',
+                                 '-segment_time', str(segment_seconds), '-reset_timestamps', '1',
+                                 os.path.join(work_dir, 'source%06d.mkv')])
+        sources = sorted(glob.glob(os.path.join(glob.escape(work_dir), 'source*.mkv')))
+        encode_args = ['-c:v', plan.video_encoder] + VIDEO_ENCODER_ARGS.get(plan.video_encoder, []) + \
+            ['-threads', str(max(1, cpus // workers))]
+        done = [0]
+        lock = threading.Lock()
+
+        def encode(source):
+            # only the file name, a directory above work_dir may be called source as well
+            target = os.path.join(work_dir, 'encoded' + os.path.basename(source)[len('source'):])
+            with slots:
+                run_ffmpeg(ffmpeg + ['-i', source, '-map', '0:v:0'] + encode_args + [target])
+            with lock:
+                done[0] += 1
+                if on_segment:
+                    on_segment(done[0], len(sources))
+            return target
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            encoded = list(executor.map(encode, sources))
+        playlist = os.path.join(work_dir, 'segments.txt')
+        with open(playlist, 'w', encoding='utf-8') as f:
+            for path in encoded:
+                f.write("file '{}'\n".format(os.path.basename(path)))
+        # same extension as output_path, ffmpeg picks the container from it
+        joined = os.path.join(work_dir, 'joined' + os.path.splitext(output_path)[1])
+        with slots:
+            run_ffmpeg(ffmpeg + ['-f', 'concat', '-safe', '0', '-i', playlist, '-i', audio_path,
+                                 '-map', '0:v:0', '-map', '1:a:0', '-c:v', 'copy', '-c:a', plan.audio_encoder,
+                                 joined])
+        # the output lasts as long as the longer of its sources, like a plain mux
+        durations = [d for d in (media_duration(video_path, capabilities), media_duration(audio_path, capabilities))
+                     if d is not None]
+        expected = max(durations) if durations else None
+        actual = media_duration(joined, capabilities)
+        if expected is not None and (actual is None or abs(actual - expected) > DURATION_TOLERANCE):
+            raise FfmpegError('joined video lasts {}s instead of {}s'.format(actual, expected))
+        os.replace(joined, output_path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
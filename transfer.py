@@ -0,0 +1,879 @@
+import asyncio
+import http.client
+import io
+import itertools
+import os
+import random
+import socket
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from transport import default_transport, DEFAULT_CHUNK_SIZE, DEFAULT_TIMEOUT
+
+DEFAULT_CONNECTIONS = 4  # parallel connections per stream
+DEFAULT_SEGMENT_SIZE = 9437184  # 9MB, same range size as pytube uses
+REQUEST_HEADERS = {'User-Agent': 'Mozilla/5.0', 'accept-language': 'en-US,en'}
+JOURNAL_SUFFIX = '.journal'  # sidecar file recording completed byte ranges of a partial download
+MAX_REDIRECTS = 5
+DEFAULT_RETRIES = 4  # times a failed range is requested again before the download fails
+RETRY_BACKOFF = 0.5  # seconds before the first retry, doubled for every further one
+MAX_RETRY_BACKOFF = 8
+HEDGE_RATIO = 0.25  # a range fetched below this fraction of the median rate of its peers gets a hedged duplicate
+HEDGE_MIN_AGE = 1.0  # seconds a request runs before its rate is judged
+STALL_SECONDS = 3.0  # a request receiving nothing for this long is hedged even without peers to compare with
+HEALTH_INTERVAL = 0.2  # seconds between checks of the requests in flight
+RECENT_RATES = 16  # rates of finished requests kept as peers of the running ones
+
+
+class DownloadCancelledError(Exception):
+    pass
+
+
+class RangeNotSupportedError(Exception):
+    pass
+
+
+class SegmentedDownloader:
+    def __init__(self, connections=DEFAULT_CONNECTIONS, segment_size=DEFAULT_SEGMENT_SIZE,
+                 chunk_size=DEFAULT_CHUNK_SIZE, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, hedge=True,
+                 transport=None):
+        """
+        download a single stream over several HTTP connections, each fetching its own byte ranges.
+        a range whose request fails is requested again from where it stopped, and a range fetched much slower
+        than the others gets a hedged duplicate request, whichever finishes first wins
+
+        :param connections: number of parallel connections per stream
+        :type connections: int
+        :param segment_size: size of byte range fetched by one request
+        :type segment_size: int
+        :param chunk_size: number of bytes read from a connection at a time
+        :type chunk_size: int
+        :param timeout: timeout of each request in seconds
+        :type timeout: int or float
+        :param retries: times a range is requested again after a connection error, timeout or server error
+        :type retries: int
+        :param hedge: send hedged duplicates of slow or stalled ranges
+        :type hedge: bool
+        :param transport: connections the requests are sent on, the transport shared by the process if None
+        :type transport: transport.Transport or None
+        """
+        if connections < 1:
+            raise ValueError("connections should be at least 1")
+        self.connections = connections
+        self.segment_size = segment_size
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.retries = retries
+        self.hedge = hedge
+        self.transport = transport if transport is not None else default_transport()
+
+    def download(self, url, file_path, filesize, on_progress=None, cancel_event=None, resume=False, throttle=None,
+                 byte_range=None, offset=0):
+        """
+        download url to file_path. the file is preallocated to filesize and every connection writes
+        its ranges straight to their offsets, so nothing has to be reassembled afterwards
+
+        :param url: url of the stream
+        :type url: str
+        :param file_path: path of the output file
+        :type file_path: str or path-like
+        :param filesize: size of the stream in bytes, download with one connection if unknown
+        :type filesize: int or None
+        :param on_progress: callback(bytes_done, total) called after each chunk
+        :type on_progress: callable or None
+        :param cancel_event: stop downloading and raise DownloadCancelledError once it is set
+        :type cancel_event: threading.Event or None
+        :param resume: record completed ranges in a journal next to file_path and continue from it
+                       if a previous download of the same file was interrupted
+        :type resume: bool
+        :param throttle: callback(n) called after each chunk of n bytes, blocks to limit the rate,
+                         e.g. bandwidth.TransferJob.throttle
+        :type throttle: callable or None
+        :param byte_range: (first, last) inclusive bytes of the stream to download instead of all of it,
+                           on_progress then counts the bytes of this range
+        :type byte_range: tuple[int, int] or None
+        :param offset: offset in the file of the first downloaded byte, the bytes before it are left for
+                       the caller to fill, e.g. with the init segment of a clip
+        :type offset: int
+        :return: path to downloaded file
+        :rtype: str
+        :raise RangeNotSupportedError: if the server ignores range requests and byte_range is given
+        """
+        cancel_event = cancel_event if cancel_event is not None else threading.Event()
+        if byte_range is not None:
+            first, last = byte_range
+            filesize = last - first + 1
+        else:
+            first = 0
+        if not filesize:
+            self._download_whole(url, file_path, filesize, on_progress, cancel_event, throttle)
+            return file_path
+        journal = DownloadJournal(str(file_path) + JOURNAL_SUFFIX, offset + filesize) if resume else None
+        try:
+            self._download_segments(url, file_path, filesize, on_progress, cancel_event, journal, throttle,
+                                    first=first, offset=offset)
+        except RangeNotSupportedError:
+            if byte_range is not None or offset:
+                raise
+            # server ignores Range header, fall back to a single sequential connection
+            self._download_whole(url, file_path, filesize, on_progress, cancel_event, throttle)
+        if journal is not None:
+            journal.remove()
+        return file_path
+
+    def download_to(self, url, fileobj, filesize, on_progress=None, cancel_event=None, throttle=None):
+        """
+        download url and write it to fileobj in order, e.g. into a pipe to ffmpeg. ranges are still fetched
+        over several connections, but at most two per connection are held in memory ahead of the writer
+
+        :param url: url of the stream
+        :type url: str
+        :param fileobj: writable binary file object, it is not closed
+        :type fileobj: io.BufferedIOBase
+        :param filesize: size of the stream in bytes, download with one connection if unknown
+        :type filesize: int or None
+        :param on_progress: callback(bytes_done, total) called after each chunk
+        :type on_progress: callable or None
+        :param cancel_event: stop downloading and raise DownloadCancelledError once it is set
+        :type cancel_event: threading.Event or None
+        :param throttle: callback(n) called after each chunk of n bytes, see download
+        :type throttle: callable or None
+        :return: None
+        """
+        cancel_event = cancel_event if cancel_event is not None else threading.Event()
+        if not filesize:
+            self._copy_whole(url, fileobj, filesize, on_progress, cancel_event, throttle)
+            return
+        segments = deque(split_ranges(filesize, self.segment_size))
+        lock = threading.Lock()
+        progress = [0]
+        stop_event = threading.Event()  # set when the writer gives up
+
+        def report(n):
+            with lock:
+                progress[0] += n
+                done = progress[0]
+            if on_progress:
+                on_progress(done, filesize)
+            if throttle:
+                throttle(n)
+
+        def fetch(start, end):
+            buffer = io.BytesIO()
+            for attempt in itertools.count():
+                try:
+                    # a retry continues after the bytes already in the buffer
+                    self._fetch_range(url, buffer, start + buffer.tell(), end, report, cancel_event, stop_event,
+                                      offset=buffer.tell())
+                    return buffer
+                except Exception as e:
+                    if attempt >= self.retries or not is_retryable(e) or stop_event.wait(retry_delay(attempt)):
+                        raise
+
+        written = 0
+        with ThreadPoolExecutor(max_workers=self.connections) as executor:
+            pending = deque()
+            try:
+                while segments or pending:
+                    while segments and len(pending) < 2 * self.connections:
+                        pending.append(executor.submit(fetch, *segments.popleft()))
+                    data = pending.popleft().result().getbuffer()
+                    fileobj.write(data)
+                    written += len(data)
+            except RangeNotSupportedError:
+                if written:
+                    raise
+                fallback = True
+            else:
+                fallback = False
+            finally:
+                stop_event.set()
+                for future in pending:
+                    future.cancel()
+        if fallback:
+            # server ignores Range header, fall back to a single sequential connection
+            self._copy_whole(url, fileobj, filesize, on_progress, cancel_event, throttle)
+
+    def _download_segments(self, url, file_path, filesize, on_progress, cancel_event, journal=None, throttle=None,
+                           first=0, offset=0):
+        # segments count from the first byte downloaded: byte x is byte first + x of the stream and is
+        # written at offset + x of the file, the journal records offsets of the file
+        completed = [(max(0, start - offset), end - offset) for start, end in journal.load(file_path)
+                     if end >= offset] if journal is not None else []
+        pending = []
+        for start, end in missing_ranges(completed, filesize):
+            pending += [_Segment(start + a, start + b) for a, b in split_ranges(end - start + 1, self.segment_size)]
+        pending.reverse()  # workers pop from the end, so the file is fetched front to back
+        condition = threading.Condition()
+        progress = [sum(end - start + 1 for start, end in completed)]
+        remaining = [len(pending)]  # segments not finished yet
+        workers = [min(self.connections, len(pending))]  # threads taking segments from pending
+        running = set()  # requests in flight
+        rates = deque(maxlen=RECENT_RATES)  # bytes per second of finished requests
+        errors = []
+        stop_event = threading.Event()  # set when any worker fails or the download ends
+
+        def write(request, data):
+            # the number of bytes no other request wrote yet, None if the request should stop
+            with condition:
+                segment = request.segment
+                if stop_event.is_set() or segment.done.is_set():
+                    return None
+                fh.seek(offset + request.position)
+                fh.write(data)
+                request.position += len(data)
+                request.received = time.monotonic()
+                new = max(0, request.position - segment.written)
+                segment.written += new
+                progress[0] += new
+                done = progress[0]
+            if new and on_progress:
+                on_progress(done, filesize)
+            return new
+
+        def fetch(request):
+            # True if the request wrote the whole rest of its segment, which is then done
+            with condition:
+                running.add(request)
+            try:
+                if not self._fetch_request(url, request, write, cancel_event, throttle, first):
+                    return False
+            finally:
+                with condition:
+                    running.discard(request)
+            with condition:
+                segment = request.segment
+                if segment.done.is_set():
+                    return False
+                if journal is not None:
+                    # make sure the bytes are on disk before the journal says they are
+                    fh.flush()
+                    os.fsync(fh.fileno())
+                    journal.record(offset + segment.start, offset + segment.end)
+                segment.done.set()
+                remaining[0] -= 1
+                rates.append(request.rate(time.monotonic()))
+                if request.hedge:
+                    # the thread of the original request no longer counts as a worker, the hedge takes its place
+                    segment.abandoned = True
+                    workers[0] -= 1
+                condition.notify_all()
+            return True
+
+        def fetch_segment(segment):
+            # False if a hedge finished the segment, the thread is not a worker anymore then
+            for attempt in itertools.count():
+                try:
+                    fetch(_Request(segment))
+                    break
+                except Exception as e:
+                    if segment.done.is_set() or stop_event.is_set():
+                        break
+                    if attempt >= self.retries or not is_retryable(e):
+                        raise
+                    if stop_event.wait(retry_delay(attempt)):
+                        break
+            with condition:
+                return not segment.abandoned
+
+        def work(counted=True, hedge=None):
+            try:
+                if hedge is not None:
+                    try:
+                        fetch(hedge)
+                    except (RangeNotSupportedError, DownloadCancelledError):
+                        raise
+                    except Exception:
+                        pass  # the original request is still running
+                    finally:
+                        with condition:
+                            hedge.segment.hedged = hedge.segment.done.is_set()
+                while True:
+                    with condition:
+                        if not counted:
+                            if workers[0] >= self.connections:
+                                return
+                            workers[0] += 1
+                            counted = True
+                        if stop_event.is_set() or not pending:
+                            workers[0] -= 1
+                            return
+                        segment = pending.pop()
+                    counted = fetch_segment(segment)
+            except Exception as e:
+                with condition:
+                    errors.append(e)
+                    stop_event.set()
+                    condition.notify_all()
+
+        if not completed:
+            with open(file_path, 'wb') as fh:
+                fh.truncate(offset + filesize)
+            if journal is not None:
+                journal.start()
+        elif on_progress:
+            on_progress(progress[0], filesize)
+        # one handle shared by every request, a stalled request that lost its segment never touches it again
+        with open(file_path, 'r+b') as fh:
+            try:
+                for _ in range(workers[0]):
+                    threading.Thread(target=work, daemon=True).start()
+                with condition:
+                    while remaining[0] and not errors:
+                        if cancel_event.is_set():
+                            raise DownloadCancelledError('download cancelled')
+                        condition.wait(HEALTH_INTERVAL)
+                        if self.hedge and not errors:
+                            for request in self._stragglers(running, rates):
+                                request.segment.hedged = True
+                                threading.Thread(target=work, kwargs={'counted': False, 'hedge': _Request(
+                                    request.segment, hedge=True)}, daemon=True).start()
+            finally:
+                # requests still in flight, e.g. stalled ones, stop at their next chunk without writing it
+                with condition:
+                    stop_event.set()
+        if errors:
+            raise errors[0]
+
+    def _stragglers(self, running, rates):
+        """
+        requests in flight that should get a hedged duplicate: their rate is far below the median rate of the
+        other requests, or they received nothing for a while. at most half of the connections are hedges
+
+        :param running: requests in flight
+        :type running: set[_Request]
+        :param rates: rates of recently finished requests in bytes per second
+        :type rates: collections.deque
+        :rtype: list[_Request]
+        """
+        now = time.monotonic()
+        judged = [request for request in running if now - request.started >= HEDGE_MIN_AGE]
+        hedges = sum(request.hedge for request in running)
+        stragglers = []
+        for request in judged:
+            if hedges + len(stragglers) >= max(1, self.connections // 2):
+                break
+            segment = request.segment
+            if request.hedge or segment.hedged or segment.end + 1 - segment.written < self.chunk_size:
+                continue
+            peers = [other.rate(now) for other in judged if other is not request] + list(rates)
+            slow = bool(peers) and request.rate(now) < HEDGE_RATIO * statistics.median(peers)
+            if slow or now - request.received >= STALL_SECONDS:
+                stragglers.append(request)
+        return stragglers
+
+    def _fetch_request(self, url, request, write, cancel_event, throttle=None, first=0):
+        """
+        fetch the rest of the segment of request from its position and pass every chunk to write(request, data).
+        return True if the whole rest was written, False if write stopped the request.
+        segments count from byte first of the stream
+        """
+        segment = request.segment
+        headers = dict(REQUEST_HEADERS, Range='bytes={}-{}'.format(first + request.position, first + segment.end))
+        with self.transport.open(urllib.request.Request(url, headers=headers), timeout=self.timeout) as response:
+            if response.status != 206:
+                raise RangeNotSupportedError('server does not support range requests')
+            buffer = bytearray(self.chunk_size)
+            view = memoryview(buffer)
+            while request.position <= segment.end:
+                if cancel_event.is_set():
+                    raise DownloadCancelledError('download cancelled')
+                n = response.readinto(view[:min(self.chunk_size, segment.end + 1 - request.position)])
+                if not n:
+                    raise ConnectionError('connection closed with {} bytes left'.format(
+                        segment.end + 1 - request.position))
+                if write(request, view[:n]) is None:
+                    return False
+                if throttle:
+                    throttle(n)
+        return True
+
+    def _fetch_range(self, url, fh, start, end, report, cancel_event, stop_event, offset=None):
+        """
+        fetch bytes start to end (inclusive) of url and write them at offset of fh, at the same offset
+        as in the stream if None. return True if the whole range was written
+        """
+        request = urllib.request.Request(url, headers=dict(REQUEST_HEADERS, Range='bytes={}-{}'.format(start, end)))
+        with self.transport.open(request, timeout=self.timeout) as response:
+            if response.status != 206:
+                raise RangeNotSupportedError('server does not support range requests')
+            fh.seek(start if offset is None else offset)
+            return self._copy(response, fh, end - start + 1, report, cancel_event, stop_event)
+
+    def _download_whole(self, url, file_path, filesize, on_progress, cancel_event, throttle=None):
+        with open(file_path, 'wb') as fh:
+            self._copy_whole(url, fh, filesize, on_progress, cancel_event, throttle)
+
+    def _copy_whole(self, url, fh, filesize, on_progress, cancel_event, throttle=None):
+        request = urllib.request.Request(url, headers=REQUEST_HEADERS)
+        progress = [0]
+
+        def report(n):
+            progress[0] += n
+            if on_progress:
+                on_progress(progress[0], filesize)
+            if throttle:
+                throttle(n)
+
+        with self.transport.open(request, timeout=self.timeout) as response:
+            self._copy(response, fh, None, report, cancel_event, None)
+
+    def _copy(self, response, fh, length, report, cancel_event, stop_event):
+        """
+        copy length bytes (or everything if None) from response to fh through a reused buffer,
+        return False if stopped by stop_event before finishing
+        """
+        buffer = bytearray(self.chunk_size)
+        view = memoryview(buffer)
+        remaining = length
+        while remaining is None or remaining > 0:
+            if cancel_event.is_set():
+                raise DownloadCancelledError('download cancelled')
+            if stop_event is not None and stop_event.is_set():
+                return False
+            n = response.readinto(view if remaining is None or remaining >= self.chunk_size else view[:remaining])
+            if not n:
+                if remaining is not None:
+                    raise ConnectionError('connection closed with {} bytes left'.format(remaining))
+                break
+            fh.write(view[:n])
+            if remaining is not None:
+                remaining -= n
+            report(n)
+        return True
+
+
+class _Segment:
+    def __init__(self, start, end):
+        """
+        byte range of a segmented download, fetched by one request at a time plus at most one hedged duplicate
+        """
+        self.start = start
+        self.end = end
+        self.written = start  # every byte before this offset is written, by whichever request
+        self.done = threading.Event()
+        self.hedged = False
+        self.abandoned = False  # a hedge finished the segment before the original request
+
+
+class _Request:
+    def __init__(self, segment, hedge=False):
+        """
+        one request for the part of a segment not written yet
+        """
+        self.segment = segment
+        self.hedge = hedge
+        self.start = self.position = segment.written
+        self.started = self.received = time.monotonic()
+
+    def rate(self, now):
+        """
+        bytes per second since the request was sent
+        """
+        return (self.position - self.start) / (now - self.started) if now > self.started else 0
+
+
+class AsyncSegmentedDownloader:
+    def __init__(self, connections=DEFAULT_CONNECTIONS, segment_size=DEFAULT_SEGMENT_SIZE,
+                 chunk_size=DEFAULT_CHUNK_SIZE, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES):
+        """
+        asyncio counterpart of SegmentedDownloader, every connection is a task on the running event loop
+        instead of a thread. cancelling the awaiting task stops all connections at their next read.
+        failed ranges are retried like SegmentedDownloader does, but not hedged
+
+        :param connections: number of parallel connections per stream
+        :type connections: int
+        :param segment_size: size of byte range fetched by one request
+        :type segment_size: int
+        :param chunk_size: number of bytes read from a connection at a time
+        :type chunk_size: int
+        :param timeout: timeout of connecting and of each read in seconds
+        :type timeout: int or float
+        :param retries: times a range is requested again after a connection error, timeout or server error
+        :type retries: int
+        """
+        if connections < 1:
+            raise ValueError("connections should be at least 1")
+        self.connections = connections
+        self.segment_size = segment_size
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.retries = retries
+
+    async def download(self, url, file_path, filesize, on_progress=None, resume=False, throttle=None):
+        """
+        download url to file_path, see SegmentedDownloader.download
+
+        :param url: url of the stream
+        :type url: str
+        :param file_path: path of the output file
+        :type file_path: str or path-like
+        :param filesize: size of the stream in bytes, download with one connection if unknown
+        :type filesize: int or None
+        :param on_progress: callback(bytes_done, total) called after each chunk
+        :type on_progress: callable or None
+        :param resume: record completed ranges in a journal next to file_path and continue from it
+                       if a previous download of the same file was interrupted
+        :type resume: bool
+        :param throttle: blocking callback(n) called after each chunk of n bytes, it runs in a worker thread,
+                         e.g. bandwidth.TransferJob.throttle
+        :type throttle: callable or None
+        :return: path to downloaded file
+        :rtype: str
+        """
+        if not filesize:
+            await self._download_whole(url, file_path, filesize, on_progress, throttle)
+            return file_path
+        journal = DownloadJournal(str(file_path) + JOURNAL_SUFFIX, filesize) if resume else None
+        try:
+            await self._download_segments(url, file_path, filesize, on_progress, journal, throttle)
+        except RangeNotSupportedError:
+            # server ignores Range header, fall back to a single sequential connection
+            await self._download_whole(url, file_path, filesize, on_progress, throttle)
+        if journal is not None:
+            journal.remove()
+        return file_path
+
+    async def fetch(self, url):
+        """
+        download a small resource, e.g. a thumbnail, into memory
+
+        :param url: url of the resource
+        :type url: str
+        :return: content
+        :rtype: bytes
+        """
+        buffer = io.BytesIO()
+        response = await self._request(url, REQUEST_HEADERS)
+        try:
+            await self._copy(response, buffer, None, lambda n: None)
+        finally:
+            response.close()
+        return buffer.getvalue()
+
+    async def _download_segments(self, url, file_path, filesize, on_progress, journal=None, throttle=None):
+        completed = journal.load(file_path) if journal is not None else []
+        segments = deque()
+        for start, end in missing_ranges(completed, filesize):
+            segments += [(start + a, start + b) for a, b in split_ranges(end - start + 1, self.segment_size)]
+        progress = [sum(end - start + 1 for start, end in completed)]
+
+        def report(n):
+            progress[0] += n
+            if on_progress:
+                on_progress(progress[0], filesize)
+
+        async def worker():
+            # the tasks share one thread, so popping a segment needs no lock
+            with open(file_path, 'r+b') as fh:
+                while segments:
+                    start, end = segments.popleft()
+                    position = start
+                    fh.seek(start)
+                    for attempt in itertools.count():
+                        try:
+                            await self._fetch_range(url, fh, position, end, report, throttle)
+                            break
+                        except Exception as e:
+                            if attempt >= self.retries or not is_retryable(e):
+                                raise
+                            # continue after the bytes already written
+                            position = fh.tell()
+                            await asyncio.sleep(retry_delay(attempt))
+                    if journal is not None:
+                        # make sure the bytes are on disk before the journal says they are
+                        fh.flush()
+                        os.fsync(fh.fileno())
+                        journal.record(start, end)
+
+        if not completed:
+            with open(file_path, 'wb') as fh:
+                fh.truncate(filesize)
+            if journal is not None:
+                journal.start()
+        elif on_progress:
+            on_progress(progress[0], filesize)
+        tasks = [asyncio.ensure_future(worker()) for _ in range(min(self.connections, len(segments)))]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # stop the other connections if one failed or the download was cancelled
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _fetch_range(self, url, fh, start, end, report, throttle=None):
+        """
+        fetch bytes start to end (inclusive) of url and write them at the same offset of fh
+        """
+        response = await self._request(url, dict(REQUEST_HEADERS, Range='bytes={}-{}'.format(start, end)))
+        try:
+            if response.status != 206:
+                raise RangeNotSupportedError('server does not support range requests')
+            fh.seek(start)
+            await self._copy(response, fh, end - start + 1, report, throttle)
+        finally:
+            response.close()
+
+    async def _download_whole(self, url, file_path, filesize, on_progress, throttle=None):
+        progress = [0]
+
+        def report(n):
+            progress[0] += n
+            if on_progress:
+                on_progress(progress[0], filesize)
+
+        response = await self._request(url, REQUEST_HEADERS)
+        try:
+            with open(file_path, 'wb') as fh:
+                await self._copy(response, fh, None, report, throttle)
+        finally:
+            response.close()
+
+    async def _copy(self, response, fh, length, report, throttle=None):
+        """
+        copy length bytes (or everything if None) from response to fh
+        """
+        remaining = length
+        while remaining is None or remaining > 0:
+            data = await asyncio.wait_for(
+                response.read(self.chunk_size if remaining is None else min(remaining, self.chunk_size)),
+                self.timeout)
+            if not data:
+                if remaining is not None:
+                    raise ConnectionError('connection closed with {} bytes left'.format(remaining))
+                break
+            fh.write(data)
+            if remaining is not None:
+                remaining -= len(data)
+            report(len(data))
+            if throttle:
+                await asyncio.to_thread(throttle, len(data))
+
+    async def _request(self, url, headers):
+        """
+        send a GET request over a new connection and read the response head, following redirects
+
+        :rtype: _AsyncResponse
+        :raise urllib.error.HTTPError: on error status, like urllib.request.urlopen
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            secure = parts.scheme == 'https'
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(parts.hostname, parts.port or (443 if secure else 80), ssl=secure or None),
+                self.timeout)
+            try:
+                target = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+                lines = ['GET {} HTTP/1.1'.format(target), 'Host: {}'.format(parts.netloc), 'Connection: close']
+                lines += ['{}: {}'.format(name, value) for name, value in headers.items()]
+                writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+                status_line = await asyncio.wait_for(reader.readline(), self.timeout)
+                status = int(status_line.split()[1])
+                response_headers = {}
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), self.timeout)
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    response_headers[name.strip().lower()] = value.strip()
+            except BaseException:
+                writer.close()
+                raise
+            if status in (301, 302, 303, 307, 308) and 'location' in response_headers:
+                writer.close()
+                url = urllib.parse.urljoin(url, response_headers['location'])
+                continue
+            if status >= 400:
+                writer.close()
+                reason = http.client.responses.get(status, '')
+                raise urllib.error.HTTPError(url, status, reason, response_headers, None)
+            return _AsyncResponse(status, response_headers, reader, writer)
+        raise ConnectionError('too many redirects')
+
+
+class _AsyncResponse:
+    def __init__(self, status, headers, reader, writer):
+        """
+        body of an HTTP/1.1 response read from an asyncio stream, plain or chunked
+        """
+        self.status = status
+        self.headers = headers
+        self.reader = reader
+        self.writer = writer
+        self.chunked = headers.get('transfer-encoding', '').lower() == 'chunked'
+        self.remaining = int(headers['content-length']) \
+            if 'content-length' in headers and not self.chunked else None
+        self.chunk_left = 0
+
+    async def read(self, n):
+        """
+        read at most n bytes of the body, b'' at its end
+        """
+        if self.chunked:
+            if not self.chunk_left:
+                self.chunk_left = int((await self.reader.readline()).split(b';')[0], 16)
+                if not self.chunk_left:
+                    return b''
+            data = await self.reader.read(min(n, self.chunk_left))
+            self.chunk_left -= len(data)
+            if data and not self.chunk_left:
+                await self.reader.readexactly(2)  # CRLF after chunk data
+            return data
+        if self.remaining is not None:
+            if not self.remaining:
+                return b''
+            n = min(n, self.remaining)
+        data = await self.reader.read(n)
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.writer.close()
+
+
+class DownloadJournal:
+    def __init__(self, path, filesize):
+        """
+        append-only record of the byte ranges of a partial file that are completely written.
+        the first line holds the expected filesize, every other line is an inclusive range 'start end'
+
+        :param path: path of the journal file
+        :type path: str
+        :param filesize: size of the complete file in bytes
+        :type filesize: int
+        """
+        self.path = path
+        self.filesize = filesize
+
+    def start(self):
+        """
+        start a new journal for an empty partial file
+        """
+        with open(self.path, 'w') as f:
+            f.write('filesize {}\n'.format(self.filesize))
+
+    def load(self, file_path):
+        """
+        read completed ranges of file_path. nothing is trusted if the journal is missing or damaged,
+        or if the expected filesize or the size of the partial file on disk does not match
+
+        :param file_path: path of the partial file
+        :type file_path: str or path-like
+        :return: merged completed ranges, sorted
+        :rtype: list[tuple[int, int]]
+        """
+        try:
+            with open(self.path) as f:
+                lines = f.read().split('\n')
+            if lines[0] != 'filesize {}'.format(self.filesize) or os.path.getsize(file_path) != self.filesize:
+                return []
+        except (OSError, IndexError):
+            return []
+        ranges = []
+        # the last line may have been cut off by a crash, ignore anything that does not parse
+        for line in lines[1:]:
+            try:
+                start, end = (int(x) for x in line.split())
+            except ValueError:
+                continue
+            if 0 <= start <= end < self.filesize:
+                ranges.append((start, end))
+        return merge_ranges(ranges)
+
+    def record(self, start, end):
+        """
+        record that bytes start to end (inclusive) are written
+        """
+        with open(self.path, 'a') as f:
+            f.write('{} {}\n'.format(start, end))
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def merge_ranges(ranges):
+    """
+    merge overlapping and adjacent inclusive ranges
+
+    :param ranges: list of (start, end)
+    :type ranges: list[tuple[int, int]]
+    :return: sorted, non-overlapping ranges
+    :rtype: list[tuple[int, int]]
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def missing_ranges(completed, filesize):
+    """
+    inclusive ranges of a file of filesize bytes not covered by completed
+
+    :param completed: sorted, non-overlapping ranges, e.g. from merge_ranges
+    :type completed: list[tuple[int, int]]
+    :param filesize: size of the file in bytes
+    :type filesize: int
+    :return: list of (start, end)
+    :rtype: list[tuple[int, int]]
+    """
+    missing = []
+    position = 0
+    for start, end in completed:
+        if start > position:
+            missing.append((position, start - 1))
+        position = max(position, end + 1)
+    if position < filesize:
+        missing.append((position, filesize - 1))
+    return missing
+
+
+def is_retryable(error):
+    """
+    check if a failed request is worth repeating: connection errors, timeouts, server errors and rate limiting.
+    other HTTP errors, e.g. 403 for an expired stream url, fail again
+
+    :type error: Exception
+    :rtype: bool
+    """
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code >= 500 or error.code == 429
+    return isinstance(error, (urllib.error.URLError, ConnectionError, TimeoutError, socket.timeout,
+                              asyncio.TimeoutError, http.client.HTTPException, asyncio.IncompleteReadError))
+
+
+def retry_delay(attempt):
+    """
+    seconds to wait before retry number attempt (from 0), exponential with jitter so that the connections
+    of a download do not retry in lockstep
+
+    :type attempt: int
+    :rtype: float
+    """
+    return min(RETRY_BACKOFF * 2 ** attempt, MAX_RETRY_BACKOFF) * random.uniform(0.5, 1)
+
+
+def split_ranges(filesize, segment_size):
+    """
+    split a file into byte ranges of at most segment_size bytes
+
+    :param filesize: size of the file in bytes
+    :type filesize: int
+    :param segment_size: maximum size of each range
+    :type segment_size: int
+    :return: list of (start, end) with inclusive end, in file order
+    :rtype: list[tuple[int, int]]
+    """
+    return [(start, min(start + segment_size, filesize) - 1) for start in range(0, filesize, segment_size)]
@@ -0,0 +1,389 @@
+import http.client
+import select
+import socket
+import ssl
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+
+DEFAULT_TIMEOUT = 30  # seconds
+DEFAULT_CHUNK_SIZE = 65536  # bytes read from a connection at a time
+DEFAULT_MAX_PER_HOST = 16  # connections open to one host at a time
+DEFAULT_KEEP_ALIVE = 60  # seconds an idle connection is kept for the next request to the same host
+DEFAULT_DNS_TTL = 300  # seconds the addresses of a host are remembered
+COUNTERS = ('requests', 'connections', 'reused', 'stale', 'waits', 'wait_time', 'tls_handshakes', 'tls_resumed',
+            'dns_lookups', 'dns_cached')
+
+_default_transport = None
+_default_transport_lock = threading.Lock()
+
+
+class Transport:
+    def __init__(self, max_per_host=DEFAULT_MAX_PER_HOST, keep_alive=DEFAULT_KEEP_ALIVE, timeout=DEFAULT_TIMEOUT,
+                 chunk_size=DEFAULT_CHUNK_SIZE, dns_ttl=DEFAULT_DNS_TTL, context=None):
+        """
+        HTTP connections shared by the requests of a process: stream ranges, thumbnails, clip indexes and,
+        once installed as urllib's opener, pytube's metadata requests. a connection is kept open after its
+        response was read to the end and reused by the next request to the same host, TLS sessions are
+        resumed on new connections and the addresses of hosts are cached.
+        redirects, proxies and error statuses are handled by urllib as usual, requests tunnelled through
+        an HTTPS proxy are not pooled
+
+        :param max_per_host: connections open to one host at a time, a request waits up to its timeout for
+                             a free one (timeout of the transport if it has none), unlimited if None
+        :type max_per_host: int or None
+        :param keep_alive: seconds an idle connection is kept open, 0 to close connections after every request
+        :type keep_alive: int or float
+        :param timeout: timeout of requests opened without one, in seconds
+        :type timeout: int or float
+        :param chunk_size: bytes read from a connection at a time by downloads using this transport
+        :type chunk_size: int
+        :param dns_ttl: seconds the addresses of a host are remembered
+        :type dns_ttl: int or float
+        :param context: TLS settings of HTTPS connections, the system's default settings if None
+        :type context: ssl.SSLContext or None
+        """
+        if max_per_host is not None and max_per_host < 1:
+            raise ValueError("max_per_host should be at least 1")
+        self.max_per_host = max_per_host
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.dns_ttl = dns_ttl
+        if context is None:
+            context = ssl.create_default_context()
+            context.set_alpn_protocols(['http/1.1'])
+        self.context = context
+        self.lock = threading.Lock()
+        self.hosts = {}  # (scheme, host) -> _Host
+        self.addresses = {}  # (host, port) -> (expiry, socket addresses)
+        self.sessions = {}  # (host, port) -> TLS session of the last connection, resumed by the next one
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.opener = urllib.request.build_opener(_PooledHTTPHandler(self), _PooledHTTPSHandler(self))
+
+    def open(self, request, timeout=None):
+        """
+        send a request, like urllib.request.urlopen. read the response to the end, or close it, to give
+        its connection back
+
+        :param request: url or request
+        :type request: str or urllib.request.Request
+        :param timeout: timeout in seconds, the timeout of the transport if None
+        :type timeout: int or float or None
+        :rtype: http.client.HTTPResponse
+        :raise urllib.error.HTTPError: on error status
+        :raise urllib.error.URLError: if the request could not be sent
+        """
+        return self.opener.open(request, timeout=timeout if timeout is not None else self.timeout)
+
+    def statistics(self):
+        """
+        counters of connection reuse since the transport was created:
+        requests, connections (opened), reused (requests sent on a kept-alive connection), stale (kept-alive
+        connections the server had closed), waits and wait_time (requests that waited for a free connection
+        and the seconds they waited), tls_handshakes, tls_resumed (handshakes resuming a session),
+        dns_lookups, dns_cached (connections made to a cached address), plus reuse_ratio and the number of
+        connections open and idle right now
+
+        :rtype: dict
+        """
+        with self.lock:
+            result = dict(self.counters)
+            result['open'] = sum(host.open for host in self.hosts.values())
+            result['idle'] = sum(len(host.idle) for host in self.hosts.values())
+        result['wait_time'] = round(result['wait_time'], 3)
+        result['reuse_ratio'] = round(result['reused'] / result['requests'], 3) if result['requests'] else 0.0
+        return result
+
+    def close(self):
+        """
+        close the idle connections, connections in use are closed once their response is done
+        """
+        with self.lock:
+            idle = [connection for host in self.hosts.values() for connection, _ in host.idle]
+            for host in self.hosts.values():
+                host.open -= len(host.idle)
+                host.idle.clear()
+        for connection in idle:
+            connection.close()
+
+    def _count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def _open(self, request, scheme):
+        """
+        send request on a pooled connection, see urllib.request.AbstractHTTPHandler.do_open
+        """
+        if not request.host:
+            raise urllib.error.URLError('no host given')
+        headers = dict(request.unredirected_hdrs)
+        headers.update({name: value for name, value in request.headers.items() if name not in headers})
+        # unlike urllib, no "Connection: close", the connection is kept for the next request
+        headers = {name.title(): value for name, value in headers.items()}
+        timeout = request.timeout if isinstance(request.timeout, (int, float)) else socket.getdefaulttimeout()
+        key = (scheme, request.host)
+        self._count('requests')
+        while True:
+            connection, reused = self._checkout(key, timeout)
+            sent = False
+            try:
+                connection.request(request.get_method(), request.selector, request.data, headers,
+                                   encode_chunked=request.has_header('Transfer-encoding'))
+                sent = True
+                response = connection.getresponse()
+            except Exception as e:
+                self._checkin(key, connection, False)
+                if reused and isinstance(e, (ConnectionError, http.client.BadStatusLine)):
+                    # closed by the server while idle, send again on another connection
+                    self._count('stale')
+                    continue
+                if isinstance(e, OSError) and not sent:
+                    raise urllib.error.URLError(e)
+                raise
+            break
+        if reused:
+            self._count('reused')
+        response.release = lambda reusable: self._checkin(key, connection, reusable)
+        if response.length == 0:
+            # nothing to read, e.g. HEAD, the connection is free right away
+            response.close()
+        response.url = request.get_full_url()
+        response.msg = response.reason
+        return response
+
+    def _checkout(self, key, timeout):
+        """
+        idle connection to the host of key, or a new one once fewer than max_per_host are open.
+        return (connection, True if it was used before)
+        """
+        # a request without a timeout must not wait forever for a connection another thread never frees
+        limit = timeout if timeout is not None else self.timeout if self.timeout is not None else DEFAULT_TIMEOUT
+        with self.lock:
+            host = self.hosts.get(key)
+            if host is None:
+                host = self.hosts[key] = _Host(self.lock)
+            started = time.monotonic()
+            waited = False
+            while True:
+                connection = self._idle_connection(host)
+                if connection is not None:
+                    connection.timeout = timeout
+                    connection.sock.settimeout(timeout)
+                    result = connection, True
+                    break
+                if self.max_per_host is None or host.open < self.max_per_host:
+                    host.open += 1
+                    result = self._connection(key, timeout), False
+                    break
+                if not waited:
+                    waited = True
+                    self.counters['waits'] += 1
+                wait = started + limit - time.monotonic()
+                if wait <= 0:
+                    self.counters['wait_time'] += time.monotonic() - started
+                    raise urllib.error.URLError(socket.timeout(
+                        'no free connection to {} within {} seconds, all {} are busy'.format(
+                            key[1], limit, self.max_per_host)))
+                host.freed.wait(wait)
+            if waited:
+                self.counters['wait_time'] += time.monotonic() - started
+            return result
+
+    def _idle_connection(self, host):
+        """
+        the most recently used idle connection of host that is still open, closing the expired ones
+        """
+        now = time.monotonic()
+        while host.idle:
+            connection, idle_since = host.idle.pop()
+            if now - idle_since < self.keep_alive and _alive(connection):
+                return connection
+            host.open -= 1
+            connection.close()
+        return None
+
+    def _connection(self, key, timeout):
+        scheme, address = key
+        if scheme == 'https':
+            connection = _PooledHTTPSConnection(self, address, timeout=timeout, context=self.context)
+        else:
+            connection = _PooledHTTPConnection(address, timeout=timeout)
+        # every new socket goes through the address cache
+        connection._create_connection = self._create_connection
+        return connection
+
+    def _checkin(self, key, connection, reusable):
+        """
+        give a connection back after its response is done, it is kept for the next request if reusable
+        """
+        sock = connection.sock
+        if isinstance(sock, ssl.SSLSocket) and sock.session is not None:
+            # read after the response, TLS 1.3 sends the session ticket after the handshake
+            with self.lock:
+                self.sessions[(connection.host, connection.port)] = sock.session
+        keep = reusable and sock is not None and self.keep_alive > 0
+        with self.lock:
+            host = self.hosts[key]
+            if keep:
+                host.idle.append((connection, time.monotonic()))
+            else:
+                host.open -= 1
+            host.freed.notify()
+        if not keep:
+            connection.close()
+
+    def _session(self, host, port):
+        with self.lock:
+            return self.sessions.get((host, port))
+
+    def _handshake(self, sock):
+        with self.lock:
+            self.counters['tls_handshakes'] += 1
+            if sock.session_reused:
+                self.counters['tls_resumed'] += 1
+
+    def _resolve(self, host, port):
+        """
+        socket addresses of host, from the cache if they were looked up less than dns_ttl seconds ago
+        """
+        now = time.monotonic()
+        with self.lock:
+            expiry, addresses = self.addresses.get((host, port), (0, None))
+            if expiry > now:
+                self.counters['dns_cached'] += 1
+                return addresses
+            self.counters['dns_lookups'] += 1
+        addresses = [info[4] for info in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)]
+        with self.lock:
+            self.addresses[(host, port)] = (now + self.dns_ttl, addresses)
+        return addresses
+
+    def _create_connection(self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+        """
+        socket.create_connection over the cached addresses of the host
+        """
+        self._count('connections')
+        host, port = address
+        error = None
+        for sockaddr in self._resolve(host, port):
+            try:
+                return socket.create_connection(sockaddr[:2], timeout, source_address)
+            except OSError as e:
+                error = e
+        # the host may have moved, look it up again next time
+        with self.lock:
+            self.addresses.pop((host, port), None)
+        raise error
+
+
+class _Host:
+    def __init__(self, lock):
+        """
+        connections of a transport to one host
+        """
+        self.open = 0  # connections in use or idle
+        self.idle = deque()  # (connection, monotonic time it became idle), the most recent last
+        self.freed = threading.Condition(lock)  # notified when a connection is given back
+
+
+class _PooledResponse(http.client.HTTPResponse):
+    release = None  # callback(reusable) giving the connection back, set by Transport._open
+
+    def _close_conn(self):
+        super()._close_conn()
+        # also called when the server closed the connection before the end of a body of known length
+        self._release(not self.will_close and (self.chunked or self.length == 0))
+
+    def close(self):
+        if self.fp is not None and self.length != 0:
+            # closed before the end of the body, the rest would arrive on the next request
+            self._release(False)
+        super().close()
+
+    def _release(self, reusable):
+        release, self.release = self.release, None
+        if release is not None:
+            release(reusable)
+
+
+class _PooledHTTPConnection(http.client.HTTPConnection):
+    response_class = _PooledResponse
+
+
+class _PooledHTTPSConnection(http.client.HTTPSConnection):
+    response_class = _PooledResponse
+
+    def __init__(self, transport, host, **kwargs):
+        super().__init__(host, **kwargs)
+        self.transport = transport
+
+    def connect(self):
+        # same as HTTPSConnection.connect, but resuming the last TLS session with the host
+        http.client.HTTPConnection.connect(self)
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=self.host,
+                                              session=self.transport._session(self.host, self.port))
+        self.transport._handshake(self.sock)
+
+
+class _PooledHTTPHandler(urllib.request.HTTPHandler):
+    def __init__(self, transport):
+        super().__init__()
+        self.transport = transport
+
+    def http_open(self, request):
+        return self.transport._open(request, 'http')
+
+
+class _PooledHTTPSHandler(urllib.request.HTTPSHandler):
+    def __init__(self, transport):
+        super().__init__(context=transport.context)
+        self.transport = transport
+
+    def https_open(self, request):
+        if request._tunnel_host:
+            # CONNECT tunnel through a proxy, not pooled
+            return super().https_open(request)
+        return self.transport._open(request, 'https')
+
+
+def _alive(connection):
+    """
+    an idle connection the server closed has a readable socket, with the end of the stream to read
+    """
+    if connection.sock is None:
+        return False
+    try:
+        return not select.select([connection.sock], [], [], 0)[0]
+    except (OSError, ValueError):
+        return False
+
+
+def default_transport():
+    """
+    transport shared by every helper of this process. it is installed as urllib's opener, so pytube's own
+    requests for metadata, stream sizes and sequential streams reuse its connections too
+
+    :rtype: Transport
+    """
+    global _default_transport
+    with _default_transport_lock:
+        if _default_transport is None:
+            _default_transport = Transport()
+            urllib.request.install_opener(_default_transport.opener)
+        return _default_transport
+
+
+def set_default_transport(transport):
+    """
+    replace the transport shared by every helper of this process, e.g. by one with other limits,
+    and install it as urllib's opener
+
+    :type transport: Transport
+    """
+    global _default_transport
+    with _default_transport_lock:
+        _default_transport = transport
+        urllib.request.install_opener(transport.opener)